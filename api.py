@@ -0,0 +1,178 @@
+"""Read-only JSON views of a user's dashboards, built from column projections.
+
+Each view selects just the columns its JSON needs, as plain rows, so no ORM
+objects are built or tracked, and code descriptions come from the code
+registry. Archived jobs and contacts grow without limit, so they're paged
+with the same keyset cursors as their HTML lists (see pages.py)."""
+
+from sqlalchemy import and_, desc, func
+from codes import code_registry
+from model import Company, Contact, ContactEvent, Job, JobEvent, JobStatus, ToDo, User, db
+from pages import PAGE_SIZE, is_latest_contact_event, seek
+
+
+def iso(value):
+    """A date as JSON sends it."""
+
+    return value.isoformat() if value else None
+
+
+def todo_json(todo_id, todo_code, date_due, codes):
+    """A todo's columns as JSON, or None when there's no todo."""
+
+    if todo_id is None:
+        return None
+
+    return {'todo_id': todo_id,
+            'todo_code': todo_code,
+            'description': codes.todo_codes[todo_code].description,
+            'date_due': iso(date_due)}
+
+
+##############################################################################
+# Jobs
+
+def job_rows(user_id, active_status):
+    """The unordered query for the columns of a user's active or archived jobs."""
+
+    return (db.session.query(JobStatus.job_id, JobStatus.job_event_id, JobStatus.job_code,
+                             JobStatus.last_activity, Job.title, Job.link, Job.notes, Job.avg_salary,
+                             Job.company_id, Company.name.label('company_name'),
+                             ToDo.todo_id, ToDo.todo_code, ToDo.date_due)
+              .join(Job, Job.job_id == JobStatus.job_id)
+              .join(Company, Company.company_id == Job.company_id)
+              .outerjoin(ToDo, and_(ToDo.todo_id == JobStatus.todo_id,
+                                    ToDo.active_status == True))
+              .filter(JobStatus.user_id == user_id, Job.active_status == active_status))
+
+
+def job_json(row, codes):
+    """A job row as JSON."""
+
+    return {'job_id': row.job_id,
+            'title': row.title,
+            'link': row.link,
+            'notes': row.notes,
+            'avg_salary': row.avg_salary,
+            'company_id': row.company_id,
+            'company_name': row.company_name,
+            'job_code': row.job_code,
+            'status': codes.job_codes[row.job_code],
+            'last_activity': iso(row.last_activity),
+            'todo': todo_json(row.todo_id, row.todo_code, row.date_due, codes)}
+
+
+def active_jobs(user_id):
+    """Every active job a user tracks, latest activity first."""
+
+    codes = code_registry.get_data()
+    rows = (job_rows(user_id, active_status=True)
+              .order_by(desc(JobStatus.last_activity), desc(JobStatus.job_event_id))
+              .all())
+
+    return {'jobs': [job_json(row, codes) for row in rows]}
+
+
+def archived_jobs(user_id, cursor=None, limit=PAGE_SIZE):
+    """A page of a user's archived jobs, latest activity first, and the next page's cursor."""
+
+    codes = code_registry.get_data()
+    rows, next_cursor = seek(job_rows(user_id, active_status=False),
+                             JobStatus.last_activity, JobStatus.job_event_id,
+                             lambda row: (row.last_activity, row.job_event_id),
+                             cursor, limit)
+
+    return {'jobs': [job_json(row, codes) for row in rows], 'next_cursor': next_cursor}
+
+
+##############################################################################
+# Companies, contacts and todos
+
+def companies(user_id):
+    """Every company a user has a job or contact at, by name, with how many of their jobs are there."""
+
+    job_counts = dict(db.session.query(Job.company_id, func.count(JobStatus.job_id))
+                        .join(JobStatus, JobStatus.job_id == Job.job_id)
+                        .filter(JobStatus.user_id == user_id)
+                        .group_by(Job.company_id))
+
+    rows = (db.session.query(Company.company_id, Company.name, Company.city, Company.state,
+                             Company.website)
+              .filter(Company.company_id.in_(User.company_ids(user_id)))
+              .order_by(Company.name, Company.company_id))
+
+    return {'companies': [{'company_id': row.company_id,
+                           'name': row.name,
+                           'city': row.city,
+                           'state': row.state,
+                           'website': row.website,
+                           'jobs': job_counts.get(row.company_id, 0)}
+                          for row in rows]}
+
+
+def contacts(user_id, cursor=None, limit=PAGE_SIZE):
+    """A page of a user's contacts, most recently contacted first, and the next page's cursor."""
+
+    codes = code_registry.get_data()
+    query = (db.session.query(ContactEvent.contact_event_id, ContactEvent.contact_code,
+                              ContactEvent.date_created, Contact.contact_id, Contact.fname,
+                              Contact.lname, Contact.email, Contact.phone, Contact.company_id,
+                              Company.name.label('company_name'))
+               .join(Contact, Contact.contact_id == ContactEvent.contact_id)
+               .outerjoin(Company, Company.company_id == Contact.company_id)
+               .filter(is_latest_contact_event(user_id)))
+
+    rows, next_cursor = seek(query, ContactEvent.date_created, ContactEvent.contact_event_id,
+                             lambda row: (row.date_created, row.contact_event_id),
+                             cursor, limit)
+
+    # the oldest active todo of each latest event, for the whole page in one query
+    todos = {}
+    if rows:
+        for todo in (db.session.query(ToDo.contact_event_id, ToDo.todo_id, ToDo.todo_code, ToDo.date_due)
+                       .filter(ToDo.contact_event_id.in_([row.contact_event_id for row in rows]),
+                               ToDo.active_status == True)
+                       .order_by(ToDo.todo_id)):
+            todos.setdefault(todo.contact_event_id, todo)
+
+    def contact_json(row):
+        todo = todos.get(row.contact_event_id)
+        return {'contact_id': row.contact_id,
+                'fname': row.fname,
+                'lname': row.lname,
+                'email': row.email,
+                'phone': row.phone,
+                'company_id': row.company_id,
+                'company_name': row.company_name,
+                'contact_code': row.contact_code,
+                'last_action': codes.contact_codes[row.contact_code],
+                'last_contacted': iso(row.date_created),
+                'todo': todo_json(todo.todo_id, todo.todo_code, todo.date_due, codes) if todo else None}
+
+    return {'contacts': [contact_json(row) for row in rows], 'next_cursor': next_cursor}
+
+
+def todos(user_id):
+    """Every active todo on a user's job and contact events, soonest due first."""
+
+    codes = code_registry.get_data()
+
+    # one query per kind of event, so each is found through its own index
+    job_todos = (db.session.query(ToDo.todo_id, ToDo.todo_code, ToDo.date_due, JobEvent.job_id)
+                   .join(JobEvent, JobEvent.job_event_id == ToDo.job_event_id)
+                   .filter(JobEvent.user_id == user_id, ToDo.active_status == True)
+                   .all())
+    contact_todos = (db.session.query(ToDo.todo_id, ToDo.todo_code, ToDo.date_due, ContactEvent.contact_id)
+                       .join(ContactEvent, ContactEvent.contact_event_id == ToDo.contact_event_id)
+                       .filter(ContactEvent.user_id == user_id, ToDo.active_status == True)
+                       .all())
+
+    rows = ([dict(todo_json(row.todo_id, row.todo_code, row.date_due, codes), job_id=row.job_id)
+             for row in job_todos]
+            + [dict(todo_json(row.todo_id, row.todo_code, row.date_due, codes), contact_id=row.contact_id)
+               for row in contact_todos])
+
+    # todos without a due date go last
+    rows.sort(key=lambda todo: (todo['date_due'] is None, todo['date_due'] or '', todo['todo_id']))
+
+    return {'todos': rows}
@@ -0,0 +1,439 @@
+"""Benchmark the dashboard routes against a seeded database of any size.
+
+    createdb benchjobs
+    python3.6 bench.py run --users 10000 --output before.json
+    ... change something ...
+    python3.6 bench.py run --users 10000 --output after.json
+    python3.6 bench.py compare before.json after.json
+    python3.6 bench.py load --workers 1 2 4
+
+The same seed and scale give the same data, so two runs are comparable; the
+posts add rows, so a run with --no-seed measures a slightly bigger database.
+Each route is requested through the Flask test client as one logged-in user,
+timing every request and reading the SQL statements it issued and the rows
+they returned from the X-SQL-* headers instrument.py adds. compare exits with
+status 1 when a route got slower or issues more SQL than before.
+
+load serves the app the way production does, with gunicorn (serving.py and
+wsgi.py), once for each number of worker processes, and measures how many
+dashboard pages a second it answers to a fixed number of client processes
+logged in as one user."""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import Pool
+from statistics import median
+from model import Company, Contact, Job, connect_to_db, db
+from server import app
+from salaries import salary_service
+
+
+# the user every request is made as
+BENCH_USER_ID = 1
+
+# pages, in the order they are benchmarked; {job_id}, {contact_id} and
+# {company_id} are the job and contact added for the benchmark
+GET_ROUTES = [
+    '/dashboard/jobs',
+    '/dashboard/jobs/archived',
+    '/dashboard/jobs/{job_id}',
+    '/dashboard/companies',
+    '/dashboard/companies/{company_id}',
+    '/dashboard/contacts',
+    '/dashboard/contacts/{contact_id}',
+    '/dashboard/profile',
+    '/dashboard/jobs/salary/analytics',
+]
+
+# form posts, benchmarked after the pages since they add rows
+POST_ROUTES = [
+    ('/dashboard/jobs/add', {'job_title': 'Software Engineer', 'job_status': '2', 'job_link': '',
+                             'job_notes': '', 'company_id': '{company_id}', 'company_name': ''}),
+    ('/dashboard/job-status', {'job_id': '{job_id}', 'job_code': '3'}),
+    ('/dashboard/jobs/edit', {'job_id': '{job_id}', 'link': 'example.com', 'avg_salary': '$90,000',
+                              'notes': 'Benchmark notes'}),
+    ('/dashboard/contacts/add', {'fname': 'Bench', 'lname': 'Contact', 'email': '', 'phone': '',
+                                 'notes': '', 'company_id': '{company_id}', 'company_name': '',
+                                 'contact_event': '1'}),
+    ('/dashboard/contact-status', {'contact_id': '{contact_id}', 'contact_code': '2'}),
+    ('/dashboard/profile/edit', {'fname': 'Bench', 'lname': 'User', 'email': 'bench@example.com',
+                                 'phone': '5555555555'}),
+]
+
+
+# pages the load test requests in turn, as a user with an open browser tab would
+LOAD_ROUTES = [
+    '/dashboard/jobs',
+    '/dashboard/jobs/archived',
+    '/dashboard/companies',
+    '/dashboard/contacts',
+    '/dashboard/profile',
+]
+
+
+def parse_args(args=None):
+    """Read the run or compare command from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run = commands.add_parser('run', help="seed a database and benchmark every route")
+    run.add_argument('--db', default='postgresql:///benchjobs',
+                     help="database to seed and benchmark; everything in it is replaced")
+    run.add_argument('--no-seed', action='store_true', help="benchmark the database as it is")
+    run.add_argument('--seed', type=int, default=0, help="random seed for the generated data")
+    run.add_argument('--users', type=int, default=1000)
+    run.add_argument('--jobs-per-user', type=int, default=20)
+    run.add_argument('--events-per-job', type=int, default=6)
+    run.add_argument('--contacts-per-user', type=int, default=10)
+    run.add_argument('--workers', type=int, default=None, help="processes generating the data")
+    run.add_argument('--iterations', type=int, default=30, help="timed requests per route")
+    run.add_argument('--warmup', type=int, default=3, help="untimed requests per route first")
+    run.add_argument('--output', default='bench.json', help="where to write the JSON results")
+
+    load = commands.add_parser('load', help="measure throughput under gunicorn as workers are added")
+    load.add_argument('--db', default='postgresql:///benchjobs', help="database to serve, as it is")
+    load.add_argument('--user', type=int, default=3, help="user every client is logged in as")
+    load.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                      help="worker processes to serve with, one load test each")
+    load.add_argument('--threads', type=int, default=4, help="threads per worker process")
+    load.add_argument('--clients', type=int, default=16, help="client processes making requests at once")
+    load.add_argument('--duration', type=float, default=20, help="seconds to measure each load test")
+    load.add_argument('--warmup', type=float, default=5, help="untimed seconds first, to fill every worker's caches")
+    load.add_argument('--port', type=int, default=5099)
+    load.add_argument('--output', default='load.json', help="where to write the JSON results")
+
+    compare = commands.add_parser('compare', help="flag routes that regressed between two runs")
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--threshold', type=float, default=0.2,
+                         help="fraction a latency may grow before it counts (default 0.2)")
+    compare.add_argument('--min-delta-ms', type=float, default=1.0,
+                         help="latency changes smaller than this are noise (default 1.0)")
+
+    return parser.parse_args(args)
+
+
+def seed_database(settings):
+    """Replace everything in the benchmark database with generated data at the requested scale."""
+
+    from data.faker import generate, parse_args as faker_args
+    import seed
+
+    db.drop_all()
+    db.create_all()
+
+    with tempfile.TemporaryDirectory() as directory:
+        scale = ['--seed', str(settings.seed), '--users', str(settings.users),
+                 '--jobs-per-user', str(settings.jobs_per_user),
+                 '--events-per-job', str(settings.events_per_job),
+                 '--contacts-per-user', str(settings.contacts_per_user), '--output', directory]
+        if settings.workers:
+            scale += ['--workers', str(settings.workers)]
+        generate(faker_args(scale))
+
+        seed.load_salaries()
+        seed.load_todocodes()
+        seed.load_contactcodes()
+        seed.load_jobcodes()
+        seed.load_users(directory)
+        seed.load_companies(directory)
+        seed.load_contacts(directory)
+        seed.load_contactevents(directory)
+        seed.load_jobs(directory)
+        seed.load_jobevents(directory)
+
+    seed.set_sequences()
+    seed.assign_company_owners()
+    seed.merge_duplicate_companies()
+    seed.rebuild_job_statuses()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def measure(request, iterations, warmup):
+    """Time a request function, returning its latency percentiles, statements and rows."""
+
+    for _ in range(warmup):
+        request()
+
+    timings = []
+    statements = []
+    rows = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = request()
+        timings.append((time.perf_counter() - start) * 1000)
+
+        # counted by instrument.py for every request
+        statements.append(int(response.headers['X-SQL-Statements']))
+        rows.append(int(response.headers['X-SQL-Rows']))
+
+        # a failing route would only benchmark its error page
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.status_code} from {request.__doc__}")
+
+    return {
+        'p50_ms': round(percentile(timings, 0.5), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'statements': int(median(statements)),
+        'rows': int(median(rows)),
+        'status': response.status_code,
+    }
+
+
+def add_targets(client):
+    """Add the job and contact the detail pages and posts use, returning their ids.
+
+    Seeded jobs and contacts have no todos, so the benchmark adds its own
+    through the app's forms, to time pages that show tasks."""
+
+    company_id = str(db.session.query(db.func.min(Company.company_id))
+                       .filter(Company.owner_user_id == BENCH_USER_ID).scalar())
+
+    client.post('/dashboard/jobs/add', data=dict(POST_ROUTES[0][1], company_id=company_id))
+    client.post('/dashboard/contacts/add', data=dict(POST_ROUTES[3][1], company_id=company_id))
+    db.session.remove()
+
+    return {
+        'company_id': company_id,
+        'job_id': str(db.session.query(db.func.max(Job.job_id)).scalar()),
+        'contact_id': str(db.session.query(db.func.max(Contact.contact_id)).scalar()),
+    }
+
+
+def run_benchmark(settings):
+    """Benchmark every route, returning the results by route."""
+
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = BENCH_USER_ID
+
+    salary_service.load()
+    targets = add_targets(client)
+    results = {}
+
+    for route in GET_ROUTES:
+        url = route.format(**targets)
+
+        def request():
+            return client.get(url)
+        request.__doc__ = f'GET {url}'
+
+        results[f'GET {route}'] = measure(request, settings.iterations, settings.warmup)
+        print(f"GET {route}: {results[f'GET {route}']}")
+
+    for route, form in POST_ROUTES:
+        data = {name: value.format(**targets) for name, value in form.items()}
+
+        def request():
+            return client.post(route, data=data)
+        request.__doc__ = f'POST {route}'
+
+        results[f'POST {route}'] = measure(request, settings.iterations, settings.warmup)
+        print(f"POST {route}: {results[f'POST {route}']}")
+
+    return results
+
+
+def session_cookie(user_id):
+    """A session cookie logging a client in as user_id, signed with the app's secret key."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+
+    return f'{app.session_cookie_name}={serializer.dumps({"user_id": user_id})}'
+
+
+def load_client(port, cookie, deadline, first_route):
+    """Request LOAD_ROUTES in turn over one keep-alive connection until deadline.
+
+    Returns the latency of every successful request, in milliseconds, and how
+    many requests failed."""
+
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    timings = []
+    errors = 0
+    routes = LOAD_ROUTES[first_route:] + LOAD_ROUTES[:first_route]
+
+    while time.time() < deadline:
+        for route in routes:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', route, headers={'Cookie': cookie})
+                response = connection.getresponse()
+                response.read()
+                succeeded = response.status == 200
+            except (OSError, http.client.HTTPException):
+                # the next request opens a new connection
+                connection.close()
+                succeeded = False
+
+            if succeeded:
+                timings.append((time.perf_counter() - start) * 1000)
+            else:
+                errors += 1
+
+    connection.close()
+
+    return timings, errors
+
+
+def start_server(settings, workers):
+    """Start gunicorn with a number of workers, returning once it answers requests."""
+
+    env = dict(os.environ, WORKERS=str(workers), THREADS=str(settings.threads),
+               BIND=f'127.0.0.1:{settings.port}', DATABASE_URL=settings.db)
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    server = subprocess.Popen([gunicorn, '-c', 'serving.py', 'wsgi:app'], env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', settings.port, timeout=5)
+            connection.request('GET', '/')
+            if connection.getresponse().status == 200:
+                return server
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.5)
+
+    server.terminate()
+    raise RuntimeError("gunicorn didn't start answering requests within a minute")
+
+
+def run_load_test(settings):
+    """Load test gunicorn at each number of workers, returning the results by worker count."""
+
+    cookie = session_cookie(settings.user)
+    results = {}
+
+    for workers in settings.workers:
+        server = start_server(settings, workers)
+        try:
+            with Pool(settings.clients) as clients:
+                def run(seconds):
+                    deadline = time.time() + seconds
+                    return clients.starmap(load_client, [(settings.port, cookie, deadline, client % len(LOAD_ROUTES))
+                                                         for client in range(settings.clients)])
+
+                run(settings.warmup)
+                start = time.time()
+                runs = run(settings.duration)
+                elapsed = time.time() - start
+        finally:
+            server.terminate()
+            server.wait()
+
+        timings = [timing for client_timings, errors in runs for timing in client_timings]
+        results[str(workers)] = {
+            'requests_per_second': round(len(timings) / elapsed, 1),
+            'p50_ms': round(percentile(timings, 0.5), 3) if timings else None,
+            'p95_ms': round(percentile(timings, 0.95), 3) if timings else None,
+            'errors': sum(errors for client_timings, errors in runs),
+        }
+        print(f"{workers} workers x {settings.threads} threads: {results[str(workers)]}")
+
+    return results
+
+
+def git_commit():
+    """The commit being benchmarked, or None outside a git checkout."""
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_regressions(before, after, threshold=0.2, min_delta_ms=1.0):
+    """List the routes that got slower or issue more SQL between two result files."""
+
+    regressions = []
+
+    for route, new in after['routes'].items():
+        old = before['routes'].get(route)
+        if old is None:
+            continue
+
+        for timing in ('p50_ms', 'p95_ms'):
+            delta = new[timing] - old[timing]
+            if delta > min_delta_ms and new[timing] > old[timing] * (1 + threshold):
+                regressions.append(f"{route}: {timing} {old[timing]} -> {new[timing]}")
+
+        # statement counts don't vary between runs, so any increase is real
+        if new['statements'] > old['statements']:
+            regressions.append(f"{route}: statements {old['statements']} -> {new['statements']}")
+
+        if new['rows'] > old['rows'] * (1 + threshold):
+            regressions.append(f"{route}: rows {old['rows']} -> {new['rows']}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    settings = parse_args()
+
+    if settings.command == 'compare':
+        with open(settings.before) as before_file, open(settings.after) as after_file:
+            before = json.load(before_file)
+            after = json.load(after_file)
+
+        if before['settings'] != after['settings']:
+            print("Warning: the two runs used different settings.")
+
+        regressions = find_regressions(before, after, settings.threshold, settings.min_delta_ms)
+        for regression in regressions:
+            print(regression)
+        print(f"{len(regressions)} regressions between {before['commit']} and {after['commit']}.")
+        sys.exit(1 if regressions else 0)
+
+    if settings.command == 'load':
+        results = {
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(),
+            'cpus': os.cpu_count(),
+            'settings': {name: value for name, value in vars(settings).items()
+                         if name in ('db', 'user', 'threads', 'clients', 'duration')},
+            'workers': run_load_test(settings),
+        }
+
+        with open(settings.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f"Wrote {settings.output}.")
+        sys.exit(0)
+
+    connect_to_db(app, settings.db)
+
+    if not settings.no_seed:
+        seed_database(settings)
+
+    results = {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(),
+        'settings': {name: value for name, value in vars(settings).items()
+                     if name in ('db', 'seed', 'users', 'jobs_per_user', 'events_per_job',
+                                 'contacts_per_user', 'iterations', 'warmup')},
+        'routes': run_benchmark(settings),
+    }
+
+    with open(settings.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"Wrote {settings.output}.")
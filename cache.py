@@ -0,0 +1,67 @@
+"""In-process caches for data the job hunt app renders on every page."""
+
+from threading import Lock
+from cachetools import LRUCache
+from model import User, Company, db
+
+
+class CompanyCache(object):
+    """Per-user cache of the (company_id, name) pairs shown in the company dropdowns.
+
+    Holds at most maxsize users and evicts the least recently used one when full.
+    Handlers that can attach a new company to a user must call invalidate().
+    That only reaches this process's cache, so callers serving from several
+    processes pass the user's data version too: an entry loaded at another
+    version is reloaded, whichever process made the change."""
+
+    def __init__(self, maxsize=1000):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, version=None):
+        """Return the dropdown companies for a user, querying only on a cache miss.
+
+        With a version, companies cached at any other data version are a miss."""
+
+        with self.lock:
+            entry = self.cache.get(user_id)
+            if entry is not None and (version is None or entry[0] == version):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # query outside the lock so one slow user doesn't block the others
+        companies = tuple(db.session.query(Company.company_id, Company.name)
+                            .filter(Company.company_id.in_(User.company_ids(user_id)))
+                            .order_by(Company.name)
+                            .all())
+
+        with self.lock:
+            self.cache[user_id] = (version, companies)
+
+        return companies
+
+    def invalidate(self, user_id):
+        """Drop a user's cached companies so the next page view reloads them."""
+
+        with self.lock:
+            self.cache.pop(user_id, None)
+
+    def stats(self):
+        """Return hit and miss counters for the cache."""
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': self.cache.currsize,
+                'maxsize': self.cache.maxsize,
+            }
+
+
+# one cache shared by every request in this process
+company_cache = CompanyCache()
@@ -0,0 +1,113 @@
+"""In-memory code tables for the job hunt app.
+
+The job, contact and todo code tables are a few rows of reference data that
+only change when seed.py reloads them. The code registry reads them once per
+process, along with the rule for which todo each job and contact event starts,
+so handlers and templates look codes up without a query. Every few seconds it
+checks whether the tables' reference version has gone up since."""
+
+import time
+from collections import namedtuple
+from threading import Lock
+from types import MappingProxyType
+from model import ContactCode, JobCode, ToDoCode, db
+from versions import reference_version
+
+
+# one immutable copy of the code tables, swapped in whole on every load
+CodeTables = namedtuple('CodeTables', ['job_codes', 'contact_codes', 'todo_codes',
+                                       'job_todos', 'contact_todos'])
+
+# a todo code's description and how many days after its event it's due
+TodoCode = namedtuple('TodoCode', ['description', 'sugg_due_date'])
+
+# seconds a process answers from its copy before checking whether the codes were reloaded
+CHECK_INTERVAL = 5
+
+# job codes past this one mean the search for the job is over: an offer accepted or declined,
+# or none made (see data/job-codes.txt)
+LAST_ACTIVE_JOB_CODE = 5
+
+
+class CodeRegistry(object):
+    """Descriptions of every code, and the todo code each job and contact code starts."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = None
+        # the tables' reference version when they were last loaded, and when that was last checked
+        self.loaded_version = None
+        self.checked = 0.0
+
+    def load(self):
+        """Read the code tables into memory, replacing anything loaded before."""
+
+        loaded_version = reference_version('codes')
+        job_rows = db.session.query(JobCode.job_code, JobCode.description, JobCode.todo_code).all()
+        contact_rows = db.session.query(ContactCode.contact_code, ContactCode.description,
+                                        ContactCode.todo_code).all()
+        todo_rows = db.session.query(ToDoCode.todo_code, ToDoCode.description,
+                                     ToDoCode.sugg_due_date).all()
+
+        # read-only views, so a handler can't change the codes for every other request
+        data = CodeTables(
+            job_codes=MappingProxyType({code: description for code, description, todo in job_rows}),
+            contact_codes=MappingProxyType({code: description for code, description, todo in contact_rows}),
+            todo_codes=MappingProxyType({code: TodoCode(description, days) for code, description, days in todo_rows}),
+            job_todos=MappingProxyType({code: todo for code, description, todo in job_rows}),
+            contact_todos=MappingProxyType({code: todo for code, description, todo in contact_rows}))
+
+        with self.lock:
+            self.data = data
+            self.loaded_version = loaded_version
+            self.checked = time.monotonic()
+
+        return data
+
+    def reload(self):
+        """Load the code tables again after they have been re-seeded."""
+
+        return self.load()
+
+    def get_data(self):
+        """Return the loaded code tables, loading them on first use and after another process reloads them."""
+
+        # two requests racing here both load, and the later copy wins
+        data = self.data
+        if data is None:
+            return self.load()
+
+        now = time.monotonic()
+        if now - self.checked >= CHECK_INTERVAL:
+            self.checked = now
+            if reference_version('codes') != self.loaded_version:
+                data = self.load()
+
+        return data
+
+    def todo_for_job(self, job_code):
+        """The todo code a job event with job_code starts and the days until it's due, or None."""
+
+        data = self.get_data()
+        todo_code = data.job_todos[int(job_code)]
+
+        # a code with no todo code starts no todo
+        if todo_code is None:
+            return None
+
+        return todo_code, data.todo_codes[todo_code].sugg_due_date
+
+    def todo_for_contact(self, contact_code):
+        """The todo code a contact event with contact_code starts and the days until it's due, or None."""
+
+        data = self.get_data()
+        todo_code = data.contact_todos[int(contact_code)]
+
+        if todo_code is None:
+            return None
+
+        return todo_code, data.todo_codes[todo_code].sugg_due_date
+
+
+# one registry shared by every request in this process
+code_registry = CodeRegistry()
@@ -1,90 +1,273 @@
-"""Create fake user, company, and job data from Faker """
+"""Create fake user, company, contact, and job data from Faker for seed.py to load
 
+Run from the repo root as a module, so this file doesn't hide the faker package:
+
+    python3.6 -m data.faker --users 100000 --output data/generated
+    python3.6 seed.py data/generated
+
+Rows are written in blocks, each with its own random seed, so the same seed
+and scale always give the same files however many worker processes share the
+work. Each block goes to its own part file and is appended to the output file
+in order, which keeps memory use flat at any scale.
+
+Files have no id column: a row's line number is its id. Users, jobs and
+contacts are numbered in blocks, so every reference can be worked out from
+the block being written, without reading anything back."""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import date, timedelta
+from multiprocessing import Pool
 from faker import Faker
-fake = Faker()
 
 
-def create_users():
-    """Create fake users for job hunt app"""
+# users or companies written by one worker task
+BLOCK_SIZE = 1000
+
+# codes.LAST_ACTIVE_JOB_CODE, kept here since importing codes sets up the app's
+# database; a job whose last event is past it is written as inactive
+LAST_ACTIVE_JOB_CODE = 5
+
+# Faker values drawn for each block; rows pick from these, since Faker is far
+# slower than the rest of the generator
+POOL_SIZE = 250
+
+# the Faker values users, contacts and jobs are made from
+POOLS = ['first_name', 'last_name', 'free_email_domain', 'password', 'job', 'url', 'bs']
+
+# the file seed.py reads for each kind of row
+FILES = {
+    'users': 'user-example.txt',
+    'companies': 'company-example.txt',
+    'contacts': 'contact-example.txt',
+    'contact_events': 'contact-event-examples.txt',
+    'jobs': 'job-example.txt',
+    'job_events': 'job-event-example.txt',
+}
+
+# what can follow each job code (None is a new job), with weights; None ends the job's history
+JOB_STEPS = {
+    None: [(1, 60), (2, 40)],                   # interested, or applied right away
+    1: [(2, 70), (None, 30)],                   # interested -> applied
+    2: [(3, 35), (8, 35), (None, 30)],          # applied -> phone interview or no offer
+    3: [(4, 50), (8, 35), (None, 15)],          # phone -> on-site or no offer
+    4: [(5, 35), (8, 45), (None, 20)],          # on-site -> offer or no offer
+    5: [(6, 60), (7, 40)],                      # offer -> accepted or declined
+}
+
+# what can follow each contact code (None is a new contact), with weights
+CONTACT_STEPS = {
+    None: [(1, 70), (2, 30)],                   # met at an event, or reached out
+    1: [(2, 50), (None, 50)],                   # met -> requested informational interview
+    2: [(3, 60), (None, 40)],                   # requested -> met for informational interview
+    3: [(4, 40), (5, 30), (None, 30)],          # met -> introduced or referred
+    4: [(5, 40), (None, 60)],                   # introduced -> referred
+}
+
+
+def parse_args(args=None):
+    """Read the seed and scale from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default 0)")
+    parser.add_argument('--users', type=int, default=10, help="number of users (default 10)")
+    parser.add_argument('--companies', type=int, default=None,
+                        help="number of companies (default one for every two users)")
+    parser.add_argument('--jobs-per-user', type=int, default=3, help="jobs each user tracks (default 3)")
+    parser.add_argument('--events-per-job', type=int, default=6,
+                        help="most status changes a job can have (default 6)")
+    parser.add_argument('--contacts-per-user', type=int, default=3,
+                        help="contacts each user tracks (default 3)")
+    parser.add_argument('--events-per-contact', type=int, default=3,
+                        help="most events a contact can have (default 3)")
+    parser.add_argument('--start', type=date_arg, default=date(2018, 1, 1),
+                        help="first day events can fall on, YYYY-MM-DD (default 2018-01-01)")
+    parser.add_argument('--days', type=int, default=365, help="days that jobs and contacts start over (default 365)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="worker processes (default one per CPU)")
+    parser.add_argument('--output', default='data/generated',
+                        help="directory to write the files to (default data/generated)")
+
+    settings = parser.parse_args(args)
+    if settings.companies is None:
+        settings.companies = max(1, settings.users // 2)
+
+    return settings
 
-    with open("data/user-example.txt", "a") as myfile:
-        count = 0
-        while count < 10:
-            fname = fake.first_name()
-            lname = fake.last_name()
-            email = fake.email()
-            password = fake.password()
-            myfile.write("{}|{}|{}|{}\n".format(fname, lname, email, password))
-            count += 1
 
+def date_arg(text):
+    """Parse a YYYY-MM-DD command line date."""
 
-def create_companies():
-    """Create fake companies for jub hunt app"""
+    year, month, day = text.split('-')
+    return date(int(year), int(month), int(day))
 
-    with open("data/company-example.txt", "a") as myfile:
-        count = 0
-        while count < 5:
+
+def choose(rng, steps):
+    """Pick the next code from a list of (code, weight) pairs."""
+
+    codes, weights = zip(*steps)
+    return rng.choices(codes, weights)[0]
+
+
+def choose_company(rng, companies):
+    """Pick a company id, favouring low ids so some companies are much more popular."""
+
+    return int(companies * rng.random() ** 2) + 1
+
+
+def history(rng, steps, most, day):
+    """Yield (code, date) for one job's or contact's events, in date order."""
+
+    code = choose(rng, steps[None])
+    for _ in range(most):
+        yield code, day
+        if code not in steps:
+            break
+        code = choose(rng, steps[code])
+        if code is None:
+            break
+        day += timedelta(days=rng.randint(1, 21))
+
+
+def write_companies(settings, first, count, parts):
+    """Write companies first to first + count - 1."""
+
+    rng = random.Random(f'{settings.seed}-companies-{first}')
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    with open(parts['companies'], 'w') as myfile:
+        for company_id in range(first, first + count):
             name = fake.company()
             street = fake.street_address()
-            city = fake.city()
+            city = fake.city()[:50]
             state = fake.state_abbr()
-            zipcode = fake.zipcode()
+            zipcode = fake.zipcode()[:5]
             website = fake.url()
             myfile.write("{}|{}|{}|{}|{}|{}\n".format(name, street, city, state, zipcode, website))
-            count += 1
-
-
-def create_jobs():
-    """Create fake jobs for job hunt app"""
-
-    with open("data/job-example.txt", "a") as myfile:
-        count = 0
-        while count < 6:
-            title = fake.job()
-            link = fake.url()
-            company_id = fake.random_int(min=21, max=25)
-            active_status = True
-            notes = fake.bs()
-            myfile.write("{}|{}|{}|{}|{}\n".format(title, link, company_id, active_status, notes))
-            count += 1
-
-
-def create_job_events():
-    """Create fake job events for job hunt app"""
-
-    with open("data/job-event-example.txt", "a") as myfile:
-        count = 0
-        while count < 6:
-            job_id = fake.random_int(min=25, max=30)
-            user_id = 5
-            job_code = fake.random_int(min=1, max=8)
-            date = fake.date_this_year()
-            myfile.write("{}|{}|{}|{}\n".format(job_id, user_id, job_code, date))
-            count += 1
-
-
-def create_contacts():
-    """Create fake contacts for job hunt app"""
-
-    with open("data/contact-example.txt", "a") as myfile:
-        count = 0
-        while count < 5:
-            fname = fake.first_name()
-            lname = fake.last_name()
-            company_id = fake.random_int(min=21, max=25)
-            myfile.write("{}|{}|{}\n".format(fname, lname, company_id))
-            count += 1
-
-
-def create_contact_events():
-    """Create fake contact events for job hunt app"""
-
-    with open("data/contact-event-examples.txt", "a") as myfile:
-        count = 0
-        while count < 6:
-            user_id = 5
-            contact_id = fake.random_int(min=21, max=25)
-            contact_code = fake.random_int(min=1, max=5)
-            date = fake.date_this_year()
-            myfile.write("{}|{}|{}|{}\n".format(user_id, contact_id, contact_code, date))
-            count += 1
+
+
+def write_users(settings, first, count, parts):
+    """Write users first to first + count - 1 with their contacts, jobs and events."""
+
+    rng = random.Random(f'{settings.seed}-users-{first}')
+    fake = Faker()
+    fake.seed_instance(rng.random())
+    pools = {name: [getattr(fake, name)() for _ in range(POOL_SIZE)] for name in POOLS}
+
+    def pick(name):
+        return rng.choice(pools[name])
+
+    users = open(parts['users'], 'w')
+    contacts = open(parts['contacts'], 'w')
+    contact_events = open(parts['contact_events'], 'w')
+    jobs = open(parts['jobs'], 'w')
+    job_events = open(parts['job_events'], 'w')
+
+    for user_id in range(first, first + count):
+        fname = pick('first_name')[:25]
+        lname = pick('last_name')[:25]
+        # the user id keeps emails unique however many users there are
+        email = "{}{}@{}".format(fname.lower(), user_id, pick('free_email_domain'))[:50]
+        password = pick('password')
+        users.write("{}|{}|{}|{}\n".format(fname, lname, email, password))
+
+        # this user's contacts and jobs follow straight after the previous user's
+        first_contact = (user_id - 1) * settings.contacts_per_user + 1
+        for contact_id in range(first_contact, first_contact + settings.contacts_per_user):
+            company_id = choose_company(rng, settings.companies)
+            contacts.write("{}|{}|{}\n".format(pick('first_name')[:25], pick('last_name')[:25], company_id))
+
+            day = settings.start + timedelta(days=rng.randrange(settings.days))
+            for contact_code, event_date in history(rng, CONTACT_STEPS, settings.events_per_contact, day):
+                contact_events.write("{}|{}|{}|{}\n".format(user_id, contact_id, contact_code, event_date))
+
+        first_job = (user_id - 1) * settings.jobs_per_user + 1
+        for job_id in range(first_job, first_job + settings.jobs_per_user):
+            day = settings.start + timedelta(days=rng.randrange(settings.days))
+            events = list(history(rng, JOB_STEPS, settings.events_per_job, day))
+            active_status = events[-1][0] <= LAST_ACTIVE_JOB_CODE
+
+            title = pick('job')[:100]
+            link = pick('url')
+            company_id = choose_company(rng, settings.companies)
+            notes = pick('bs')
+            jobs.write("{}|{}|{}|{}|{}\n".format(title, link, company_id, active_status, notes))
+
+            for job_code, event_date in events:
+                job_events.write("{}|{}|{}|{}\n".format(job_id, user_id, job_code, event_date))
+
+    for myfile in (users, contacts, contact_events, jobs, job_events):
+        myfile.close()
+
+
+def write_block(task):
+    """Write one block of rows to part files and return their paths, by kind."""
+
+    settings, kind, first, count, directory = task
+
+    # one part file per kind of row this block writes
+    kinds = ['companies'] if kind == 'companies' else ['users', 'contacts', 'contact_events', 'jobs', 'job_events']
+    parts = {name: os.path.join(directory, f'{name}-{first}.part') for name in kinds}
+
+    if kind == 'companies':
+        write_companies(settings, first, count, parts)
+    else:
+        write_users(settings, first, count, parts)
+
+    return parts
+
+
+def blocks(total):
+    """Yield (first, count) for BLOCK_SIZE blocks covering ids 1 to total."""
+
+    for first in range(1, total + 1, BLOCK_SIZE):
+        yield first, min(BLOCK_SIZE, total - first + 1)
+
+
+def generate(settings):
+    """Write every file seed.py loads to settings.output.
+
+    Returns the number of rows written to each file."""
+
+    os.makedirs(settings.output, exist_ok=True)
+    directory = tempfile.mkdtemp(dir=settings.output)
+
+    tasks = ([(settings, 'companies', first, count, directory) for first, count in blocks(settings.companies)] +
+             [(settings, 'users', first, count, directory) for first, count in blocks(settings.users)])
+
+    outputs = {name: open(os.path.join(settings.output, filename), 'w') for name, filename in FILES.items()}
+    rows = dict.fromkeys(FILES, 0)
+
+    try:
+        with Pool(settings.workers) as pool:
+            # imap hands blocks back in order, so files come out the same for any number of workers
+            for parts in pool.imap(write_block, tasks):
+                for name, path in parts.items():
+                    with open(path) as part:
+                        for line in part:
+                            outputs[name].write(line)
+                            rows[name] += 1
+                    os.remove(path)
+    finally:
+        for output in outputs.values():
+            output.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return rows
+
+
+if __name__ == "__main__":
+    settings = parse_args()
+
+    start = time.perf_counter()
+    rows = generate(settings)
+    seconds = time.perf_counter() - start
+
+    for name, count in rows.items():
+        print(f"{FILES[name]}: {count} rows")
+    print(f"{sum(rows.values())} rows in {seconds:.2f}s ({sum(rows.values()) / seconds:.0f} rows/s)")
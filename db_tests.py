@@ -1,10 +1,1693 @@
 """Tests for the jobs database with real and sample data"""
 
-from model import JobCode, JobEvent, Job, ToDo, ToDoCode, db
+import io
+import json
+import os
+import re
+import pytest
+import tempfile
+import tracemalloc
+from itertools import count
+from sqlalchemy import desc, event
+from model import (User, Company, Contact, ContactCode, ContactEvent, JobCode, JobEvent,
+                   JobStatus, Job, PooledSQLAlchemy, Salary, ToDo, ToDoCode, company_key, connect_to_db, db,
+                   engine_options)
+from server import app
+from cache import CompanyCache
+from fragments import FragmentCache
+from codes import LAST_ACTIVE_JOB_CODE, CodeRegistry, code_registry
+from importer import import_jobs, iter_json, read_rows
+from pages import contacts_page
+from status import current_job_statuses, record_job_status, rebuild_job_statuses
+from upgrade import assign_company_owners, fill_job_statuses, merge_duplicate_companies
+from salaries import (SalaryService, TitleMatcher, parse_percent, parse_salary, salary_analytics,
+                      salary_service)
+from data.faker import FILES, generate, parse_args
+from bench import find_regressions
+from instrument import RequestStats, SQLBudgetError, instrument_sql, sql_budget
+from metrics import Counter, Gauge, Histogram, Registry
+from profiler import Sampler, profile_token, sampler
+from versions import bump_reference_version
+from memtrace import instrument_memory, logger as memtrace_logger, rank_routes, read_log
+from flask import Flask
 from datetime import datetime
 from datetime import timedelta
 
 
+# test setup and helpers
+def setup_module():
+    """Connect to the test database and create fresh tables before the tests run."""
+
+    connect_to_db(app, 'postgresql:///testjobs')
+    db.drop_all()
+    db.create_all()
+
+    # every event needs a code to point at
+    db.session.add(ToDoCode(todo_code=1, description='Apply to job', sugg_due_date=2))
+    db.session.add(ToDoCode(todo_code=2, description='Follow up on job application', sugg_due_date=30))
+    # job and contact codes point at todo codes, with no relationship to order the inserts
+    db.session.flush()
+    db.session.add(JobCode(job_code=1, description='Interested', todo_code=1))
+    db.session.add(JobCode(job_code=2, description='Applied', todo_code=2))
+    db.session.add(JobCode(job_code=7, description='Declined offer', todo_code=1))
+    # codes may start no todo at all
+    db.session.add(JobCode(job_code=8, description='No job offer', todo_code=None))
+    db.session.add(ContactCode(contact_code=1, description='Met at networking event', todo_code=2))
+    db.session.add(ContactCode(contact_code=2, description='Sent a thank you note', todo_code=None))
+    db.session.commit()
+
+
+def teardown_module():
+    """Drop the test tables once the tests are done."""
+
+    db.session.close()
+    db.drop_all()
+
+
+def capture_queries(func):
+    """Call func and return the (statement, parameters) pairs it sent to the database."""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    return statements
+
+
+def count_queries(func):
+    """Call func and return how many SQL statements it sent to the database."""
+
+    return len(capture_queries(func))
+
+
+def count_commits(func):
+    """Call func and return how many transactions it committed."""
+
+    commits = []
+
+    def commit(conn):
+        commits.append(conn)
+
+    event.listen(db.engine, 'commit', commit)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'commit', commit)
+
+    return len(commits)
+
+
+user_numbers = count()
+
+
+def example_user(num_jobs, num_contacts=2):
+    """Create a user tracking num_jobs jobs and num_contacts contacts, each at its own company."""
+
+    user = User(fname='Test', lname='User', email=f'test{next(user_numbers)}@example.com', password='test')
+    db.session.add(user)
+    db.session.commit()
+
+    today = datetime.now()
+    for i in range(num_jobs):
+        company = Company(name=f'Job Company {i}', owner_user_id=user.user_id)
+        job = Job(title='Software Engineer', companies=company, active_status=True)
+        job_event = JobEvent(users=user, jobs=job, job_code=1, date_created=today)
+        db.session.add(job_event)
+        record_job_status(job_event)
+
+    for i in range(num_contacts):
+        company = Company(name=f'Contact Company {i}', owner_user_id=user.user_id)
+        contact = Contact(fname='Contact', lname=str(i), companies=company)
+        db.session.add(ContactEvent(users=user, contacts=contact, contact_code=1, date_created=today))
+
+    db.session.commit()
+
+    return user
+
+
+# ids for bulk example data start well clear of the table sequences
+FIRST_EXAMPLE_ID = 1000000
+
+# tables that grow with users and must never be read with a sequential scan
+LARGE_TABLES = ['companies', 'contacts', 'contact_events', 'jobs', 'job_events',
+                'job_statuses', 'todos']
+
+
+def load_example_data(num_users=500, jobs_per_user=20, contacts_per_user=10):
+    """Bulk insert a realistic amount of data for many users and return the first user's id.
+
+    Every job and contact sits at its own company and has two events, each with
+    a todo. Rows are generated inside the database so large loads stay fast."""
+
+    # the data only needs loading once per test run
+    if User.query.get(FIRST_EXAMPLE_ID):
+        return FIRST_EXAMPLE_ID
+
+    params = {'first': FIRST_EXAMPLE_ID, 'users': num_users, 'jobs': jobs_per_user,
+              'per_user': jobs_per_user + contacts_per_user}
+
+    # n numbers each user's jobs and contacts in turn, e numbers the two events
+    statements = [
+        """INSERT INTO users (user_id, fname, lname, email, password)
+           SELECT :first + u, 'Load', u, 'load' || u || '@example.com', 'load'
+           FROM generate_series(0, :users - 1) u""",
+        """INSERT INTO companies (company_id, owner_user_id, name)
+           SELECT :first + n, :first + n / :per_user, 'Company ' || n
+           FROM generate_series(0, :users * :per_user - 1) n""",
+        """INSERT INTO jobs (job_id, title, company_id, active_status)
+           SELECT :first + n, 'Software Engineer', :first + n, n % 2 = 0
+           FROM generate_series(0, :users * :per_user - 1) n WHERE n % :per_user < :jobs""",
+        """INSERT INTO contacts (contact_id, fname, lname, company_id)
+           SELECT :first + n, 'Contact', n, :first + n
+           FROM generate_series(0, :users * :per_user - 1) n WHERE n % :per_user >= :jobs""",
+        """INSERT INTO job_events (job_event_id, user_id, job_id, job_code, date_created)
+           SELECT :first + 2 * n + e, :first + n / :per_user, :first + n, e + 1, now() - (30 - e) * interval '1 day'
+           FROM generate_series(0, :users * :per_user - 1) n, generate_series(0, 1) e
+           WHERE n % :per_user < :jobs""",
+        """INSERT INTO contact_events (contact_event_id, user_id, contact_id, contact_code, date_created)
+           SELECT :first + 2 * n + e, :first + n / :per_user, :first + n, 1, now() - (30 - e) * interval '1 day'
+           FROM generate_series(0, :users * :per_user - 1) n, generate_series(0, 1) e
+           WHERE n % :per_user >= :jobs""",
+        """INSERT INTO todos (todo_id, job_event_id, contact_event_id, todo_code, date_created, date_due, active_status)
+           SELECT :first + 2 * n + e,
+                  CASE WHEN n % :per_user < :jobs THEN :first + 2 * n + e END,
+                  CASE WHEN n % :per_user >= :jobs THEN :first + 2 * n + e END,
+                  1, now(), now(), e = 1
+           FROM generate_series(0, :users * :per_user - 1) n, generate_series(0, 1) e""",
+        """INSERT INTO job_statuses (user_id, job_id, job_code, job_event_id, todo_id, last_activity)
+           SELECT :first + n / :per_user, :first + n, 2, :first + 2 * n + 1, :first + 2 * n + 1, now() - interval '29 days'
+           FROM generate_series(0, :users * :per_user - 1) n WHERE n % :per_user < :jobs""",
+    ]
+    for statement in statements:
+        db.session.execute(statement, params)
+    db.session.commit()
+
+    # give the planner real statistics to work with
+    db.session.execute('ANALYZE')
+
+    return FIRST_EXAMPLE_ID
+
+
+def plan_nodes(plan):
+    """Yield every node of an EXPLAIN (FORMAT JSON) plan tree."""
+
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def full_table_scans(statements):
+    """EXPLAIN each statement and return the scans that read a whole large table.
+
+    Sequential scans are switched off for the planner, so it only falls back to
+    one when no index can serve the query. An index scan that doesn't constrain
+    the index's leading column walks the whole index, so it counts too."""
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('SET LOCAL enable_seqscan = off')
+
+    # table and leading column of every index
+    cursor.execute("""SELECT c.relname, t.relname, a.attname
+                      FROM pg_index i
+                      JOIN pg_class c ON c.oid = i.indexrelid
+                      JOIN pg_class t ON t.oid = i.indrelid
+                      JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]""")
+    indexes = {index: (table, column) for index, table, column in cursor.fetchall()}
+
+    scans = []
+    for statement, parameters in statements:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        plan = cursor.fetchone()[0][0]['Plan']
+        for node in plan_nodes(plan):
+            if node['Node Type'] == 'Seq Scan':
+                table = node['Relation Name']
+            elif 'Index Name' in node:
+                table, column = indexes[node['Index Name']]
+                if re.search(rf'\b{column}\b', node.get('Index Cond', '')):
+                    continue
+            else:
+                continue
+            if table in LARGE_TABLES:
+                scans.append((node['Node Type'], table, statement))
+
+    return scans
+
+
+# test user companies
+def test_user_companies_query_count():
+    """User.companies sends one statement no matter how many jobs a user has."""
+
+    small_user = example_user(num_jobs=2)
+    large_user = example_user(num_jobs=60)
+
+    # load the user rows first so only the companies lookup is counted
+    assert small_user.user_id and large_user.user_id
+
+    assert count_queries(lambda: small_user.companies) == 1
+    assert count_queries(lambda: large_user.companies) == 1
+
+
+def test_user_companies_from_jobs_and_contacts():
+    """User.companies finds companies through both job and contact events."""
+
+    user = example_user(num_jobs=3, num_contacts=4)
+    names = set(company.name for company in user.companies)
+
+    assert len(names) == 7
+    assert 'Job Company 2' in names
+    assert 'Contact Company 3' in names
+
+
+# test company dropdown cache
+def test_company_cache_hits_and_invalidation():
+    """The dropdown cache only queries on a miss and reloads after invalidation."""
+
+    user = example_user(num_jobs=3, num_contacts=0)
+    user_id = user.user_id
+    cache = CompanyCache(maxsize=2)
+
+    assert count_queries(lambda: cache.get(user_id)) == 1
+    assert count_queries(lambda: cache.get(user_id)) == 0
+    assert [company.name for company in cache.get(user_id)] == ['Job Company 0', 'Job Company 1', 'Job Company 2']
+
+    cache.invalidate(user_id)
+    assert count_queries(lambda: cache.get(user_id)) == 1
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+
+
+def test_company_cache_evicts_least_recently_used():
+    """A full dropdown cache drops the user looked up longest ago."""
+
+    cache = CompanyCache(maxsize=2)
+    cache.get(1)
+    cache.get(2)
+    cache.get(1)
+    cache.get(3)
+
+    assert count_queries(lambda: cache.get(1)) == 0
+    assert count_queries(lambda: cache.get(2)) == 1
+
+
+def test_company_cache_reloads_companies_from_another_data_version():
+    """A write handled by another process changes the user's version, so this process reloads."""
+
+    user = example_user(num_jobs=1, num_contacts=0)
+    user_id = user.user_id
+    cache = CompanyCache()
+
+    assert count_queries(lambda: cache.get(user_id, 1)) == 1
+    assert count_queries(lambda: cache.get(user_id, 1)) == 0
+    assert count_queries(lambda: cache.get(user_id, 2)) == 1
+
+
+# test template fragment cache
+def test_fragment_cache_keeps_under_entry_and_byte_limits():
+    """A full fragment cache drops the least recently used fragment, and never keeps one bigger than itself."""
+
+    renders = []
+
+    def render(html):
+        return lambda: renders.append(html) or html
+
+    cache = FragmentCache(max_entries=2, max_bytes=100)
+    cache.get_or_render('a', render('aaaa'))
+    cache.get_or_render('b', render('bbbb'))
+    cache.get_or_render('a', render('aaaa'))
+    cache.get_or_render('c', render('cccc'))
+    assert renders == ['aaaa', 'bbbb', 'cccc']
+    assert cache.get_or_render('b', render('bbbb')) == 'bbbb'
+    assert renders[-1] == 'bbbb'
+
+    cache = FragmentCache(max_entries=10, max_bytes=10)
+    for key in 'abc':
+        cache.get_or_render(key, render(key * 4))
+    assert (cache.stats()['size'], cache.stats()['bytes']) == (2, 8)
+    cache.get_or_render('big', render('x' * 20))
+    cache.get_or_render('big', render('x' * 20))
+    assert renders[-2:] == ['x' * 20, 'x' * 20]
+    assert cache.stats()['size'] == 2
+
+    # every hit saves the time its fragment took to render
+    cache = FragmentCache()
+    cache.get_or_render('a', render('aaaa'))
+    cache.get_or_render('a', render('aaaa'))
+    assert cache.stats()['saved_seconds'] == cache.stats()['render_seconds'] > 0
+
+
+def test_company_menus_are_cached_until_the_users_data_changes():
+    """Both company menus render once per data version, and a new company shows up right away."""
+
+    user = example_user(num_jobs=2, num_contacts=0)
+    user_id = user.user_id
+    code_registry.reload()
+    salary_service.load()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    fragment_cache = app.jinja_env.fragment_cache
+    fragment_cache.clear()
+    hits, misses = fragment_cache.stats()['hits'], fragment_cache.stats()['misses']
+
+    page = client.get('/dashboard/jobs').data.decode()
+    assert page.count('>Job Company 1</option>') == 2
+    assert (fragment_cache.stats()['hits'] - hits, fragment_cache.stats()['misses'] - misses) == (1, 1)
+
+    assert client.get('/dashboard/contacts').data.decode().count('>Job Company 1</option>') == 2
+    assert (fragment_cache.stats()['hits'] - hits, fragment_cache.stats()['misses'] - misses) == (3, 1)
+
+    client.post('/dashboard/jobs/add', data=job_form(company_name='Fragment Labs'))
+    page = client.get('/dashboard/jobs').data.decode()
+    assert page.count('>Fragment Labs</option>') == 2
+    assert fragment_cache.stats()['misses'] - misses == 2
+
+
+# test serving settings
+def test_engine_options_size_the_pool_and_time_out_statements():
+    """Pool settings given to connect_to_db reach the engine, and each connection gets the statement timeout."""
+
+    pooled_app = Flask(__name__)
+    pooled_db = PooledSQLAlchemy()
+    pooled_app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///testjobs'
+    pooled_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    pooled_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        pool_size=3, max_overflow=1, pool_recycle=600, pool_pre_ping=True, statement_timeout=1500)
+    pooled_db.init_app(pooled_app)
+
+    with pooled_app.app_context():
+        engine = pooled_db.engine
+        assert (engine.pool.size(), engine.pool._max_overflow, engine.pool._recycle) == (3, 1, 600)
+        assert engine.pool._pre_ping
+        assert engine.execute('SHOW statement_timeout').scalar() == '1500ms'
+        engine.dispose()
+
+
+def test_forked_process_opens_its_own_connections():
+    """A process forked while its parent has pooled connections connects again, leaving the parent's alone."""
+
+    parent_backend = db.session.execute('SELECT pg_backend_pid()').scalar()
+    db.session.commit()
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(write, str(db.session.execute('SELECT pg_backend_pid()').scalar()).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write)
+    child_backend = os.read(read, 20).decode()
+    os.close(read)
+    os.waitpid(pid, 0)
+
+    assert child_backend and int(child_backend) != parent_backend
+    assert db.session.execute('SELECT pg_backend_pid()').scalar() == parent_backend
+    db.session.commit()
+
+
+# test current job status
+def test_current_job_statuses_latest_event():
+    """Each job shows only its latest event and that event's active todo."""
+
+    user = example_user(num_jobs=2, num_contacts=0)
+    job = user.job_events[0].jobs
+
+    # move the first job on to applied, with a new todo
+    applied = JobEvent(users=user, jobs=job, job_code=2, date_created=datetime.now() + timedelta(days=1))
+    todo = ToDo(job_events=applied, todo_code=1, date_created=datetime.now(),
+                date_due=datetime.now(), active_status=True)
+    db.session.add(todo)
+    record_job_status(applied, todo)
+    db.session.commit()
+
+    rows = current_job_statuses(user.user_id)
+
+    assert len(rows) == 2
+    assert rows[0].JobEvent.job_event_id == applied.job_event_id
+    assert rows[0].ToDo.todo_id == todo.todo_id
+    assert rows[1].ToDo is None
+    assert current_job_statuses(user.user_id, active_status=False) == []
+
+
+def test_current_job_statuses_query_count():
+    """The job dashboards cost one statement no matter how many jobs a user has."""
+
+    user = example_user(num_jobs=40, num_contacts=0)
+    user_id = user.user_id
+
+    codes = code_registry.get_data()
+
+    def render_rows():
+        for status, todo, company in current_job_statuses(user_id):
+            status.jobs.title, codes.job_codes[status.job_code], company.name
+
+    assert count_queries(render_rows) == 1
+
+
+def test_rebuild_job_statuses_matches_recorded():
+    """Replaying job events rebuilds the same status rows the handlers record."""
+
+    example_user(num_jobs=5, num_contacts=0)
+
+    def status_rows():
+        return sorted((row.user_id, row.job_id, row.job_event_id, row.todo_id)
+                      for row in JobStatus.query.all())
+
+    recorded = status_rows()
+    rebuild_job_statuses()
+    db.session.expire_all()
+
+    assert status_rows() == recorded
+
+
+def test_upgrade_fills_an_empty_job_statuses_table():
+    """Upgrading a database from before job_statuses fills it, so no job drops off the dashboards."""
+
+    example_user(num_jobs=3, num_contacts=0)
+
+    def status_rows():
+        return sorted((row.user_id, row.job_id, row.job_event_id, row.todo_id)
+                      for row in JobStatus.query.all())
+
+    recorded = status_rows()
+    JobStatus.query.delete()
+    db.session.commit()
+
+    fill_job_statuses()
+    db.session.expire_all()
+    assert status_rows() == recorded
+
+    # a table that already has rows is left alone
+    assert count_queries(fill_job_statuses) == 1
+
+
+# test dashboard query plans
+def dashboard_paths():
+    """The dashboard pages for the first example user, with ids from their own data."""
+
+    job_id = company_id = FIRST_EXAMPLE_ID
+
+    # the first user's contacts come after their jobs
+    contact_id = FIRST_EXAMPLE_ID + 20
+
+    return ['/dashboard/jobs',
+            '/dashboard/jobs/archived',
+            f'/dashboard/jobs/{job_id}',
+            '/dashboard/companies',
+            f'/dashboard/companies/{company_id}',
+            '/dashboard/contacts',
+            f'/dashboard/contacts/{contact_id}',
+            '/dashboard/profile',
+            '/dashboard/jobs/archived/page',
+            f'/dashboard/jobs/{job_id}/events',
+            '/dashboard/contacts/page',
+            f'/dashboard/contacts/{contact_id}/events']
+
+
+def test_dashboard_queries_use_indexes():
+    """No dashboard query falls back to a sequential scan on a large table."""
+
+    user_id = load_example_data(jobs_per_user=20)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    for path in dashboard_paths():
+        responses = []
+        statements = capture_queries(lambda: responses.append(client.get(path)))
+        assert responses[0].status_code == 200, path
+        assert full_table_scans(statements) == [], path
+
+
+# test write transactions
+def job_form(**fields):
+    """The add job form, with a new company unless fields say otherwise."""
+
+    form = {'job_title': 'Data Engineer', 'job_status': '2', 'job_link': '', 'job_notes': '',
+            'company_id': '', 'company_name': 'Unit Of Work Inc'}
+    form.update(fields)
+
+    return form
+
+
+def test_adding_a_job_is_one_transaction():
+    """A new job, its company, event, todo and status are written by one commit."""
+
+    user = example_user(num_jobs=0, num_contacts=0)
+    user_id = user.user_id
+    code_registry.reload()
+    salary_service.load()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    statements = []
+    commits = count_commits(lambda: statements.extend(
+        capture_queries(lambda: client.post('/dashboard/jobs/add', data=job_form()))))
+
+    # find the company, then insert it, the job, its event, its todo and the status row,
+    # and bump the user's data version
+    assert commits == 1
+    assert len(statements) <= 7
+
+    job_event = JobEvent.query.filter(JobEvent.user_id == user_id).one()
+    todo = ToDo.query.filter(ToDo.job_event_id == job_event.job_event_id).one()
+    status = JobStatus.query.filter(JobStatus.user_id == user_id).one()
+
+    assert job_event.jobs.companies.name == 'Unit Of Work Inc'
+    assert (todo.todo_code, todo.active_status) == (2, True)
+    assert (status.job_event_id, status.todo_id) == (job_event.job_event_id, todo.todo_id)
+
+    # the same name finds the company instead of adding another
+    client.post('/dashboard/jobs/add', data=job_form())
+    assert Company.query.filter(Company.name == 'Unit Of Work Inc').count() == 1
+
+
+def test_failed_job_add_leaves_nothing_behind():
+    """A request that fails part way through rolls back the rows it already flushed."""
+
+    user = example_user(num_jobs=0, num_contacts=0)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.user_id
+
+    # there is no job code 99, so the request fails after the company is flushed
+    response = client.post('/dashboard/jobs/add',
+                           data=job_form(job_status='99', company_name='Half Written Inc'))
+
+    assert response.status_code == 500
+    assert Company.query.filter(Company.name == 'Half Written Inc').count() == 0
+    assert JobEvent.query.filter(JobEvent.user_id == user.user_id).count() == 0
+
+
+def test_changing_job_status_is_one_transaction():
+    """A status change closes the last todo and records the new event and todo in one commit."""
+
+    user = example_user(num_jobs=0, num_contacts=0)
+    user_id = user.user_id
+    code_registry.reload()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    client.post('/dashboard/jobs/add', data=job_form(job_status='1'))
+    first_event = JobEvent.query.filter(JobEvent.user_id == user_id).one()
+    job_id = first_event.job_id
+
+    commits = count_commits(lambda: client.post('/dashboard/job-status',
+                                                data={'job_id': str(job_id), 'job_code': '2'}))
+    assert commits == 1
+
+    events = JobEvent.query.filter(JobEvent.job_id == job_id).order_by(JobEvent.job_event_id).all()
+    old_todo, new_todo = [event.todos[0] for event in events]
+
+    assert old_todo.active_status is False
+    assert (new_todo.todo_code, new_todo.active_status) == (2, True)
+    assert JobStatus.query.get((user_id, job_id)).todo_id == new_todo.todo_id
+
+
+def test_changing_many_job_statuses_at_once():
+    """A batch of transitions is applied with the same statements however many jobs it moves."""
+
+    user = example_user(num_jobs=0, num_contacts=0)
+    user_id = user.user_id
+    other_user_id = example_user(num_jobs=0, num_contacts=0).user_id
+    code_registry.reload()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = other_user_id
+    client.post('/dashboard/jobs/add', data=job_form(job_title='Not Yours'))
+    other_job_id = JobStatus.query.filter(JobStatus.user_id == other_user_id).one().job_id
+
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    for i in range(22):
+        client.post('/dashboard/jobs/add', data=job_form(job_title=f'Engineer {i}', job_status='1'))
+    job_ids = sorted(job_id for job_id, in db.session.query(JobStatus.job_id)
+                     .filter(JobStatus.user_id == user_id))
+
+    def change(transitions):
+        return client.post('/dashboard/jobs/status', json={'transitions': transitions})
+
+    # job code 7 ends the search, so the job is archived
+    transitions = [{'job_id': job_ids[0], 'job_code': 2},
+                   {'job_id': job_ids[1], 'job_code': 7},
+                   {'job_id': other_job_id, 'job_code': 2},
+                   {'job_id': job_ids[0], 'job_code': 99}]
+    statements = capture_queries(lambda: change(transitions))
+    summary = change(transitions).get_json()
+
+    assert summary == {'updated': 2, 'archived': 1,
+                       'errors': [{'index': 2, 'error': 'job_id is not one of your jobs.'},
+                                  {'index': 3, 'error': 'job_code 99 is not a job code.'}]}
+
+    statuses = {status.job_id: (status.job_code, todo.todo_code)
+                for status, todo, company in current_job_statuses(user_id)}
+    assert statuses[job_ids[0]] == (2, 2)
+    assert job_ids[1] not in statuses
+    assert Job.query.get(job_ids[1]).active_status is False
+
+    # the other user's job and the earlier todos were left alone
+    assert JobEvent.query.filter(JobEvent.job_id == other_job_id).count() == 1
+    assert ToDo.query.join(JobEvent).filter(JobEvent.job_id == job_ids[0],
+                                            ToDo.active_status == True).count() == 1
+
+    many = [{'job_id': job_id, 'job_code': 2 if job_id % 2 else 7} for job_id in job_ids[2:]]
+    assert count_queries(lambda: change(many)) == len(statements)
+
+    assert change([]).get_json() == {'updated': 0, 'archived': 0, 'errors': []}
+    assert client.post('/dashboard/jobs/status', data='not json').status_code == 400
+
+
+def test_adding_a_contact_is_one_transaction():
+    """A new contact, its event and its todo are written by one commit."""
+
+    user = example_user(num_jobs=1, num_contacts=0)
+    user_id = user.user_id
+    company_id = Company.query.filter(Company.owner_user_id == user_id).one().company_id
+    code_registry.reload()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    form = {'fname': 'Ada', 'lname': 'Lovelace', 'email': '', 'phone': '', 'notes': '',
+            'company_id': str(company_id), 'company_name': '', 'contact_event': '1'}
+    commits = count_commits(lambda: client.post('/dashboard/contacts/add', data=form))
+    assert commits == 1
+
+    contact_event = ContactEvent.query.filter(ContactEvent.user_id == user_id).one()
+    assert contact_event.contacts.fname == 'Ada'
+    assert contact_event.todos[0].todo_code == 2
+
+
+# test job import
+def test_import_jobs_reports_every_row():
+    """Good rows become jobs with their events, todos and statuses; bad rows are reported."""
+
+    user = example_user(num_jobs=1, num_contacts=0)
+    user_id = user.user_id
+    company_id = Company.query.filter(Company.owner_user_id == user_id).one().company_id
+    code_registry.reload()
+
+    csv_file = io.BytesIO((
+        "job_title,job_status,job_link,job_notes,company_id,company_name\n"
+        "Data Engineer,1,example.com/1,,,Imported Inc\n"
+        "Data Analyst,2,,,,Imported Inc\n"
+        f"Software Engineer,2,,Notes,{company_id},\n"
+        "Designer,99,,,,Imported Inc\n"
+        "Recruiter,1,,,,\n"
+        "Manager,1,,,123456789,\n").encode())
+
+    # batches of two, so companies are resolved across batches
+    report = import_jobs(user_id, read_rows(csv_file, 'jobs.csv'), batch_size=2)
+    db.session.commit()
+
+    assert (report['imported'], report['skipped']) == (3, 3)
+    assert [line['row'] for line in report['rows']] == [1, 2, 3, 4, 5, 6]
+    assert report['rows'][3]['error'] == 'job_status 99 is not a job code.'
+    assert report['rows'][4]['error'] == 'company_id or company_name is required.'
+    assert report['rows'][5]['error'] == 'company_id is not one of your companies.'
+
+    # both rows naming the new company share one
+    assert Company.query.filter(Company.name == 'Imported Inc').count() == 1
+
+    job = Job.query.get(report['rows'][0]['job_id'])
+    assert (job.title, job.link, job.companies.name) == ('Data Engineer', 'http://example.com/1', 'Imported Inc')
+    assert Job.query.get(report['rows'][2]['job_id']).company_id == company_id
+
+    # every imported job shows up on the dashboard with the todo its status starts
+    statuses = current_job_statuses(user_id)
+    assert len(statuses) == 4
+    todo_codes = sorted(todo.todo_code for status, todo, company in statuses if todo)
+    assert todo_codes == [1, 2, 2]
+
+
+def test_import_rejects_unreadable_files():
+    """A file that breaks part way through is a 400 and adds nothing."""
+
+    user = example_user(num_jobs=0, num_contacts=0)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.user_id
+
+    broken = b'[{"job_title": "Engineer", "job_status": 1, "company_name": "Broken Inc"}, {"job_title": '
+    response = client.post('/dashboard/jobs/import', data={'file': (io.BytesIO(broken), 'jobs.json')},
+                           content_type='multipart/form-data')
+
+    assert response.status_code == 400
+    assert Company.query.filter(Company.name == 'Broken Inc').count() == 0
+
+    response = client.post('/dashboard/jobs/import', data={'file': (io.BytesIO(b'jobs'), 'jobs.xlsx')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+
+
+def test_iter_json_reads_arrays_and_lines_in_pieces():
+    """Rows split across reads are put back together, for an array or one row per line."""
+
+    rows = [{'job_title': f'Engineer {i}', 'job_notes': 'a, [bracketed] note'} for i in range(20)]
+
+    array = io.StringIO(json.dumps(rows))
+    lines = io.StringIO('\n'.join(json.dumps(row) for row in rows))
+
+    assert list(iter_json(array, read_size=7)) == rows
+    assert list(iter_json(lines, read_size=7)) == rows
+
+
+# test company keys and owners
+def test_company_key_ignores_case_punctuation_and_suffixes():
+    """Spellings of one company share a key; different companies don't."""
+
+    assert company_key('Google') == company_key(' google ') == company_key('Google, Inc.') == 'google'
+    assert company_key('Acme  Widget Co.') == company_key('ACME WIDGET CORPORATION') == 'acme widget'
+    assert company_key('AT&T') == company_key('AT & T')
+    # a name that is all suffix keeps it
+    assert company_key('Inc.') == 'inc'
+    assert company_key('Google') != company_key('Googles')
+
+
+def test_every_write_path_finds_companies_by_key():
+    """Adding a job or contact, editing a contact and importing all reuse one company per key."""
+
+    user = example_user(num_jobs=0, num_contacts=0)
+    user_id = user.user_id
+    code_registry.reload()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    client.post('/dashboard/jobs/add', data=job_form(company_name='Keyed Widgets'))
+    client.post('/dashboard/contacts/add', data={
+        'fname': 'Grace', 'lname': 'Hopper', 'email': '', 'phone': '', 'notes': '',
+        'company_id': '', 'company_name': ' keyed widgets, inc. ', 'contact_event': '1'})
+    contact = Contact.query.filter(Contact.fname == 'Grace', Contact.lname == 'Hopper').one()
+    client.post('/dashboard/contacts/edit', data={
+        'contact_id': str(contact.contact_id), 'notes': '', 'email': '', 'phone': '',
+        'company_id': '', 'company_name': 'KEYED WIDGETS LLC'})
+    report = import_jobs(user_id, [{'job_title': 'Analyst', 'job_status': '1',
+                                    'company_name': 'Keyed Widgets Ltd'}])
+    db.session.commit()
+
+    company = Company.query.filter(Company.owner_user_id == user_id, Company.name_key == 'keyed widgets').one()
+    assert company.name == 'Keyed Widgets'
+    assert Contact.query.get(contact.contact_id).company_id == company.company_id
+    assert Job.query.get(report['rows'][0]['job_id']).company_id == company.company_id
+    assert Job.query.filter(Job.company_id == company.company_id).count() == 2
+
+
+def test_merging_duplicate_companies_repoints_jobs_and_contacts():
+    """A user's duplicates fold into their oldest company, which keeps their jobs, contacts and details."""
+
+    user_id = example_user(num_jobs=0, num_contacts=0).user_id
+    other_user_id = example_user(num_jobs=0, num_contacts=0).user_id
+
+    # added without keys, as they were before companies had them
+    oldest = Company(name='Merge Me Inc', city='Boston', owner_user_id=user_id)
+    duplicate = Company(name='merge me', city='New York', website='mergeme.example.com', owner_user_id=user_id)
+    other = Company(name='MERGE ME, LLC', owner_user_id=user_id)
+    # another user's company of the same name, and their notes, are left alone
+    not_mine = Company(name='Merge Me', notes='Private', owner_user_id=other_user_id)
+    job = Job(title='Software Engineer', companies=duplicate, active_status=True)
+    contact = Contact(fname='Merged', lname='Contact', companies=other)
+    db.session.add_all([oldest, not_mine, job, contact])
+    db.session.commit()
+    oldest_id, not_mine_id, job_id, contact_id = oldest.company_id, not_mine.company_id, job.job_id, contact.contact_id
+    duplicate_ids = [duplicate.company_id, other.company_id]
+
+    merge_duplicate_companies()
+    db.session.expire_all()
+
+    company = Company.query.filter(Company.owner_user_id == user_id, Company.name_key == 'merge me').one()
+    assert company.company_id == oldest_id
+    assert (company.name, company.city, company.website, company.notes) == (
+        'Merge Me Inc', 'Boston', 'mergeme.example.com', None)
+    assert Job.query.get(job_id).company_id == oldest_id
+    assert Contact.query.get(contact_id).company_id == oldest_id
+    assert Company.query.filter(Company.company_id.in_(duplicate_ids)).count() == 0
+    assert Company.query.filter(Company.name_key == None).count() == 0
+    assert Company.query.get(not_mine_id).name_key == 'merge me'
+
+    # adding the name again finds the merged company, and only for its owner
+    assert Company.get_or_create_id(user_id, 'merge me inc.') == oldest_id
+    assert Company.get_or_create_id(other_user_id, 'merge me inc.') == not_mine_id
+
+
+def test_companies_are_private_to_the_user_who_added_them():
+    """Two users naming the same company each get their own, and can't see or change the other's."""
+
+    user_id = example_user(num_jobs=0, num_contacts=0).user_id
+    other_user_id = example_user(num_jobs=0, num_contacts=0).user_id
+    code_registry.reload()
+
+    client = app.test_client()
+    company_ids = []
+    for owner_id in (user_id, other_user_id):
+        with client.session_transaction() as sess:
+            sess['user_id'] = owner_id
+        client.post('/dashboard/jobs/add', data=job_form(company_name='Private Widgets'))
+        company_ids.append(Company.query.filter(Company.owner_user_id == owner_id,
+                                                Company.name_key == 'private widgets').one().company_id)
+    mine, theirs = company_ids
+    assert mine != theirs
+
+    # the other user is still logged in
+    edit = {'company_id': str(mine), 'street': '', 'city': '', 'state': '', 'zipcode': '',
+            'website': '', 'notes': 'Not theirs to write'}
+    assert client.post('/dashboard/companies/edit', data=edit).status_code == 404
+    assert client.get(f'/dashboard/companies/{mine}').status_code == 404
+    assert client.post('/dashboard/jobs/add', data=job_form(company_id=str(mine), company_name='')).status_code == 404
+    report = import_jobs(other_user_id, [{'job_title': 'Analyst', 'job_status': '1', 'company_id': str(mine)}])
+    db.session.rollback()
+    assert report['rows'][0]['error'] == 'company_id is not one of your companies.'
+
+    assert client.post('/dashboard/companies/edit', data=dict(edit, company_id=str(theirs))).status_code == 200
+    assert client.get(f'/dashboard/companies/{theirs}').status_code == 200
+    assert Company.query.get(mine).notes is None
+    assert Company.query.get(theirs).notes == 'Not theirs to write'
+
+
+def test_assigning_company_owners_copies_shared_companies():
+    """A company without an owner goes to its earliest user; every other user gets a copy without its notes."""
+
+    user = example_user(num_jobs=0, num_contacts=0)
+    other_user = example_user(num_jobs=0, num_contacts=0)
+    user_id, other_user_id = user.user_id, other_user.user_id
+
+    shared = Company(name='Shared Widgets', city='Denver', notes='First user only')
+    job = Job(title='Software Engineer', companies=shared, active_status=True)
+    contact = Contact(fname='Shared', lname='Contact', companies=shared)
+    earlier = datetime.now() - timedelta(days=2)
+    db.session.add_all([JobEvent(users=user, jobs=job, job_code=1, date_created=earlier),
+                        ContactEvent(users=other_user, contacts=contact, contact_code=1, date_created=datetime.now())])
+    db.session.commit()
+    shared_id, job_id, contact_id = shared.company_id, job.job_id, contact.contact_id
+
+    assign_company_owners()
+    db.session.expire_all()
+
+    assert Company.query.get(shared_id).owner_user_id == user_id
+    assert Job.query.get(job_id).company_id == shared_id
+
+    copy = Contact.query.get(contact_id).companies
+    assert copy.company_id != shared_id
+    assert (copy.owner_user_id, copy.name, copy.city, copy.notes) == (other_user_id, 'Shared Widgets', 'Denver', None)
+
+
+# test SQL instrumentation
+def test_dashboards_have_no_n_plus_one_queries():
+    """Every dashboard page stays within its SQL budget in test mode."""
+
+    user_id = load_example_data(jobs_per_user=20)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    app.testing = True
+    try:
+        for path in dashboard_paths():
+            response = client.get(path)
+            assert response.status_code == 200, path
+            assert response.headers['X-SQL-N-Plus-One'] == '0', path
+            assert int(response.headers['X-SQL-Statements']) <= 5, path
+    finally:
+        app.testing = False
+
+
+def test_sql_budget_fails_requests_in_test_mode():
+    """A request over its statement budget raises in test mode and only reports otherwise."""
+
+    user = example_user(num_jobs=2)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.user_id
+
+    app.config['SQL_STATEMENT_BUDGET'] = 0
+    try:
+        assert client.get('/dashboard/jobs').status_code == 200
+
+        app.testing = True
+        with pytest.raises(SQLBudgetError):
+            client.get('/dashboard/jobs')
+    finally:
+        app.testing = False
+        app.config['SQL_STATEMENT_BUDGET'] = 20
+
+
+def test_sql_budget_reads_the_n_plus_one_threshold_per_request():
+    """A budgeted route without its own repeats limit uses the app's threshold as it is when the request runs."""
+
+    budgeted_app = Flask(__name__)
+    budgeted_app.testing = True
+    instrument_sql(budgeted_app)
+
+    @budgeted_app.route('/repeats')
+    @sql_budget(10)
+    def repeats():
+        with db.get_engine(app).connect() as connection:
+            for number in range(4):
+                connection.execute('SELECT %(number)s', {'number': number})
+        return 'ok'
+
+    client = budgeted_app.test_client()
+    with pytest.raises(SQLBudgetError):
+        client.get('/repeats')
+
+    budgeted_app.config['SQL_N_PLUS_ONE_THRESHOLD'] = 5
+    assert client.get('/repeats').status_code == 200
+
+
+def test_repeated_statements_are_n_plus_one():
+    """Statements that only differ in their parameters are grouped and counted."""
+
+    stats = RequestStats()
+    stats.record('SELECT * FROM users', 0.001, 1)
+    for i in range(4):
+        stats.record('SELECT * FROM todos WHERE todos.job_event_id = %(param_1)s', 0.001, 1)
+
+    assert stats.statements == 5
+    assert stats.rows == 5
+    [pattern] = stats.n_plus_one(threshold=3)
+    assert pattern['statement'] == 'SELECT * FROM todos WHERE todos.job_event_id = %(param_1)s'
+    assert pattern['count'] == 4
+    assert re.match(r'db_tests.py:\d+ in test_repeated_statements_are_n_plus_one$', pattern['call_site'])
+    assert stats.n_plus_one(threshold=5) == []
+
+
+# test keyset pagination
+def walk_pages(client, path, limit):
+    """Follow a JSON list's cursors to its end, returning its rows and each page's SQL."""
+
+    rows, statements, cursor = [], [], None
+    while True:
+        query = {'limit': limit, 'cursor': cursor} if cursor else {'limit': limit}
+        responses = []
+        statements.append(capture_queries(lambda: responses.append(client.get(path, query_string=query))))
+        assert responses[0].status_code == 200
+        page = responses[0].get_json()
+        rows.extend(page['rows'])
+        cursor = page['next_cursor']
+        if not cursor:
+            return rows, statements
+
+
+def test_archived_jobs_pages_return_every_job_once():
+    """Cursors walk archived jobs newest first, through ties, with the same SQL on every page."""
+
+    user = example_user(num_jobs=7, num_contacts=0)
+    user_id = user.user_id
+    code_registry.reload()
+
+    # archive every job, several at the same moment
+    statuses = JobStatus.query.filter(JobStatus.user_id == user_id).order_by(JobStatus.job_id).all()
+    moment = datetime(2018, 6, 1, 9, 30)
+    for i, status in enumerate(statuses):
+        status.last_activity = moment + timedelta(days=i // 3)
+        JobEvent.query.get(status.job_event_id).date_created = status.last_activity
+        Job.query.get(status.job_id).active_status = False
+    db.session.commit()
+    newest_first = [job_id for activity, job_event_id, job_id in sorted(
+        ((status.last_activity, status.job_event_id, status.job_id) for status in statuses), reverse=True)]
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    rows, statements = walk_pages(client, '/dashboard/jobs/archived/page', limit=3)
+
+    assert [row['job_id'] for row in rows] == newest_first
+    assert len(statements) == 3
+    assert len(set(len(page) for page in statements)) == 1
+
+    assert client.get('/dashboard/jobs/archived/page?cursor=not-a-cursor').status_code == 400
+    assert client.get('/dashboard/jobs/archived/page?limit=1000').status_code == 400
+
+
+def test_contacts_pages_list_each_contact_by_latest_event():
+    """A contact with many events is listed once, at its latest event, with that event's task."""
+
+    user = example_user(num_jobs=0, num_contacts=3)
+    user_id = user.user_id
+    events = ContactEvent.query.filter(ContactEvent.user_id == user_id).order_by(ContactEvent.contact_id).all()
+
+    # the first contact is the most recently contacted, twice over
+    later = datetime.now() + timedelta(days=1)
+    for days in (1, 2):
+        event = ContactEvent(user_id=user_id, contact_id=events[0].contact_id, contact_code=1,
+                             date_created=later + timedelta(days=days))
+        db.session.add(ToDo(contact_events=event, todo_code=1, date_created=later,
+                            date_due=later, active_status=True))
+    db.session.commit()
+
+    first_page, cursor = contacts_page(user_id, limit=2)
+    second_page, last_cursor = contacts_page(user_id, cursor, limit=2)
+
+    contact_ids = [event.contact_id for event, todo in first_page + second_page]
+    assert contact_ids[0] == events[0].contact_id
+    assert sorted(contact_ids) == sorted(event.contact_id for event in events)
+    assert last_cursor is None
+
+    latest, todo = first_page[0]
+    assert latest.date_created == later + timedelta(days=2)
+    assert todo.contact_event_id == latest.contact_event_id
+
+
+# test JSON API
+def test_api_returns_lean_rows_for_each_dashboard():
+    """Each API route answers with plain column values and code descriptions."""
+
+    user = example_user(num_jobs=2, num_contacts=1)
+    code_registry.reload()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.user_id
+
+    jobs = client.get('/api/jobs').get_json()['jobs']
+    assert [job['company_name'] for job in jobs] == ['Job Company 1', 'Job Company 0']
+    assert (jobs[0]['title'], jobs[0]['status'], jobs[0]['todo']) == ('Software Engineer', 'Interested', None)
+
+    assert client.get('/api/jobs/archived').get_json() == {'jobs': [], 'next_cursor': None}
+
+    companies = client.get('/api/companies').get_json()['companies']
+    assert sorted((company['name'], company['jobs']) for company in companies) == [
+        ('Contact Company 0', 0), ('Job Company 0', 1), ('Job Company 1', 1)]
+
+    contacts = client.get('/api/contacts').get_json()
+    assert [contact['lname'] for contact in contacts['contacts']] == ['0']
+    assert contacts['contacts'][0]['last_action'] == 'Met at networking event'
+
+    assert client.get('/api/todos').get_json() == {'todos': []}
+
+
+def test_api_answers_304_until_the_users_data_changes():
+    """A matching If-None-Match costs one query, and any write the user sees changes the ETag."""
+
+    user = example_user(num_jobs=1, num_contacts=0)
+    other = example_user(num_jobs=0, num_contacts=0)
+    user_id, other_id = user.user_id, other.user_id
+    job = JobEvent.query.filter(JobEvent.user_id == user_id).one().jobs
+    job_id, company_id = job.job_id, job.company_id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    etag = client.get('/api/jobs').headers['ETag']
+
+    responses = []
+    statements = capture_queries(lambda: responses.append(
+        client.get('/api/jobs', headers={'If-None-Match': etag})))
+    assert responses[0].status_code == 304
+    assert responses[0].data == b''
+    assert len(statements) == 1
+
+    # the user's own edit
+    client.post('/dashboard/jobs/edit', data={'job_id': str(job_id), 'link': '', 'avg_salary': '',
+                                              'notes': 'Call back Monday'})
+    response = client.get('/api/jobs', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['jobs'][0]['notes'] == 'Call back Monday'
+    etag = response.headers['ETag']
+
+    # another user can't edit the user's company, so nothing the user sees changes
+    company_edit = {'company_id': str(company_id), 'street': '', 'city': 'Oakland', 'state': 'CA',
+                    'zipcode': '', 'notes': '', 'website': ''}
+    other_client = app.test_client()
+    with other_client.session_transaction() as sess:
+        sess['user_id'] = other_id
+    assert other_client.post('/dashboard/companies/edit', data=company_edit).status_code == 404
+    assert client.get('/api/companies', headers={'If-None-Match': etag}).status_code == 304
+
+    # the user's own company edit
+    client.post('/dashboard/companies/edit', data=company_edit)
+    response = client.get('/api/companies', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['companies'][0]['city'] == 'Oakland'
+
+
+def test_dashboards_answer_304_before_running_their_queries():
+    """A dashboard revalidated with its ETag costs one query until a write handler bumps the version."""
+
+    user = example_user(num_jobs=1, num_contacts=1)
+    user_id = user.user_id
+    contact_event = ContactEvent.query.filter(ContactEvent.user_id == user_id).one()
+    todo = ToDo(contact_events=contact_event, todo_code=1, date_created=datetime.now(),
+                date_due=datetime.now(), active_status=True)
+    db.session.add(todo)
+    db.session.commit()
+    todo_id = todo.todo_id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    paths = ['/dashboard/jobs', '/dashboard/jobs/archived', '/dashboard/companies',
+             '/dashboard/contacts', '/dashboard/profile']
+    etags = {path: client.get(path).headers['ETag'] for path in paths}
+
+    for path in paths:
+        responses = []
+        statements = capture_queries(lambda: responses.append(
+            client.get(path, headers={'If-None-Match': etags[path]})))
+        assert responses[0].status_code == 304, path
+        assert len(statements) == 1, path
+
+    client.post('/dashboard/archive-task', data={'todo_id': str(todo_id)})
+    for path in paths:
+        response = client.get(path, headers={'If-None-Match': etags[path]})
+        assert response.status_code == 200, path
+        assert response.headers['ETag'] != etags[path]
+
+    # a page showing a flashed message is never revalidated
+    with client.session_transaction() as sess:
+        sess['_flashes'] = [('success', 'Welcome back!')]
+    response = client.get('/dashboard/jobs', headers={'If-None-Match': etags['/dashboard/jobs']})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+
+
+def test_companies_page_counts_only_the_users_own_jobs():
+    """Another user's job at a company of the same name leaves the page, and so its ETag, unchanged."""
+
+    user = example_user(num_jobs=1, num_contacts=0)
+    other = example_user(num_jobs=0, num_contacts=0)
+    user_id, other_id = user.user_id, other.user_id
+    company_id = JobEvent.query.filter(JobEvent.user_id == user_id).one().jobs.company_id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    page = client.get('/dashboard/companies').data.decode()
+
+    other_client = app.test_client()
+    with other_client.session_transaction() as sess:
+        sess['user_id'] = other_id
+    other_client.post('/dashboard/jobs/add', data=job_form(company_name='Job Company 0'))
+    assert JobEvent.query.filter(JobEvent.user_id == other_id).one().jobs.company_id != company_id
+
+    assert client.get('/dashboard/companies').data.decode() == page
+    assert re.search(r'>\s*1\s*</td>', page)
+
+
+# test code registry
+def test_code_registry_holds_codes_and_todo_rules():
+    """The registry maps codes to descriptions and each event code to the todo it starts."""
+
+    codes = code_registry.reload()
+
+    assert codes.job_codes[2] == 'Applied'
+    assert codes.contact_codes[1] == 'Met at networking event'
+    assert codes.todo_codes[2].description == 'Follow up on job application'
+
+    # form values arrive as strings
+    assert code_registry.todo_for_job('2') == (2, 30)
+    assert code_registry.todo_for_contact('1') == (2, 30)
+
+    # shared by every request, so it can't be changed in place
+    with pytest.raises(TypeError):
+        codes.job_codes[2] = 'Ghosted'
+
+
+def test_code_reload_reaches_every_process(monkeypatch):
+    """A process notices codes reloaded elsewhere on its next check."""
+
+    other = CodeRegistry()
+    other.load()
+
+    db.session.add(JobCode(job_code=9, description='Ghosted', todo_code=None))
+    bump_reference_version('codes')
+    db.session.commit()
+
+    # the other copy is trusted until its next check
+    assert 9 not in other.get_data().job_codes
+    monkeypatch.setattr('codes.CHECK_INTERVAL', 0)
+    assert other.get_data().job_codes[9] == 'Ghosted'
+
+    JobCode.query.filter(JobCode.job_code == 9).delete()
+    bump_reference_version('codes')
+    db.session.commit()
+    assert 9 not in other.get_data().job_codes
+
+
+def test_codes_without_a_todo_start_no_todo():
+    """Every way of recording an event whose code has no todo code records it without a todo."""
+
+    user = example_user(num_jobs=3, num_contacts=1)
+    user_id = user.user_id
+    job_ids = sorted(job_id for job_id, in db.session.query(JobStatus.job_id).filter(JobStatus.user_id == user_id))
+    contact_id = ContactEvent.query.filter(ContactEvent.user_id == user_id).one().contact_id
+    code_registry.reload()
+
+    assert code_registry.todo_for_job('8') is None
+    assert code_registry.todo_for_contact('2') is None
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    assert client.post('/dashboard/job-status', data={'job_id': str(job_ids[0]), 'job_code': '8'}).status_code == 302
+    assert client.post('/dashboard/jobs/status',
+                       json={'transitions': [{'job_id': job_ids[1], 'job_code': 8},
+                                             {'job_id': job_ids[2], 'job_code': 2}]}).get_json()['updated'] == 2
+    assert client.post('/dashboard/contact-status',
+                       data={'contact_id': str(contact_id), 'contact_code': '2'}).status_code == 302
+
+    report = import_jobs(user_id, [{'job_title': 'Designer', 'job_status': '8', 'job_link': '', 'job_notes': '',
+                                    'company_id': '', 'company_name': 'No Offer Inc'}])
+    db.session.commit()
+    assert report['imported'] == 1
+    imported_job_id = report['rows'][0]['job_id']
+
+    todo_ids = dict(db.session.query(JobStatus.job_id, JobStatus.todo_id).filter(JobStatus.user_id == user_id))
+    assert todo_ids[job_ids[0]] is None
+    assert todo_ids[job_ids[1]] is None
+    assert todo_ids[job_ids[2]] is not None
+    assert todo_ids[imported_job_id] is None
+
+    contact_event = (ContactEvent.query.filter(ContactEvent.contact_id == contact_id)
+                     .order_by(desc(ContactEvent.contact_event_id)).first())
+    assert (contact_event.contact_code, contact_event.todos) == (2, [])
+
+    for path in ['/dashboard/jobs', '/dashboard/jobs/archived', '/dashboard/contacts',
+                 f'/dashboard/contacts/{contact_id}', '/api/todos']:
+        assert client.get(path).status_code == 200, path
+
+
+def test_dashboards_read_codes_from_the_registry():
+    """Rendering a dashboard never queries the code tables."""
+
+    user_id = load_example_data(jobs_per_user=20)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    code_registry.reload()
+
+    for path in dashboard_paths():
+        statements = capture_queries(lambda: client.get(path))
+        assert not [statement for statement, parameters in statements if '_codes' in statement], path
+
+
+# test salary service
+def test_salary_service_answers_from_memory():
+    """Salary lookups only query the database when the data is loaded."""
+
+    db.session.add(Salary(metro='National', job_title='Software Engineer', avg_salary='$86,563 '))
+    db.session.add(Salary(metro='Boston', job_title='Software Engineer', avg_salary='$99,000 '))
+    db.session.add(Salary(metro='Boston', job_title='Data Scientist', avg_salary='$104,000 '))
+    db.session.commit()
+
+    service = SalaryService()
+    # the table's reference version, then its rows
+    assert count_queries(lambda: service.metros) == 2
+
+    def lookups():
+        assert service.metros == ('Boston', 'National')
+        assert service.job_titles == ('Data Scientist', 'Software Engineer')
+        assert service.get_salary('Boston', 'Data Scientist') == '$104,000 '
+        assert service.get_salary('National', 'Data Scientist') is None
+
+    assert count_queries(lookups) == 0
+
+    # a reload picks up re-seeded rows
+    db.session.add(Salary(metro='Austin', job_title='Data Scientist', avg_salary='$95,000 '))
+    db.session.commit()
+    service.reload()
+    assert service.get_salary('Austin', 'Data Scientist') == '$95,000 '
+
+
+def test_salary_reload_reaches_every_process(monkeypatch):
+    """Only an admin may reload salaries, and a process that didn't answer the reload picks it up too."""
+
+    user = example_user(num_jobs=1)
+    user_id = user.user_id
+    # another worker's copy, loaded before the table changed
+    other = SalaryService()
+    other.load()
+
+    db.session.add(Salary(metro='Denver', job_title='Geologist', avg_salary='$91,000 '))
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    assert client.post('/dashboard/jobs/salary/reload').status_code == 403
+
+    User.query.filter(User.user_id == user_id).update({User.is_admin: True})
+    db.session.commit()
+    assert client.post('/dashboard/jobs/salary/reload').status_code == 200
+
+    # the other copy is trusted until its next check
+    assert other.get_salary('Denver', 'Geologist') is None
+    monkeypatch.setattr('salaries.CHECK_INTERVAL', 0)
+    assert other.get_salary('Denver', 'Geologist') == '$91,000 '
+
+
+def test_parse_salary_strings():
+    """Salary and percent strings from the data files parse into numbers."""
+
+    assert parse_salary('$86,563 ') == 86563
+    assert parse_salary('') is None
+    assert parse_salary('competitive') is None
+    assert parse_percent('1.80%') == 1.8
+    assert parse_percent('-0.50%') == -0.5
+    assert parse_percent(None) is None
+
+
+def test_salary_analytics_percentiles():
+    """Analytics spread each job title across metros and compare jobs with national figures."""
+
+    for metro, amount in [('National', 90000), ('Austin', 80000), ('Denver', 100000), ('Miami', 120000)]:
+        db.session.add(Salary(metro=metro, job_title='Actuary', avg_salary=f'${amount:,} ',
+                              avg_salary_amount=amount, yoy_percent=1.0))
+    user = example_user(num_jobs=1, num_contacts=0)
+    job = user.job_events[0].jobs
+    job.salary_title = 'Actuary'
+    job.avg_salary_amount = 99000
+    db.session.commit()
+
+    results = salary_analytics(user.user_id)
+    actuary = [title for title in results['job_titles'] if title['job_title'] == 'Actuary'][0]
+
+    assert actuary['metros'] == 3
+    assert actuary['median'] == 100000
+    assert actuary['national'] == 90000
+    assert results['jobs'][0]['difference'] == 9000
+    assert results['jobs'][0]['percent_of_national'] == 110.0
+
+
+def test_title_matcher_finds_free_text_titles():
+    """Shorthand and seniority words still match the right salary title."""
+
+    matcher = TitleMatcher(['Software Engineer', 'Systems Engineer', 'Human Resources Manager',
+                            'Product Manager', 'Project Manager', 'Registered Nurse'])
+
+    assert matcher.match('Sr. Software Eng', limit=1) == [('Software Engineer', 1.0)]
+    assert matcher.match('HR Mgr', limit=1)[0][0] == 'Human Resources Manager'
+    assert [title for title, score in matcher.match('product manager', limit=2)] == ['Product Manager', 'Project Manager']
+    assert matcher.match('') == []
+
+
+def test_suggested_salary_leaves_the_salary_picker_up():
+    """A job added with a suggested salary still offers the metro menu until one is picked."""
+
+    db.session.add(Salary(metro='National', job_title='Cartographer', avg_salary='$64,000 '))
+    db.session.add(Salary(metro='Portland', job_title='Cartographer', avg_salary='$69,000 '))
+    db.session.commit()
+    salary_service.load()
+    code_registry.reload()
+
+    user = example_user(num_jobs=0, num_contacts=0)
+    user_id = user.user_id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    client.post('/dashboard/jobs/add', data=job_form(job_title='Sr. Cartographer'))
+    job = Job.query.join(JobEvent).filter(JobEvent.user_id == user_id).one()
+    job_id = job.job_id
+    assert (job.salary_title, job.avg_salary, job.salary_suggested) == ('Cartographer', '$64,000 ', True)
+
+    page = client.get(f'/dashboard/jobs/{job_id}').data.decode()
+    assert 'id="submitSalaryInfo"' in page
+    assert 'national average for Cartographer' in page
+
+    client.post('/dashboard/jobs/salary', data={'metro': 'Portland', 'job_title': 'Cartographer',
+                                                'job_id': str(job_id)})
+    job = Job.query.get(job_id)
+    assert (job.avg_salary, job.salary_suggested) == ('$69,000 ', False)
+    assert 'id="submitSalaryInfo"' not in client.get(f'/dashboard/jobs/{job_id}').data.decode()
+
+
+def read_generated(directory):
+    """Return each generated file's rows, split into fields."""
+
+    rows = {}
+    for name, filename in FILES.items():
+        with open(os.path.join(directory, filename)) as myfile:
+            rows[name] = [line.rstrip('\n').split('|') for line in myfile]
+
+    return rows
+
+
+def test_generated_data_is_deterministic_and_consistent():
+    """The same seed gives the same files with any number of workers, and every reference resolves."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        scale = ['--seed', '7', '--users', '1500', '--companies', '40', '--jobs-per-user', '4',
+                 '--contacts-per-user', '2']
+        generate(parse_args(scale + ['--workers', '1', '--output', os.path.join(directory, 'one')]))
+        generate(parse_args(scale + ['--workers', '2', '--output', os.path.join(directory, 'two')]))
+
+        one = read_generated(os.path.join(directory, 'one'))
+        assert one == read_generated(os.path.join(directory, 'two'))
+
+    assert len(one['users']) == 1500
+    assert len(one['jobs']) == 6000
+    assert len(one['contacts']) == 3000
+    assert len(set(email for fname, lname, email, password in one['users'])) == 1500
+    assert all(1 <= int(company_id) <= 40 for title, link, company_id, active, notes in one['jobs'])
+
+    # a job's events all belong to the user it was written for, in date order
+    owners = {}
+    last_dates = {}
+    last_codes = {}
+    for job_id, user_id, job_code, date_created in one['job_events']:
+        assert (int(job_id) - 1) // 4 + 1 == int(user_id)
+        assert owners.setdefault(job_id, user_id) == user_id
+        assert date_created >= last_dates.get(job_id, '')
+        last_dates[job_id] = date_created
+        last_codes[job_id] = int(job_code)
+    assert len(owners) == 6000
+
+    # a job is active until its last event ends the search, as the app decides it
+    for job_id, (title, link, company_id, active, notes) in enumerate(one['jobs'], start=1):
+        assert (active == 'True') == (last_codes[str(job_id)] <= LAST_ACTIVE_JOB_CODE)
+
+    for user_id, contact_id, contact_code, date_created in one['contact_events']:
+        assert (int(contact_id) - 1) // 2 + 1 == int(user_id)
+
+
+def test_bench_flags_regressions():
+    """Slower routes and extra statements are flagged; small or noisy changes are not."""
+
+    def result(p50, p95, statements, rows):
+        return {'p50_ms': p50, 'p95_ms': p95, 'statements': statements, 'rows': rows, 'status': 200}
+
+    before = {'routes': {'GET /dashboard/jobs': result(10.0, 12.0, 1, 20),
+                         'GET /dashboard/contacts': result(0.5, 0.6, 4, 10),
+                         'GET /dashboard/profile': result(8.0, 9.0, 2, 50)}}
+    after = {'routes': {'GET /dashboard/jobs': result(15.0, 13.0, 1, 20),
+                        'GET /dashboard/contacts': result(0.9, 1.0, 4, 10),
+                        'GET /dashboard/profile': result(8.0, 9.0, 3, 100),
+                        'GET /dashboard/companies': result(50.0, 60.0, 9, 9)}}
+
+    assert find_regressions(before, after, threshold=0.2, min_delta_ms=1.0) == [
+        'GET /dashboard/jobs: p50_ms 10.0 -> 15.0',
+        'GET /dashboard/profile: statements 2 -> 3',
+        'GET /dashboard/profile: rows 50 -> 100',
+    ]
+    assert find_regressions(before, before) == []
+
+
+# test metrics
+def test_metrics_endpoint_counts_requests():
+    """A scrape reports each endpoint's requests, latency, pool and cache numbers."""
+
+    user = example_user(num_jobs=1)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.user_id
+
+    def scrape():
+        lines = client.get('/metrics').data.decode().splitlines()
+        return dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+
+    before = scrape()
+    client.get('/dashboard/jobs')
+    client.get('/dashboard/jobs')
+    after = scrape()
+
+    series = 'jobtracker_requests_total{endpoint="show_active_jobs",method="GET",status="200"}'
+    assert int(after[series]) - int(before.get(series, 0)) == 2
+
+    count = 'jobtracker_request_duration_seconds_count{endpoint="show_active_jobs"}'
+    assert int(after[count]) - int(before.get(count, 0)) == 2
+    assert after['jobtracker_request_duration_seconds_bucket{endpoint="show_active_jobs",le="+Inf"}'] == after[count]
+
+    assert 'jobtracker_db_pool_size' in after
+    assert 'jobtracker_cache_hits_total{cache="companies"}' in after
+
+
+def test_histogram_buckets_are_cumulative():
+    """Each bucket counts every observation at or below its bound."""
+
+    registry = Registry()
+    histogram = registry.add(Histogram('test_seconds', 'Test.', labels=('route',), buckets=(0.1, 1.0)))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(value, ('a"b',))
+
+    assert registry.render().splitlines() == [
+        '# HELP test_seconds Test.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{route="a\\"b",le="0.1"} 2',
+        'test_seconds_bucket{route="a\\"b",le="1.0"} 3',
+        'test_seconds_bucket{route="a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{route="a\\"b"} 2.65',
+        'test_seconds_count{route="a\\"b"} 4',
+    ]
+
+
+def test_shared_registry_adds_up_every_workers_metrics():
+    """Counters add up across the processes sharing a directory; gauges of exited ones are dropped."""
+
+    registry = Registry()
+    requests = registry.add(Counter('test_requests_total', 'Test.', labels=('route',)))
+    registry.add(Gauge('test_connections', 'Test.', lambda: 2))
+    requests.inc(('jobs',), 3)
+
+    # a worker that has exited, and one still running
+    dead = os.fork()
+    if dead == 0:
+        os._exit(0)
+    os.waitpid(dead, 0)
+    alive = os.getppid()
+
+    with tempfile.TemporaryDirectory() as directory:
+        registry.share(directory)
+        for pid, total in [(dead, 5), (alive, 7)]:
+            with open(os.path.join(directory, f'{pid}.json'), 'w') as file:
+                json.dump({'test_requests_total': [['test_requests_total', '{route="jobs"}', total]],
+                           'test_connections': [['test_connections', '', 4]]}, file)
+
+        assert [line for line in registry.render().splitlines() if not line.startswith('#')] == [
+            'test_requests_total{route="jobs"} 15',
+            'test_connections 6',
+        ]
+
+
+# test profiler
+def test_profiler_samples_signed_requests_by_route():
+    """Requests with a valid X-Profile header are sampled into a collapsed-stack file for their route."""
+
+    user = example_user(num_jobs=5)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.user_id
+
+    app.config['PROFILE_INTERVAL'] = 0.0005
+    with tempfile.TemporaryDirectory() as directory:
+        sampler.flush(directory)
+
+        # a wrong token is ignored like no token at all
+        for i in range(5):
+            client.get('/dashboard/companies', headers={'X-Profile': 'not the token'})
+        for i in range(20):
+            client.get('/dashboard/jobs', headers={'X-Profile': profile_token(app.secret_key)})
+
+        sampler.flush(directory)
+        assert [name for name in os.listdir(directory) if name.endswith('.collapsed')] == ['GET_dashboard_jobs.collapsed']
+
+        with open(os.path.join(directory, 'GET_dashboard_jobs.collapsed')) as collapsed:
+            stacks = [line.rsplit(' ', 1) for line in collapsed.read().splitlines()]
+
+    app.config['PROFILE_INTERVAL'] = 0.005
+
+    assert all(int(count) > 0 for stack, count in stacks)
+    assert any('server.py:show_active_jobs' in stack for stack, count in stacks)
+
+
+def test_profiler_workers_flushing_at_once_keep_every_sample():
+    """Worker processes merging into the same route's file don't drop each other's samples."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        children = []
+        for worker in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    worker_sampler = Sampler()
+                    for flush in range(50):
+                        worker_sampler.samples['GET /dashboard/jobs']['server.py:show_active_jobs'] += 1
+                        worker_sampler.flush(directory)
+                finally:
+                    os._exit(0)
+            children.append(pid)
+
+        for pid in children:
+            os.waitpid(pid, 0)
+
+        with open(os.path.join(directory, 'GET_dashboard_jobs.collapsed')) as collapsed:
+            assert collapsed.read() == 'server.py:show_active_jobs 200\n'
+
+
+def test_memtrace_logs_peak_memory_and_ranks_routes():
+    """With MEMTRACE on, each request logs its peak memory, and the report ranks the heaviest route first."""
+
+    traced = Flask('memtrace_test')
+
+    @traced.route('/small')
+    def small():
+        return 'x' * 1000
+
+    @traced.route('/large')
+    def large():
+        # about 8MB held only while the view runs
+        numbers = list(range(1000000))
+        return str(len(numbers))
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = os.path.join(directory, 'memtrace.log')
+        traced.config.update(MEMTRACE=True, MEMTRACE_LOG=log)
+        instrument_memory(traced)
+
+        client = traced.test_client()
+        try:
+            for i in range(3):
+                client.get('/small')
+                client.get('/large')
+        finally:
+            for handler in memtrace_logger.handlers:
+                handler.close()
+            memtrace_logger.handlers = []
+            tracemalloc.stop()
+
+        requests = list(read_log([log]))
+        ranked = rank_routes(requests)
+
+    assert len(requests) == 6
+    assert [route['route'] for route in ranked] == ['GET /large', 'GET /small']
+    assert ranked[0]['requests'] == 3
+    assert ranked[0]['max_peak_bytes'] > 8000000 > ranked[1]['max_peak_bytes']
+    # the list is gone by the time the response is ready
+    assert ranked[0]['max_retained_bytes'] < 1000000
+
+
 # test adding a job
 def add_job_return_event_desc():
     """Adds a new job to the database for a user"""
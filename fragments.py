@@ -0,0 +1,114 @@
+"""Rendered HTML of template blocks, reused across requests until what they show changes.
+
+A template wraps a block in {% cache 'name', key, ... %} ... {% endcache %}.
+The keys are the block's dependencies, named explicitly: a user's data
+version for blocks built from their data, the salary data version for the
+salary lists, a company's state for the state menu. While the keys stay the
+same the block's HTML comes from memory instead of being rendered again;
+when anything it shows changes, so does a key, and the stale copy is left for
+the LRU to evict."""
+
+from threading import Lock
+from time import perf_counter
+from cachetools import LRUCache
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class FragmentCache(object):
+    """LRU cache of rendered template fragments, bounded by entry count and by total bytes.
+
+    Each entry remembers how long its block took to render, so every hit adds
+    that time to saved_seconds, the rendering the cache has saved so far."""
+
+    def __init__(self, max_entries=5000, max_bytes=16 * 1024 * 1024):
+        # the LRU counts characters of HTML against max_bytes
+        self.cache = LRUCache(maxsize=max_bytes, getsizeof=lambda entry: len(entry[0]))
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.render_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def get_or_render(self, key, render):
+        """Return the HTML cached under key, calling render() to make it on a miss."""
+
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.saved_seconds += entry[1]
+                return entry[0]
+            self.misses += 1
+
+        # render outside the lock so one slow block doesn't hold up other requests
+        start = perf_counter()
+        html = render()
+        seconds = perf_counter() - start
+
+        with self.lock:
+            self.render_seconds += seconds
+            try:
+                self.cache[key] = (html, seconds)
+            except ValueError:
+                # a fragment bigger than the whole cache is rendered every time
+                pass
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem()
+
+        return html
+
+    def clear(self):
+        """Drop every cached fragment."""
+
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        """Return hit, miss, size and render time counters for the cache."""
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self.cache),
+                'maxsize': self.max_entries,
+                'bytes': self.cache.currsize,
+                'max_bytes': self.cache.maxsize,
+                'render_seconds': self.render_seconds,
+                'saved_seconds': self.saved_seconds,
+            }
+
+
+class FragmentCacheExtension(Extension):
+    """The {% cache 'name', key, ... %} ... {% endcache %} tag.
+
+    Fragments are cached in environment.fragment_cache, under the template's
+    name, the fragment's name and its keys."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        # the fragment's name, then any number of keys
+        keys = [nodes.Const(parser.name), parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(self.call_method('_render', [nodes.Tuple(keys, 'load')]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        # caller() returns Markup, which is kept as is so it isn't escaped again on a hit
+        return Markup(self.environment.fragment_cache.get_or_render(key, caller))
@@ -0,0 +1,312 @@
+"""Bulk import of jobs from a CSV or JSON file.
+
+Each row has the fields the add job form posts: job_title, job_status,
+job_link, job_notes, and company_id or company_name. Rows are parsed from the
+upload as it's read and written in batches: companies named in a batch are
+looked up by company_key() in one query and the missing ones added in
+another, then the batch's jobs, first job events, todos and status rows go in
+with one INSERT each, its values sent as one array per column. Nothing is
+committed here; the caller commits the whole import once.
+
+Every row gets a line in the report: the job it became, or why it was
+skipped. Memory for the rows being written grows with the batch size and the
+number of distinct companies, but the report grows with the number of rows."""
+
+import codecs
+import csv
+import json
+from datetime import datetime, timedelta
+from itertools import islice
+from sqlalchemy.dialects.postgresql import insert
+from codes import LAST_ACTIVE_JOB_CODE, code_registry
+from model import Company, Job, JobEvent, JobStatus, ToDo, company_key, db, insert_columns, next_ids
+from salaries import parse_salary, salary_service
+
+
+# rows written per batch of INSERTs
+BATCH_SIZE = 500
+
+# characters read from the upload at a time
+READ_SIZE = 64 * 1024
+
+
+class ImportFormatError(ValueError):
+    """The upload can't be read as CSV or JSON."""
+
+
+def normalize_link(job_link):
+    """Turn a link typed into the add job form into a URL, or "" when there is none."""
+
+    if not job_link:
+        return ""
+    if job_link[:4] != 'http':
+        return ''.join(['http://', job_link])
+
+    return job_link
+
+
+##############################################################################
+# Reading uploads
+
+def iter_json(text, read_size=READ_SIZE):
+    """Yield the values of a JSON array, or of JSON lines, read from text a piece at a time."""
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+
+    while True:
+        piece = text.read(read_size)
+        buffer += piece
+        position = 0
+
+        while True:
+            # step over the array's brackets and the commas and whitespace between rows
+            while position < len(buffer) and buffer[position] in '[], \t\r\n':
+                position += 1
+            if position == len(buffer):
+                break
+
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the rest of the row hasn't been read yet, unless the upload is over
+                if not piece:
+                    raise
+                break
+
+            yield value
+
+        buffer = buffer[position:]
+        if not piece:
+            return
+
+
+def read_rows(stream, filename='', content_type=''):
+    """Yield each row of a CSV or JSON upload as a dict, parsing it as it's read.
+
+    The format comes from the file name's extension, or else the content type."""
+
+    name = (filename or '').lower()
+    if name.endswith(('.json', '.jsonl')) or 'json' in (content_type or ''):
+        parse = iter_json
+    elif name.endswith('.csv') or 'csv' in (content_type or ''):
+        parse = csv.DictReader
+    else:
+        raise ImportFormatError("Upload a .csv or .json file.")
+
+    # decodes as it reads, and skips the byte order mark spreadsheets write
+    text = codecs.getreader('utf-8-sig')(stream)
+
+    try:
+        for row in parse(text):
+            yield row
+    except (ValueError, csv.Error) as error:
+        raise ImportFormatError(f"The file could not be read: {error}")
+
+
+##############################################################################
+# Importing rows
+
+def check_row(row, codes):
+    """Clean up one row the way the add job form would, returning (job, None) or (None, error)."""
+
+    if not isinstance(row, dict):
+        return None, "Row is not an object."
+
+    def field(name):
+        value = row.get(name)
+        return str(value).strip() if value is not None else ''
+
+    title = field('job_title')
+    if not title:
+        return None, "job_title is required."
+    if len(title) > Job.title.type.length:
+        return None, f"job_title is longer than {Job.title.type.length} characters."
+
+    try:
+        job_code = int(field('job_status'))
+    except ValueError:
+        return None, "job_status must be a job code."
+    if job_code not in codes.job_todos:
+        return None, f"job_status {job_code} is not a job code."
+
+    link = normalize_link(field('job_link'))
+    if len(link) > Job.link.type.length:
+        return None, f"job_link is longer than {Job.link.type.length} characters."
+
+    company_id = None
+    company_name = field('company_name')
+    if field('company_id'):
+        try:
+            company_id = int(field('company_id'))
+        except ValueError:
+            return None, "company_id must be a number."
+    elif not company_name:
+        return None, "company_id or company_name is required."
+    elif len(company_name) > Company.name.type.length:
+        return None, f"company_name is longer than {Company.name.type.length} characters."
+
+    return {'title': title, 'job_code': job_code, 'link': link, 'notes': field('job_notes'),
+            'company_id': company_id, 'company_name': company_name}, None
+
+
+class JobImport(object):
+    """One user's import: the companies resolved so far and a report line for every row."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.codes = code_registry.get_data()
+        self.today = datetime.now()
+        # company key -> id, for names seen earlier in this import
+        self.companies = {}
+        # ids of the user's companies, as far as rows have named them
+        self.company_ids = set()
+        # job title -> salary suggestion
+        self.suggestions = {}
+        self.report = []
+
+    def run(self, rows, batch_size=BATCH_SIZE):
+        """Import every row, a batch at a time, and return the report."""
+
+        rows = iter(enumerate(rows, start=1))
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            self.add_batch(batch)
+
+        imported = sum(1 for line in self.report if 'job_id' in line)
+
+        return {'imported': imported, 'skipped': len(self.report) - imported, 'rows': self.report}
+
+    def resolve_companies(self, jobs):
+        """Fill in every job's company_id, adding the companies the user hasn't added yet.
+
+        Returns the numbers of the rows whose company_id isn't one of the user's companies."""
+
+        unknown_ids = set(job['company_id'] for number, job in jobs
+                          if job['company_id'] is not None) - self.company_ids
+        if unknown_ids:
+            self.company_ids.update(id for id, in db.session.query(Company.company_id)
+                                                    .filter(Company.company_id.in_(unknown_ids),
+                                                            Company.owner_user_id == self.user_id))
+
+        # the first spelling of each new name in the batch is the one a new company gets
+        names = {}
+        for number, job in jobs:
+            if job['company_id'] is None:
+                job['company_key'] = company_key(job['company_name'])
+                if job['company_key'] not in self.companies:
+                    names.setdefault(job['company_key'], job['company_name'])
+
+        if names:
+            self.companies.update(db.session.query(Company.name_key, Company.company_id)
+                                    .filter(Company.owner_user_id == self.user_id, Company.name_key.in_(names)))
+
+            new_keys = sorted(set(names) - set(self.companies))
+            if new_keys:
+                added = db.session.execute(insert(Company)
+                                           .values([{'owner_user_id': self.user_id, 'name': names[key],
+                                                     'name_key': key}
+                                                    for key in new_keys])
+                                           .on_conflict_do_nothing(index_elements=[Company.owner_user_id,
+                                                                                   Company.name_key])
+                                           .returning(Company.name_key, Company.company_id))
+                self.companies.update(added.fetchall())
+
+            # names another transaction added since the first query
+            raced = set(names) - set(self.companies)
+            if raced:
+                self.companies.update(db.session.query(Company.name_key, Company.company_id)
+                                        .filter(Company.owner_user_id == self.user_id, Company.name_key.in_(raced)))
+
+        missing = set()
+        for number, job in jobs:
+            if job['company_id'] is None:
+                job['company_id'] = self.companies[job['company_key']]
+            elif job['company_id'] not in self.company_ids:
+                missing.add(number)
+
+        return missing
+
+    def suggest_salary(self, title):
+        """The salary suggestion for a job title, worked out once per title."""
+
+        if title not in self.suggestions:
+            self.suggestions[title] = salary_service.suggest_salary(title)
+
+        return self.suggestions[title]
+
+    def add_batch(self, batch):
+        """Check a batch of (row number, row) pairs and insert the good ones."""
+
+        jobs = []
+        for number, row in batch:
+            job, error = check_row(row, self.codes)
+            if error:
+                self.report.append({'row': number, 'error': error})
+            else:
+                jobs.append((number, job))
+
+        missing = self.resolve_companies(jobs)
+        for number in sorted(missing):
+            self.report.append({'row': number, 'error': "company_id is not one of your companies."})
+        jobs = [(number, job) for number, job in jobs if number not in missing]
+
+        if not jobs:
+            return
+
+        job_ids = next_ids('jobs', 'job_id', len(jobs))
+        job_event_ids = next_ids('job_events', 'job_event_id', len(jobs))
+        # a job code with no todo code starts no todo
+        todo_numbers = [number for number, job in jobs if self.codes.job_todos[job['job_code']] is not None]
+        todo_ids = dict(zip(todo_numbers, next_ids('todos', 'todo_id', len(todo_numbers))))
+
+        job_rows, event_rows, todo_rows, status_rows = [], [], [], []
+        for (number, job), job_id, job_event_id in zip(jobs, job_ids, job_event_ids):
+            todo_id = todo_ids.get(number)
+            suggestion = self.suggest_salary(job['title'])
+            salary_title, avg_salary = suggestion or (None, None)
+
+            job_rows.append({
+                'job_id': job_id, 'title': job['title'], 'link': job['link'],
+                'company_id': job['company_id'], 'notes': job['notes'],
+                'salary_title': salary_title, 'avg_salary': avg_salary,
+                'avg_salary_amount': parse_salary(avg_salary) if avg_salary else None,
+                'active_status': job['job_code'] <= LAST_ACTIVE_JOB_CODE,
+            })
+            event_rows.append({
+                'job_event_id': job_event_id, 'user_id': self.user_id, 'job_id': job_id,
+                'job_code': job['job_code'], 'date_created': self.today,
+            })
+
+            # the same todo the form would start for this event
+            if todo_id is not None:
+                todo_code = self.codes.job_todos[job['job_code']]
+                todo_rows.append({
+                    'todo_id': todo_id, 'job_event_id': job_event_id, 'contact_event_id': None,
+                    'todo_code': todo_code, 'date_created': self.today,
+                    'date_due': self.today + timedelta(days=self.codes.todo_codes[todo_code].sugg_due_date),
+                    'active_status': True,
+                })
+            status_rows.append({
+                'user_id': self.user_id, 'job_id': job_id, 'job_code': job['job_code'],
+                'job_event_id': job_event_id, 'todo_id': todo_id, 'last_activity': self.today,
+            })
+
+            self.report.append({'row': number, 'job_id': job_id})
+
+        # the new jobs have no status rows yet, so these are plain inserts
+        for model, rows in ((Job, job_rows), (JobEvent, event_rows),
+                            (ToDo, todo_rows), (JobStatus, status_rows)):
+            if rows:
+                insert_columns(model, rows)
+
+
+def import_jobs(user_id, rows, batch_size=BATCH_SIZE):
+    """Add a job for every good row, returning counts and a report line for each row."""
+
+    report = JobImport(user_id).run(rows, batch_size)
+    report['rows'].sort(key=lambda line: line['row'])
+
+    return report
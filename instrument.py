@@ -0,0 +1,191 @@
+"""Count the SQL each request runs and catch N+1 query patterns.
+
+Every statement run while a request is handled is counted, timed, and grouped
+by its SQL text. Bound parameters are not part of the text, so a statement
+repeated with different parameters (one query per row of an earlier result)
+shows up as one group with a high count: an N+1 pattern. The totals go out as
+X-SQL-* response headers and a JSON log line per request. In test mode a
+request with an N+1 pattern or more statements than its budget raises
+SQLBudgetError, so the test that made it fails."""
+
+import json
+import logging
+import os
+import sys
+import time
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger('jobtracker.sql')
+
+# a statement run this many times in one request is an N+1 pattern
+N_PLUS_ONE_THRESHOLD = 3
+
+# most statements a request may run in test mode, unless its route sets its own
+STATEMENT_BUDGET = 20
+
+# frames from files in this directory are the app's own code
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+THIS_FILE = os.path.abspath(__file__)
+
+
+class SQLBudgetError(Exception):
+    """A request ran more SQL than its route allows."""
+
+
+class RequestStats(object):
+    """SQL statements, time and rows for one request, grouped by statement."""
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.counts = {}
+        self.call_sites = {}
+
+    def record(self, statement, seconds, rows):
+        """Add one executed statement."""
+
+        self.statements += 1
+        self.seconds += seconds
+        self.rows += rows
+
+        count = self.counts.get(statement, 0) + 1
+        self.counts[statement] = count
+        # only a repeated statement needs to know where it came from
+        if count == 2:
+            self.call_sites[statement] = call_site()
+
+    def n_plus_one(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Statements run at least threshold times, most repeated first."""
+
+        repeated = sorted(((count, statement) for statement, count in self.counts.items()
+                           if count >= threshold), reverse=True)
+
+        return [{'statement': ' '.join(statement.split())[:200],
+                 'count': count,
+                 'call_site': self.call_sites.get(statement)}
+                for count, statement in repeated]
+
+
+def call_site():
+    """File, line and function of the innermost app frame running the current statement.
+
+    Templates count as app code, so a relationship lazy-loaded inside a loop in
+    a template is traced to the template."""
+
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename != THIS_FILE and 'site-packages' not in filename:
+            return f'{os.path.relpath(filename, APP_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+
+    return None
+
+
+def sql_budget(statements, repeats=None):
+    """Set the most statements a route may run in test mode.
+
+    Without repeats the route gets the app's SQL_N_PLUS_ONE_THRESHOLD, read
+    when the request is checked. A route that works through its input in
+    batches runs the same statements once per batch, so it can pass None for
+    statements, or False for repeats, to turn that limit off."""
+
+    def decorator(view):
+        view.sql_budget = statements
+        view.sql_repeats = repeats
+        return view
+
+    return decorator
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    """Note when a statement starts, if it's part of a request."""
+
+    if has_request_context():
+        conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    """Add a finished statement to the current request's totals."""
+
+    if not has_request_context():
+        return
+
+    starts = conn.info.get('statement_start')
+    seconds = time.perf_counter() - starts.pop() if starts else 0.0
+
+    stats = g.get('sql_stats')
+    if stats is None:
+        return
+
+    # rowcount is the number of rows a query returns; writes have no description
+    rows = cursor.rowcount if cursor.description is not None and cursor.rowcount > 0 else 0
+    stats.record(statement, seconds, rows)
+
+
+def start_request():
+    """Start counting the request's SQL from zero."""
+
+    # g can outlive a request when an app context was already pushed, as in tests
+    g.sql_stats = RequestStats()
+
+
+def report_sql(response):
+    """Add the request's SQL totals to the response and the log, and enforce budgets in test mode."""
+
+    stats = g.get('sql_stats') or RequestStats()
+
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'sql_budget', current_app.config['SQL_STATEMENT_BUDGET'])
+    repeats = getattr(view, 'sql_repeats', None)
+    if repeats is None:
+        repeats = current_app.config['SQL_N_PLUS_ONE_THRESHOLD']
+    n_plus_one = stats.n_plus_one(repeats) if repeats else []
+
+    response.headers['X-SQL-Statements'] = str(stats.statements)
+    response.headers['X-SQL-Time-Ms'] = f'{stats.seconds * 1000:.2f}'
+    response.headers['X-SQL-Rows'] = str(stats.rows)
+    response.headers['X-SQL-N-Plus-One'] = str(len(n_plus_one))
+
+    route = request.url_rule.rule if request.url_rule else request.path
+    line = {
+        'method': request.method,
+        'route': route,
+        'status': response.status_code,
+        'statements': stats.statements,
+        'db_ms': round(stats.seconds * 1000, 2),
+        'rows': stats.rows,
+        'n_plus_one': n_plus_one,
+    }
+    logger.log(logging.WARNING if n_plus_one else logging.INFO, json.dumps(line))
+
+    strict = current_app.config['SQL_BUDGET_STRICT']
+    if strict is None:
+        strict = current_app.testing
+
+    if strict:
+        if n_plus_one:
+            raise SQLBudgetError(f"{request.method} {route} repeats a statement: {n_plus_one[0]}")
+        if budget is not None and stats.statements > budget:
+            raise SQLBudgetError(f"{request.method} {route} ran {stats.statements} statements, "
+                                 f"over its budget of {budget}")
+
+    return response
+
+
+def instrument_sql(app):
+    """Report every request's SQL for app."""
+
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD)
+    app.config.setdefault('SQL_STATEMENT_BUDGET', STATEMENT_BUDGET)
+    # None means fail over-budget requests only when app.testing is set
+    app.config.setdefault('SQL_BUDGET_STRICT', None)
+
+    app.before_request(start_request)
+    app.after_request(report_sql)
@@ -0,0 +1,199 @@
+"""Opt-in memory tracing of requests with tracemalloc, and a report of the worst routes.
+
+Set MEMTRACE=1 to trace every request. Each one logs a JSON line to a rotating
+log (MEMTRACE_LOG, memtrace.log by default) with its route, the peak memory
+allocated while it ran, the memory it still held when the response was ready,
+and the code that allocated most of that. Tracing slows requests down a lot,
+so it's for finding memory hogs, not for everyday use; when MEMTRACE is unset
+nothing is hooked in at all.
+
+Peak memory is measured per process, and each request clears the traces
+before it starts, so it's only accurate while a process runs one request at a
+time: server.py's development server, or gunicorn with one thread per worker,
+which serving.py uses whenever MEMTRACE is set.
+
+    python3.6 memtrace.py report [memtrace.log ...]     # routes ranked by peak memory"""
+
+import json
+import logging
+import os
+import sys
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from flask import g, request
+
+
+# frames kept for each allocation, enough to reach from SQLAlchemy back to the view
+TRACE_FRAMES = 25
+
+# allocation sites logged per request
+TOP_SITES = 5
+
+# files in this directory are the app's own code
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger('jobtracker.memtrace')
+
+
+def allocation_site(traceback):
+    """Name where memory was allocated: the innermost frame, and the app code that led to it."""
+
+    innermost = traceback[-1] if traceback else None
+    app_frame = None
+    for frame in reversed(traceback):
+        if frame.filename.startswith(APP_DIR) and 'site-packages' not in frame.filename:
+            app_frame = frame
+            break
+
+    def name(frame):
+        filename = frame.filename
+        if 'site-packages' in filename:
+            filename = filename.split('site-packages' + os.sep, 1)[-1]
+        elif filename.startswith(APP_DIR):
+            filename = os.path.relpath(filename, APP_DIR)
+        return f'{filename}:{frame.lineno}'
+
+    if innermost is None:
+        return 'unknown'
+    if app_frame is None or app_frame is innermost:
+        return name(innermost)
+
+    return f'{name(innermost)} <- {name(app_frame)}'
+
+
+def top_sites(snapshot, limit=TOP_SITES):
+    """The sites holding the most memory in a snapshot, as dicts of site, bytes and blocks."""
+
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, __file__)])
+
+    sites = defaultdict(lambda: [0, 0])
+    for statistic in snapshot.statistics('traceback'):
+        site = sites[allocation_site(statistic.traceback)]
+        site[0] += statistic.size
+        site[1] += statistic.count
+
+    ranked = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    return [{'site': site, 'bytes': size, 'blocks': count} for site, (size, count) in ranked]
+
+
+def start_trace():
+    """Start measuring the request's allocations from zero."""
+
+    # forgets earlier allocations and resets the peak, so the snapshot at the
+    # end only holds what this request allocated; freeing older blocks counts for nothing
+    tracemalloc.clear_traces()
+    g.memtrace_traced = True
+
+
+def record_trace(response):
+    """Log the request's peak and retained memory and where the retained memory came from."""
+
+    if not g.pop('memtrace_traced', False):
+        return response
+
+    current, peak = tracemalloc.get_traced_memory()
+    # the ORM objects the view loaded are still in the session at this point
+    sites = top_sites(tracemalloc.take_snapshot())
+
+    route = request.url_rule.rule if request.url_rule else request.path
+    logger.info(json.dumps({
+        'time': datetime.now().isoformat(),
+        'method': request.method,
+        'route': route,
+        'status': response.status_code,
+        'peak_bytes': peak,
+        'retained_bytes': current,
+        'top': sites,
+    }))
+
+    return response
+
+
+def instrument_memory(app):
+    """Trace app's requests with tracemalloc if MEMTRACE is set."""
+
+    app.config.setdefault('MEMTRACE', bool(os.environ.get('MEMTRACE')))
+    app.config.setdefault('MEMTRACE_LOG', os.environ.get('MEMTRACE_LOG', 'memtrace.log'))
+
+    if not app.config['MEMTRACE']:
+        return
+
+    handler = RotatingFileHandler(app.config['MEMTRACE_LOG'], maxBytes=10 * 1024 * 1024, backupCount=5)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    # the lines are for the report, not the app log
+    logger.propagate = False
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+
+    app.before_request(start_trace)
+    app.after_request(record_trace)
+
+
+##############################################################################
+# Report
+
+def read_log(paths):
+    """Yield each request logged in the given files."""
+
+    for path in paths:
+        with open(path) as log:
+            for line in log:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def rank_routes(requests):
+    """Summarize logged requests per route, the route with the highest peak first."""
+
+    routes = {}
+    for logged in requests:
+        key = f"{logged['method']} {logged['route']}"
+        route = routes.setdefault(key, {'route': key, 'requests': 0, 'peaks': [],
+                                        'max_retained_bytes': 0, 'sites': defaultdict(int)})
+        route['requests'] += 1
+        route['peaks'].append(logged['peak_bytes'])
+        route['max_retained_bytes'] = max(route['max_retained_bytes'], logged['retained_bytes'])
+        for site in logged['top']:
+            route['sites'][site['site']] += site['bytes']
+
+    summaries = []
+    for route in routes.values():
+        peaks = sorted(route['peaks'])
+        summaries.append({
+            'route': route['route'],
+            'requests': route['requests'],
+            'max_peak_bytes': peaks[-1],
+            'median_peak_bytes': peaks[len(peaks) // 2],
+            'max_retained_bytes': route['max_retained_bytes'],
+            'top_site': max(route['sites'], key=route['sites'].get) if route['sites'] else None,
+        })
+
+    return sorted(summaries, key=lambda summary: summary['max_peak_bytes'], reverse=True)
+
+
+def print_report(paths):
+    """Print routes ranked by peak memory."""
+
+    print(f"{'max peak':>10} {'median':>10} {'retained':>10} {'requests':>8}  route / top allocation site")
+    for summary in rank_routes(read_log(paths)):
+        print(f"{summary['max_peak_bytes'] / 1024:>8.0f}KB {summary['median_peak_bytes'] / 1024:>8.0f}KB "
+              f"{summary['max_retained_bytes'] / 1024:>8.0f}KB {summary['requests']:>8}  {summary['route']}")
+        if summary['top_site']:
+            print(f"{'':>42}  {summary['top_site']}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['report']:
+        log = os.environ.get('MEMTRACE_LOG', 'memtrace.log')
+        # the rotated logs too, oldest first
+        paths = sys.argv[2:] or [f'{log}.{number}' for number in range(5, 0, -1)
+                                 if os.path.exists(f'{log}.{number}')] + [log]
+        print_report(paths)
+    else:
+        print(__doc__)
@@ -0,0 +1,425 @@
+"""In-process request, database pool and cache metrics in the Prometheus text format.
+
+Every metric lives in this process's memory and is rendered on demand by the
+/metrics route, so a Prometheus server, or curl, can scrape it without any
+other service. Recording a request is a dict lookup, a bisect and a few
+additions under a lock, which keeps the cost on the request path to a few
+microseconds. Pool and cache numbers are read when scraped, not recorded.
+
+Under gunicorn every worker process has its own metrics. Once the master has
+called registry.share(directory), each worker writes its samples to a file
+there every few seconds, and /metrics adds up every worker's, so a scrape
+reports the whole service whichever worker answers it."""
+
+import glob
+import json
+import os
+import time
+from bisect import bisect_left
+from threading import Lock, Thread
+from flask import g, request
+from sqlalchemy import event
+
+
+# request latency buckets in seconds, from a cached page to a stuck one
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# connection checkout buckets in seconds; anything but the first is waiting on a busy pool
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def format_labels(names, values):
+    """Render label pairs as {name="value",...}, escaped the way the text format wants."""
+
+    if not names:
+        return ''
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter(object):
+    """A total that only goes up, kept per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, label_values=(), amount=1):
+        """Add amount to the total for these label values."""
+
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        """Yield (name, labels, value) for every series."""
+
+        with self.lock:
+            values = list(self.values.items())
+
+        for label_values, value in sorted(values):
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram(object):
+    """Observations counted into buckets, with their sum, per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket, with one more for +Inf, sum]
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, label_values=()):
+        """Count one observation."""
+
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        """Yield cumulative bucket counts, then the sum and count, for every series."""
+
+        with self.lock:
+            values = [(label_values, list(counts), total)
+                      for label_values, (counts, total) in self.values.items()]
+
+        for label_values, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.labels + ('le',), label_values + (bound,))
+                yield self.name + '_bucket', labels, cumulative
+
+            labels = format_labels(self.labels, label_values)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class Gauge(object):
+    """A value read from a function each time metrics are scraped.
+
+    The function returns {label values: value}, or a single number when the
+    gauge has no labels. A total kept elsewhere, like a cache's hit count, can
+    be read the same way and exposed as a counter."""
+
+    def __init__(self, name, description, read, labels=(), kind='gauge'):
+        self.name = name
+        self.description = description
+        self.read = read
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        """Yield the current value of every series."""
+
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        for label_values, value in sorted(values.items()):
+            if value is not None:
+                yield self.name, format_labels(self.labels, label_values), value
+
+
+def process_alive(pid):
+    """Whether a process with this pid is still running."""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, as another user
+        pass
+    return True
+
+
+class Registry(object):
+    """Every metric the /metrics route renders, in the order they were added."""
+
+    # seconds between a worker's writes of its samples to the shared directory
+    save_interval = 5
+
+    def __init__(self):
+        self.metrics = []
+        # where every process writes its samples, once shared
+        self.directory = None
+        # the process whose thread is saving samples, so a forked worker starts its own
+        self.saver_pid = None
+        # the saving thread and a /metrics request write the same file
+        self.save_lock = Lock()
+
+    def add(self, metric):
+        """Add a metric and return it."""
+
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, directory):
+        """Add up the metrics of every process that writes to directory.
+
+        Call it in the master before workers are forked; samples left by an
+        earlier run are deleted."""
+
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+        self.directory = directory
+
+    def collect(self):
+        """Return {metric name: [[name, labels, value], ...]} for this process."""
+
+        return {metric.name: [list(sample) for sample in metric.samples()] for metric in self.metrics}
+
+    def save(self):
+        """Write this process's samples to the shared directory."""
+
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        samples = self.collect()
+        with self.save_lock:
+            with open(path + '.tmp', 'w') as file:
+                json.dump(samples, file)
+            # readers never see a half written file
+            os.replace(path + '.tmp', path)
+
+    def save_in_background(self):
+        """Start a thread that saves this process's samples every save_interval seconds."""
+
+        if self.directory is None or self.saver_pid == os.getpid():
+            return
+        self.saver_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.save_interval)
+                self.save()
+
+        Thread(target=run, name='metrics-saver', daemon=True).start()
+
+    def gather(self):
+        """Return every process's samples, added up, as collect() does for one process.
+
+        A worker that has exited keeps its counts, so totals never go down when
+        gunicorn replaces it, but its gauges are dropped."""
+
+        if self.directory is None:
+            return self.collect()
+
+        # this process's numbers are always current
+        self.save()
+
+        kinds = {metric.name: metric.kind for metric in self.metrics}
+        totals = {name: {} for name in kinds}
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            pid = int(os.path.basename(path)[:-len('.json')])
+            try:
+                with open(path) as file:
+                    samples = json.load(file)
+            except FileNotFoundError:
+                continue
+            alive = process_alive(pid)
+
+            for metric_name, metric_samples in samples.items():
+                if metric_name not in totals or (kinds[metric_name] == 'gauge' and not alive):
+                    continue
+                series = totals[metric_name]
+                for name, labels, value in metric_samples:
+                    series[name, labels] = series.get((name, labels), 0) + value
+
+        return {metric_name: [[name, labels, value] for (name, labels), value in series.items()]
+                for metric_name, series in totals.items()}
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+
+        samples = self.gather()
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in samples[metric.name]:
+                lines.append(f'{name}{labels} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# the metrics for this process, and for the others it shares a directory with
+registry = Registry()
+
+requests_total = registry.add(Counter(
+    'jobtracker_requests_total', 'Requests handled, by endpoint, method and status code.',
+    labels=('endpoint', 'method', 'status')))
+
+request_seconds = registry.add(Histogram(
+    'jobtracker_request_duration_seconds', 'Time to handle a request, by endpoint.',
+    labels=('endpoint',)))
+
+sql_statements_total = registry.add(Counter(
+    'jobtracker_sql_statements_total', 'SQL statements run while handling requests, by endpoint.',
+    labels=('endpoint',)))
+
+sql_seconds_total = registry.add(Counter(
+    'jobtracker_sql_seconds_total', 'Time spent running SQL while handling requests, by endpoint.',
+    labels=('endpoint',)))
+
+checkout_seconds = registry.add(Histogram(
+    'jobtracker_db_pool_checkout_seconds', 'Time to get a connection from the database pool.',
+    buckets=CHECKOUT_BUCKETS))
+
+
+##############################################################################
+# Requests
+
+def start_timer():
+    """Note when the request started."""
+
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(endpoint, method, status):
+    """Count a finished request and its latency, and the SQL it ran."""
+
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+
+    # a forked worker starts writing its samples for the others to read
+    registry.save_in_background()
+
+    endpoint = endpoint or 'none'
+    request_seconds.observe(time.perf_counter() - start, (endpoint,))
+    requests_total.inc((endpoint, method, status))
+
+    # totals counted by instrument.py, when it's in use
+    stats = g.get('sql_stats')
+    if stats is not None:
+        sql_statements_total.inc((endpoint,), stats.statements)
+        sql_seconds_total.inc((endpoint,), stats.seconds)
+
+
+def record_response(response):
+    """Record a request that returned a response."""
+
+    record_request(request.endpoint, request.method, response.status_code)
+    return response
+
+
+def record_error(exception):
+    """Record a request that raised instead of returning a response."""
+
+    # a request that returned a response was recorded already
+    if exception is not None:
+        record_request(request.endpoint, request.method, 500)
+
+
+##############################################################################
+# Database pool
+
+def pool_gauges(get_pool):
+    """Add gauges for the pool returned by get_pool, read each time metrics are scraped."""
+
+    def reader(method):
+        def read():
+            pool = get_pool()
+            # only queue pools have a fixed size and overflow
+            return getattr(pool, method)() if hasattr(pool, method) else None
+        return read
+
+    for name, method, description in [
+            ('jobtracker_db_pool_size', 'size', 'Connections the pool keeps open.'),
+            ('jobtracker_db_pool_checked_out', 'checkedout', 'Connections in use by requests.'),
+            ('jobtracker_db_pool_checked_in', 'checkedin', 'Idle connections waiting in the pool.'),
+            ('jobtracker_db_pool_overflow', 'overflow', 'Connections open beyond the pool size; negative while below it.')]:
+        registry.add(Gauge(name, description, reader(method)))
+
+
+def time_checkouts(engine):
+    """Time every connection checkout from engine's pool, including pools it replaces on dispose."""
+
+    def wrap(pool):
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                checkout_seconds.observe(time.perf_counter() - start)
+
+        pool.connect = timed_connect
+
+    wrap(engine.pool)
+    event.listen(engine, 'engine_disposed', lambda connection: wrap(engine.pool))
+
+
+##############################################################################
+# Caches
+
+# caches reported by the cache metrics, by name
+caches = {}
+
+
+def track_cache(name, cache):
+    """Report hits, misses and size for a cache with a stats() method."""
+
+    caches[name] = cache
+
+
+def cache_reader(key):
+    """Read one stats() number from every tracked cache, labelled by cache name.
+
+    Caches whose stats() don't have the number are left out."""
+
+    def read():
+        return {(name,): cache.stats().get(key) for name, cache in list(caches.items())}
+
+    return read
+
+
+registry.add(Gauge('jobtracker_cache_hits_total', 'Lookups a cache answered.',
+                   cache_reader('hits'), labels=('cache',), kind='counter'))
+registry.add(Gauge('jobtracker_cache_misses_total', 'Lookups a cache had to load.',
+                   cache_reader('misses'), labels=('cache',), kind='counter'))
+registry.add(Gauge('jobtracker_cache_entries', 'Entries held in a cache.',
+                   cache_reader('size'), labels=('cache',)))
+registry.add(Gauge('jobtracker_cache_max_entries', 'Most entries a cache holds before evicting.',
+                   cache_reader('maxsize'), labels=('cache',)))
+registry.add(Gauge('jobtracker_cache_bytes', 'Bytes of rendered HTML a cache holds.',
+                   cache_reader('bytes'), labels=('cache',)))
+registry.add(Gauge('jobtracker_cache_render_seconds_total', 'Time spent rendering what a cache missed.',
+                   cache_reader('render_seconds'), labels=('cache',), kind='counter'))
+registry.add(Gauge('jobtracker_cache_saved_seconds_total', 'Rendering time a cache saved by answering from memory.',
+                   cache_reader('saved_seconds'), labels=('cache',), kind='counter'))
+
+
+def instrument_metrics(app, db):
+    """Record request and pool metrics for app."""
+
+    app.before_request(start_timer)
+    app.after_request(record_response)
+    app.teardown_request(record_error)
+
+    pool_gauges(lambda: db.get_engine(app).pool)
+
+    # the engine only exists once the app is connected and handling requests
+    app.before_first_request(lambda: time_checkouts(db.get_engine(app)))
@@ -1,9 +1,28 @@
 """Model and database function for job hunt app project."""
 
+import os
+import re
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, event, exc
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.pool import Pool
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy that creates its engine with the options in SQLALCHEMY_ENGINE_OPTIONS.
+
+    Flask-SQLAlchemy 2.3 has no setting for options like pool_pre_ping or
+    connect_args, but every version calls apply_driver_hacks() with the
+    options just before it creates the engine."""
+
+    def apply_driver_hacks(self, app, info, options):
+        result = super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        return result
+
 
 # Connect to the PostgreSQL database
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
 
 ##############################################################################
 # Model definitions
@@ -20,30 +39,29 @@ class User(db.Model):
     email = db.Column(db.String(50), unique=True, nullable=False)
     phone = db.Column(db.String(12), nullable=True)
     password = db.Column(db.String(50), nullable=False)
+    # goes up with every change to the user's data, for ETags; see versions.py
+    data_version = db.Column(db.Integer, nullable=False, server_default='0')
+    # may reload the reference data every worker holds in memory
+    is_admin = db.Column(db.Boolean, nullable=False, server_default='false')
 
     @property
     def companies(self):
         """Find all companies a user is associated with and return set of objects."""
-        # make a set of company objects to add to from jobs and contacts
-        companies = set()
-
-        # query for user job events, get set of all job ids, make set of all connected companies
-        user_job_events = JobEvent.query.options(db.joinedload('jobs')).filter(JobEvent.user_id == self.user_id).all()
-        if user_job_events:
-            user_job_ids = set(job.job_id for job in user_job_events)
-            for job_id in user_job_ids:
-                job = Job.query.filter(Job.job_id == job_id).options(db.joinedload('companies')).first()
-                companies.add(job.companies)
-
-        # add companies from contacts to the set
-        user_contact_events = ContactEvent.query.options(db.joinedload('contacts')).filter(ContactEvent.user_id == self.user_id).all()
-        if user_contact_events:
-            user_contact_ids = set(contact.contact_id for contact in user_contact_events)
-            for contact_id in user_contact_ids:
-                contact = Contact.query.filter(Contact.contact_id == contact_id).options(db.joinedload('companies')).first()
-                companies.add(contact.companies)
-
-        return companies
+
+        companies = Company.query.filter(Company.company_id.in_(User.company_ids(self.user_id))).all()
+
+        return set(companies)
+
+    @staticmethod
+    def company_ids(user_id):
+        """Return a query for the ids of all companies a user is associated with."""
+
+        # company ids reached through the user's job events and contact events
+        job_company_ids = db.session.query(Job.company_id).join(JobEvent, JobEvent.job_id == Job.job_id).filter(JobEvent.user_id == user_id)
+        contact_company_ids = db.session.query(Contact.company_id).join(ContactEvent, ContactEvent.contact_id == Contact.contact_id).filter(ContactEvent.user_id == user_id)
+
+        # union both paths so all companies come back in one statement
+        return job_company_ids.union(contact_company_ids)
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -55,6 +73,9 @@ class Contact(db.Model):
     """A user's contact."""
 
     __tablename__ = 'contacts'
+    __table_args__ = (
+        db.Index('ix_contacts_company_id', 'company_id'),
+    )
 
     contact_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     fname = db.Column(db.String(25), nullable=False)
@@ -76,6 +97,10 @@ class ContactEvent(db.Model):
     """Track user and contact events outside of a job, such as networking or informational interviews."""
 
     __tablename__ = 'contact_events'
+    __table_args__ = (
+        db.Index('ix_contact_events_user_id_date_created', 'user_id', 'date_created'),
+        db.Index('ix_contact_events_contact_id_date_created', 'contact_id', 'date_created'),
+    )
 
     contact_event_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
@@ -100,6 +125,8 @@ class ContactCode(db.Model):
 
     contact_code = db.Column(db.Integer, primary_key=True, autoincrement=True)
     description = db.Column(db.Text, nullable=False)
+    # the todo a contact event with this code starts
+    todo_code = db.Column(db.Integer, db.ForeignKey('todo_codes.todo_code'), nullable=True)
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -107,13 +134,43 @@ class ContactCode(db.Model):
         return f"<ContactCode code={self.contact_code} desc={self.description}>"
 
 
+# trailing words that don't tell two companies apart: "Acme Inc." is "Acme"
+COMPANY_SUFFIXES = frozenset(['co', 'company', 'corp', 'corporation', 'gmbh', 'inc',
+                              'incorporated', 'limited', 'llc', 'llp', 'ltd', 'plc'])
+
+
+def company_key(name):
+    """Reduce a company name to the key its spellings share.
+
+    Case, punctuation, extra spaces and legal suffixes are dropped, so
+    "Google", " google " and "Google, Inc." all have the key "google"."""
+
+    words = re.findall(r'\w+', (name or '').casefold())
+    while len(words) > 1 and words[-1] in COMPANY_SUFFIXES:
+        words.pop()
+
+    # a name with no letters or digits is its own key
+    return ' '.join(words) or (name or '').strip().casefold()
+
+
 class Company(db.Model):
-    """Company that has a job listings or contacts."""
+    """Company that has a job listings or contacts.
+
+    Companies are private to the user who added them, since their address and
+    notes are that user's own; two users naming the same company each get a row."""
 
     __tablename__ = 'companies'
 
+    __table_args__ = (
+        db.Index('ix_companies_owner_user_id_name_key', 'owner_user_id', 'name_key', unique=True),
+    )
+
     company_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    # companies added before owners existed have none until upgrade.py gives them one
+    owner_user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=True)
     name = db.Column(db.String(100), nullable=False)
+    # company_key(name); companies added before it existed have none until upgrade.py merges them
+    name_key = db.Column(db.String(100), nullable=True)
     street = db.Column(db.String(100), nullable=True)
     city = db.Column(db.String(50), nullable=True)
     state = db.Column(db.String(2), nullable=True)
@@ -121,6 +178,38 @@ class Company(db.Model):
     website = db.Column(db.String(100), nullable=True)
     notes = db.Column(db.Text, nullable=True)
 
+    @classmethod
+    def get_or_create_id(cls, user_id, name):
+        """Return the id of the user's company a name means, adding the company if there is none.
+
+        Names are matched by company_key(), so "google inc" finds "Google". A new
+        company goes in with INSERT ... ON CONFLICT DO NOTHING, so two requests
+        adding the same name at once end up with the same row. Nothing is
+        committed, so a new company is only kept if the caller's transaction is."""
+
+        name = name.strip()
+        key = company_key(name)
+        mine = and_(cls.owner_user_id == user_id, cls.name_key == key)
+
+        company_id = db.session.query(cls.company_id).filter(mine).scalar()
+        if company_id is None:
+            company_id = db.session.execute(
+                insert(cls).values(owner_user_id=user_id, name=name, name_key=key)
+                           .on_conflict_do_nothing(index_elements=[cls.owner_user_id, cls.name_key])
+                           .returning(cls.company_id)).scalar()
+        if company_id is None:
+            # another transaction added it after the SELECT above
+            company_id = db.session.query(cls.company_id).filter(mine).scalar()
+
+        return company_id
+
+    @classmethod
+    def owned_id(cls, user_id, company_id):
+        """Return company_id if it's one of the user's companies, or None."""
+
+        return db.session.query(cls.company_id).filter(cls.company_id == company_id,
+                                                        cls.owner_user_id == user_id).scalar()
+
     def __repr__(self):
         """Provide helpful representation when printed."""
 
@@ -131,12 +220,19 @@ class Job(db.Model):
     """Job listing at a company that a user is tracking."""
 
     __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_company_id', 'company_id'),
+    )
 
     job_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     link = db.Column(db.String(100), nullable=True)
     company_id = db.Column(db.Integer, db.ForeignKey('companies.company_id'), nullable=False)
     avg_salary = db.Column(db.String(15), nullable=True)
+    avg_salary_amount = db.Column(db.Integer, nullable=True)
+    salary_title = db.Column(db.String(40), nullable=True)
+    # the salary is the national one suggested for salary_title, not one the user picked
+    salary_suggested = db.Column(db.Boolean, nullable=False, server_default='false')
     active_status = db.Column(db.Boolean, nullable=False)
     notes = db.Column(db.Text, nullable=True)
 
@@ -152,6 +248,10 @@ class JobEvent(db.Model):
     """Track events in status of job app."""
 
     __tablename__ = 'job_events'
+    __table_args__ = (
+        db.Index('ix_job_events_user_id_date_created', 'user_id', 'date_created'),
+        db.Index('ix_job_events_job_id_date_created', 'job_id', 'date_created'),
+    )
 
     job_event_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
@@ -169,6 +269,29 @@ class JobEvent(db.Model):
         return f"<JobEvent id={self.job_event_id} event={self.job_code}>"
 
 
+class JobStatus(db.Model):
+    """Current status of a job a user is tracking, kept in step with job events."""
+
+    __tablename__ = 'job_statuses'
+
+    __table_args__ = (
+        # pages of a user's jobs, newest activity first
+        db.Index('ix_job_statuses_user_id_last_activity', 'user_id', 'last_activity', 'job_event_id'),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.job_id'), primary_key=True)
+    job_code = db.Column(db.Integer, db.ForeignKey('job_codes.job_code'), nullable=False)
+    job_event_id = db.Column(db.Integer, db.ForeignKey('job_events.job_event_id'), nullable=False)
+    todo_id = db.Column(db.Integer, db.ForeignKey('todos.todo_id'), nullable=True)
+    last_activity = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return f"<JobStatus user_id={self.user_id} job_id={self.job_id} event={self.job_code}>"
+
+
 class JobCode(db.Model):
     """Codes corresponding to various user events with jobs."""
 
@@ -176,6 +299,8 @@ class JobCode(db.Model):
 
     job_code = db.Column(db.Integer, primary_key=True, autoincrement=True)
     description = db.Column(db.Text, nullable=False)
+    # the todo a job event with this code starts
+    todo_code = db.Column(db.Integer, db.ForeignKey('todo_codes.todo_code'), nullable=True)
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -187,6 +312,10 @@ class ToDo(db.Model):
     """Creates todos based on job events or contact events."""
 
     __tablename__ = 'todos'
+    __table_args__ = (
+        db.Index('ix_todos_job_event_id_active_status', 'job_event_id', 'active_status'),
+        db.Index('ix_todos_contact_event_id_active_status', 'contact_event_id', 'active_status'),
+    )
 
     todo_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     job_event_id = db.Column(db.Integer, db.ForeignKey('job_events.job_event_id'), nullable=True)
@@ -225,12 +354,18 @@ class Salary(db.Model):
     """Average salary for common job titles in metro areas of the United States."""
 
     __tablename__ = 'salaries'
+    __table_args__ = (
+        # one salary per job title and metro, which seed.py upserts on
+        db.Index('ix_salaries_metro_job_title', 'metro', 'job_title', unique=True),
+    )
 
     salary_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     metro = db.Column(db.String(20), nullable=False)
     job_title = db.Column(db.String(40), nullable=False)
     avg_salary = db.Column(db.String(15), nullable=False)
     yoy_salary = db.Column(db.String(7), nullable=True)
+    avg_salary_amount = db.Column(db.Integer, nullable=True)
+    yoy_percent = db.Column(db.Float, nullable=True)
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -238,19 +373,89 @@ class Salary(db.Model):
         return f"<Salary job={self.job_title} metro={self.metro} salary={self.avg_salary}>"
 
 
+class ReferenceVersion(db.Model):
+    """How many times a reference table has been reloaded, so every process can tell its copy is stale."""
+
+    __tablename__ = 'reference_versions'
+
+    name = db.Column(db.String(30), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, server_default='0')
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return f"<ReferenceVersion name={self.name} version={self.version}>"
+
+
 ##############################################################################
 # Helper functions
 
-def connect_to_db(app):
-    """Connect the database to our Flask app."""
+def engine_options(pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=-1,
+                   pool_pre_ping=False, statement_timeout=None):
+    """create_engine() options for a connection pool; statement_timeout is in milliseconds."""
+
+    options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout,
+               'pool_recycle': pool_recycle, 'pool_pre_ping': pool_pre_ping}
+    if statement_timeout:
+        # sent when each connection starts, so it costs no statement per request
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+
+    return options
+
+
+def next_ids(table, column, count):
+    """Reserve count ids from a table's serial sequence, in one statement."""
+
+    return [id for id, in db.session.execute(
+        "SELECT nextval(pg_get_serial_sequence(:table, :column)) FROM generate_series(1, :count)",
+        {'table': table, 'column': column, 'count': count})]
+
+
+def insert_columns(model, rows):
+    """Insert rows into model's table with one short statement, sending each column as an array.
+
+    A multi-row VALUES clause has a parameter per value, and building it costs
+    more than running it; unnest() takes one parameter per column."""
+
+    table = model.__table__
+    columns = list(rows[0])
+    dialect = db.engine.dialect
+    arrays = ', '.join(f'CAST(:{name} AS {table.c[name].type.compile(dialect=dialect)}[])'
+                       for name in columns)
+
+    db.session.execute(f'INSERT INTO {table.name} ({", ".join(columns)}) SELECT * FROM unnest({arrays})',
+                       {name: [row[name] for row in rows] for name in columns})
+
+
+def connect_to_db(app, db_uri='postgresql:///jobs', pool=None):
+    """Connect the database to our Flask app.
+
+    pool is a dict of engine_options() arguments; without it the engine gets
+    SQLAlchemy's default pool."""
 
     # Configure to use our PstgreSQL database
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///jobs'
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if pool is not None:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(**pool)
     db.app = app
     db.init_app(app)
 
 
+# a forked process must never use a connection it inherited, since its parent shares the socket
+@event.listens_for(Pool, 'connect')
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def refuse_inherited_connection(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info['pid'] != os.getpid():
+        # drop it without closing it, then let the pool connect again
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError("Connection was opened by another process.")
+
+
 if __name__ == "__main__":
     # As a convenience, if we run this module interactively, it will leave
     # you in a state of being able to work with the database directly.
@@ -0,0 +1,231 @@
+"""Keyset pagination for the lists that grow for as long as a user keeps using the app.
+
+Archived jobs, contacts, and the event history of a job or contact are read a
+page at a time, newest first, ordered by (date_created, id). Each page ends
+with a cursor naming its last row, and the next page seeks straight past that
+row with a row comparison that the (..., date_created) indexes answer. A deep
+page reads as many rows as the first one, where OFFSET would read and throw
+away every row before it."""
+
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, desc, tuple_
+from sqlalchemy.orm import aliased
+from codes import code_registry
+from model import ContactEvent, JobEvent, JobStatus, ToDo, db
+from status import job_statuses_query
+
+
+# rows per page, unless a request asks for fewer or more
+PAGE_SIZE = 25
+
+# most rows one request may ask for
+MAX_PAGE_SIZE = 100
+
+# cursors carry timestamps to the microsecond, so rows created in the same second stay apart
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class PageError(ValueError):
+    """A cursor or page size sent with a request can't be used."""
+
+
+def encode_cursor(date_created, row_id):
+    """An opaque cursor pointing just past a row."""
+
+    key = json.dumps([date_created.strftime(CURSOR_DATE_FORMAT), row_id])
+
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """The (date_created, id) a cursor points past."""
+
+    try:
+        date_created, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.strptime(date_created, CURSOR_DATE_FORMAT), int(row_id)
+    except (TypeError, ValueError):
+        raise PageError("The cursor is not one this app handed out.")
+
+
+def page_size(value):
+    """The page size a request asked for, PAGE_SIZE if it didn't ask."""
+
+    if not value:
+        return PAGE_SIZE
+
+    try:
+        size = int(value)
+    except ValueError:
+        raise PageError("limit must be a number.")
+    if not 1 <= size <= MAX_PAGE_SIZE:
+        raise PageError(f"limit must be between 1 and {MAX_PAGE_SIZE}.")
+
+    return size
+
+
+def seek(query, date_column, id_column, key, cursor=None, limit=PAGE_SIZE):
+    """Return the page of query's rows after cursor, newest first, and the next page's cursor.
+
+    key gives a row's (date_created, id). One row past the page is read to
+    find out whether there is a next page; the cursor is None if there isn't."""
+
+    if cursor:
+        query = query.filter(tuple_(date_column, id_column) < tuple_(*decode_cursor(cursor)))
+
+    rows = query.order_by(desc(date_column), desc(id_column)).limit(limit + 1).all()
+    next_cursor = encode_cursor(*key(rows[limit - 1])) if len(rows) > limit else None
+
+    return rows[:limit], next_cursor
+
+
+##############################################################################
+# Pages
+
+def archived_jobs_page(user_id, cursor=None, limit=PAGE_SIZE):
+    """A page of a user's archived jobs as (job_event, todo, company) rows, as in current_job_statuses()."""
+
+    # a status row's last_activity is the date its latest event was created
+    return seek(job_statuses_query(user_id, active_status=False),
+                JobStatus.last_activity, JobStatus.job_event_id,
+                lambda row: (row[0].date_created, row[0].job_event_id),
+                cursor, limit)
+
+
+def is_latest_contact_event(user_id):
+    """Filter for the user's contact events that are the latest the user has with their contact."""
+
+    # the latest event is the one with no newer event from the same user
+    newer = aliased(ContactEvent)
+    has_newer_event = (db.session.query(newer.contact_event_id)
+                         .filter(newer.user_id == user_id,
+                                 newer.contact_id == ContactEvent.contact_id,
+                                 tuple_(newer.date_created, newer.contact_event_id)
+                                 > tuple_(ContactEvent.date_created, ContactEvent.contact_event_id))
+                         .exists())
+
+    return and_(ContactEvent.user_id == user_id, ~has_newer_event)
+
+
+def contacts_page(user_id, cursor=None, limit=PAGE_SIZE):
+    """A page of the contacts a user has events with, most recently contacted first.
+
+    Rows are (contact_event, todo) pairs: each contact's latest event, with its
+    contact and company loaded, and the event's active todo or None."""
+
+    query = (ContactEvent.query
+               .filter(is_latest_contact_event(user_id))
+               .options(db.joinedload('contacts').joinedload('companies')))
+
+    events, next_cursor = seek(query, ContactEvent.date_created, ContactEvent.contact_event_id,
+                               lambda event: (event.date_created, event.contact_event_id),
+                               cursor, limit)
+
+    # the oldest active todo of each event, for the whole page in one query
+    todos = {}
+    if events:
+        for todo in (ToDo.query
+                       .filter(ToDo.contact_event_id.in_([event.contact_event_id for event in events]),
+                               ToDo.active_status == True)
+                       .order_by(ToDo.todo_id)):
+            todos.setdefault(todo.contact_event_id, todo)
+
+    return [(event, todos.get(event.contact_event_id)) for event in events], next_cursor
+
+
+def job_events_page(user_id, job_id, cursor=None, limit=PAGE_SIZE):
+    """A page of a user's events for one job, newest first, each with its todos loaded."""
+
+    query = (JobEvent.query
+               .filter(JobEvent.user_id == user_id, JobEvent.job_id == job_id)
+               .options(db.joinedload('todos')))
+
+    return seek(query, JobEvent.date_created, JobEvent.job_event_id,
+                lambda event: (event.date_created, event.job_event_id),
+                cursor, limit)
+
+
+def contact_events_page(contact_id, cursor=None, limit=PAGE_SIZE):
+    """A page of a contact's events, newest first, each with its todos loaded."""
+
+    query = (ContactEvent.query
+               .filter(ContactEvent.contact_id == contact_id)
+               .options(db.joinedload('todos')))
+
+    return seek(query, ContactEvent.date_created, ContactEvent.contact_event_id,
+                lambda event: (event.date_created, event.contact_event_id),
+                cursor, limit)
+
+
+##############################################################################
+# JSON
+
+def todo_json(todo, codes):
+    """A todo as the event and contact lists show it, or None."""
+
+    if todo is None:
+        return None
+
+    return {'todo_id': todo.todo_id,
+            'description': codes.todo_codes[todo.todo_code].description,
+            'date_due': todo.date_due.isoformat() if todo.date_due else None,
+            'active': todo.active_status}
+
+
+def archived_job_json(row, codes):
+    """An archived jobs row as JSON."""
+
+    job_event, todo, company = row
+
+    return {'job_id': job_event.job_id,
+            'title': job_event.jobs.title,
+            'notes': job_event.jobs.notes or '',
+            'company_id': company.company_id,
+            'company_name': company.name,
+            'job_code': job_event.job_code,
+            'status': codes.job_codes[job_event.job_code],
+            'date_created': job_event.date_created.isoformat()}
+
+
+def contact_json(row, codes):
+    """A contacts row as JSON."""
+
+    contact_event, todo = row
+    contact = contact_event.contacts
+
+    return {'contact_id': contact.contact_id,
+            'fname': contact.fname,
+            'lname': contact.lname,
+            'company_id': contact.company_id,
+            'company_name': contact.companies.name if contact.companies else None,
+            'last_contacted': contact_event.date_created.isoformat(),
+            'todo': todo_json(todo, codes)}
+
+
+def job_event_json(job_event, codes):
+    """A job's event as JSON."""
+
+    return {'job_event_id': job_event.job_event_id,
+            'job_code': job_event.job_code,
+            'status': codes.job_codes[job_event.job_code],
+            'date_created': job_event.date_created.isoformat(),
+            'todo': todo_json(job_event.todos[0] if job_event.todos else None, codes)}
+
+
+def contact_event_json(contact_event, codes):
+    """A contact's event as JSON."""
+
+    return {'contact_event_id': contact_event.contact_event_id,
+            'contact_code': contact_event.contact_code,
+            'action': codes.contact_codes[contact_event.contact_code],
+            'date_created': contact_event.date_created.isoformat(),
+            'todo': todo_json(contact_event.todos[0] if contact_event.todos else None, codes)}
+
+
+def page_json(rows, next_cursor, to_json):
+    """A page as the JSON endpoints send it: its rows and the cursor for the next page."""
+
+    codes = code_registry.get_data()
+
+    return {'rows': [to_json(row, codes) for row in rows], 'next_cursor': next_cursor}
@@ -0,0 +1,207 @@
+"""Sampling profiler for live requests, writing collapsed stacks per route.
+
+A request is profiled when it carries a valid X-Profile header, or at random
+for a PROFILE_RATE fraction of traffic. While any request is being profiled a
+background thread wakes every PROFILE_INTERVAL seconds and records the stack
+of each thread serving one. Samples are summed per route and merged into
+PROFILE_DIR/<method>_<route>.collapsed, one "frame;frame;frame count" line per
+stack, the input flamegraph.pl and speedscope read:
+
+    flamegraph.pl profiles/GET_dashboard_jobs.collapsed > jobs.svg
+
+Requests that aren't profiled cost one header lookup and one comparison.
+
+    python3.6 profiler.py token     # print the X-Profile header value"""
+
+import atexit
+import fcntl
+import hashlib
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import current_app, g, request
+
+
+# the header that asks for a request to be profiled
+PROFILE_HEADER = 'X-Profile'
+
+# seconds between stack samples
+PROFILE_INTERVAL = 0.005
+
+# seconds between merging samples into the files on disk
+FLUSH_INTERVAL = 10.0
+
+
+def profile_token(secret_key):
+    """The X-Profile header value that turns profiling on, signed with the app's secret key."""
+
+    if isinstance(secret_key, str):
+        secret_key = secret_key.encode()
+
+    return hmac.new(secret_key, b'jobtracker-profile', hashlib.sha256).hexdigest()
+
+
+def collapse(frame):
+    """Render a stack as "file:function;file:function", outermost frame first."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+def profile_filename(route):
+    """A file name for a route like "GET /dashboard/jobs/<job_id>"."""
+
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') + '.collapsed'
+
+
+class Sampler(object):
+    """Samples the stacks of the threads it's told are running profiled requests."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # thread id -> route of the request it's serving
+        self.active = {}
+        # route -> Counter of collapsed stacks
+        self.samples = defaultdict(Counter)
+        self.thread = None
+        self.last_flush = time.time()
+
+    def start(self, route):
+        """Start sampling the current thread under route."""
+
+        with self.lock:
+            self.active[threading.get_ident()] = route
+            # started here, not at import, so each forked worker gets its own thread
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def stop(self):
+        """Stop sampling the current thread."""
+
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+
+    def sample(self):
+        """Record one stack for every profiled thread."""
+
+        frames = sys._current_frames()
+        with self.lock:
+            for thread_id, route in self.active.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.samples[route][collapse(frame)] += 1
+
+    def run(self):
+        """Sample while any thread is profiled, and sleep until one is otherwise."""
+
+        while True:
+            if not self.active:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            self.sample()
+            time.sleep(self.interval)
+
+    def flush(self, directory):
+        """Add the samples taken so far to the files in directory, and start counting again."""
+
+        with self.lock:
+            samples = self.samples
+            self.samples = defaultdict(Counter)
+            self.last_flush = time.time()
+
+        os.makedirs(directory, exist_ok=True)
+
+        for route, stacks in samples.items():
+            path = os.path.join(directory, profile_filename(route))
+
+            # every worker process merges into the same file, so one at a time, or
+            # the last to rename its copy would drop the others' samples; the lock
+            # is a separate file since the rename replaces the collapsed one
+            with open(f'{path}.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                # merge with what's on disk, so each stack keeps a single line
+                totals = Counter()
+                if os.path.exists(path):
+                    with open(path) as collapsed:
+                        for line in collapsed:
+                            stack, count = line.rstrip('\n').rsplit(' ', 1)
+                            totals[stack] += int(count)
+                totals.update(stacks)
+
+                # write then rename, so a reader never sees half a file
+                temporary = f'{path}.{os.getpid()}.tmp'
+                with open(temporary, 'w') as collapsed:
+                    for stack, count in sorted(totals.items()):
+                        collapsed.write(f'{stack} {count}\n')
+                os.replace(temporary, path)
+
+
+# one sampler per process
+sampler = Sampler()
+
+
+def start_profile():
+    """Start sampling the request if it asked to be profiled or was picked at random."""
+
+    config = current_app.config
+
+    token = request.headers.get(PROFILE_HEADER)
+    if token is None:
+        if not config['PROFILE_RATE'] or random.random() >= config['PROFILE_RATE']:
+            return
+    elif not hmac.compare_digest(token, profile_token(current_app.secret_key)):
+        return
+
+    route = request.url_rule.rule if request.url_rule else request.path
+    g.profiled = True
+    sampler.interval = config['PROFILE_INTERVAL']
+    sampler.start(f'{request.method} {route}')
+
+
+def stop_profile(exception):
+    """Stop sampling the request, and save samples once they've been building up for a while."""
+
+    if not g.pop('profiled', False):
+        return
+
+    sampler.stop()
+    if time.time() - sampler.last_flush >= FLUSH_INTERVAL:
+        sampler.flush(current_app.config['PROFILE_DIR'])
+
+
+def instrument_profiler(app):
+    """Profile app's requests on demand or for a fraction of traffic."""
+
+    app.config.setdefault('PROFILE_RATE', float(os.environ.get('PROFILE_RATE', 0)))
+    app.config.setdefault('PROFILE_INTERVAL', PROFILE_INTERVAL)
+    app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR', 'profiles'))
+
+    app.before_request(start_profile)
+    app.teardown_request(stop_profile)
+
+    # keep whatever was sampled since the last flush when the process exits
+    atexit.register(lambda: sampler.flush(app.config['PROFILE_DIR']) if sampler.samples else None)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['token']:
+        print(profile_token(os.environ['FLASK_SECRET_KEY']))
+    else:
+        print(__doc__)
@@ -0,0 +1,333 @@
+"""In-memory salary reference data for the job hunt app.
+
+The salaries table is a small, static data set from Glassdoor Research that
+only changes when seed.py reloads it. The salary service reads it once per
+process and answers every salary lookup from memory, checking every few
+seconds whether the table's reference version has gone up since."""
+
+import heapq
+import re
+import time
+from collections import Counter, defaultdict, namedtuple
+from threading import Lock
+from sqlalchemy import and_, case, func
+from model import Job, JobStatus, Salary, db
+from versions import reference_version
+
+
+# the metro the data set uses for country-wide figures
+NATIONAL = 'National'
+
+
+# one immutable copy of the salary table, swapped in whole on every load
+SalaryData = namedtuple('SalaryData', ['metros', 'job_titles', 'salaries', 'matcher', 'version'])
+
+# seconds a process answers from its copy before checking whether the table was reloaded
+CHECK_INTERVAL = 5
+
+# best match score a job title needs before its salary is filled in automatically
+SUGGEST_SCORE = 0.8
+
+# shorthand people type into job titles, spelled out the way salary titles are
+ABBREVIATIONS = {
+    'admin': 'administrative', 'asst': 'assistant', 'assoc': 'associate',
+    'cust': 'customer', 'dev': 'developer', 'eng': 'engineer', 'engr': 'engineer', 'hr': 'human resources',
+    'mgr': 'manager', 'mngr': 'manager', 'ops': 'operations', 'prog': 'programmer',
+    'rep': 'representative', 'svc': 'service', 'sw': 'software',
+    'swe': 'software engineer', 'sys': 'systems', 'tech': 'technician',
+}
+
+# seniority words that no salary title carries
+IGNORED_WORDS = {'sr', 'senior', 'jr', 'junior', 'lead', 'staff', 'principal',
+                 'entry', 'level', 'i', 'ii', 'iii', 'iv'}
+
+
+class SalaryService(object):
+    """Sorted metro and job title lists plus a (metro, job_title) index of salaries."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = None
+        self.version = 0
+        # the table's reference version when it was last loaded, and when that was last checked
+        self.loaded_version = None
+        self.checked = 0.0
+
+    def load(self):
+        """Read the whole salaries table into memory, replacing anything loaded before."""
+
+        loaded_version = reference_version('salaries')
+        rows = db.session.query(Salary.metro, Salary.job_title, Salary.avg_salary).all()
+
+        salaries = {(metro, job_title): avg_salary for metro, job_title, avg_salary in rows}
+        metros = tuple(sorted(set(metro for metro, job_title in salaries)))
+        job_titles = tuple(sorted(set(job_title for metro, job_title in salaries)))
+        matcher = TitleMatcher(job_titles)
+
+        with self.lock:
+            self.version += 1
+            self.data = SalaryData(metros, job_titles, salaries, matcher, self.version)
+            self.loaded_version = loaded_version
+            self.checked = time.monotonic()
+
+        return self.data
+
+    def reload(self):
+        """Load the salaries table again after it has been re-seeded."""
+
+        return self.load()
+
+    def get_data(self):
+        """Return the loaded salary data, loading it on first use and after another process reloads it."""
+
+        # two requests racing here both load, and the later copy wins
+        data = self.data
+        if data is None:
+            return self.load()
+
+        now = time.monotonic()
+        if now - self.checked >= CHECK_INTERVAL:
+            self.checked = now
+            if reference_version('salaries') != self.loaded_version:
+                data = self.load()
+
+        return data
+
+    @property
+    def metros(self):
+        """All metro areas, sorted by name."""
+
+        return self.get_data().metros
+
+    @property
+    def job_titles(self):
+        """All job titles, sorted by name."""
+
+        return self.get_data().job_titles
+
+    def get_salary(self, metro, job_title):
+        """Return the average salary for a job title in a metro area, or None."""
+
+        return self.get_data().salaries.get((metro, job_title))
+
+    def match_titles(self, title, limit=5):
+        """Return up to limit (job_title, score) pairs of salary titles closest to title."""
+
+        return self.get_data().matcher.match(title, limit)
+
+    def suggest_salary(self, title):
+        """Return (salary title, national salary) for a free-text job title, or None.
+
+        Only a match scoring at least SUGGEST_SCORE is trusted."""
+
+        matches = self.match_titles(title, limit=1)
+        if not matches or matches[0][1] < SUGGEST_SCORE:
+            return None
+
+        salary_title = matches[0][0]
+        avg_salary = self.get_salary(NATIONAL, salary_title)
+        if avg_salary is None:
+            return None
+
+        return salary_title, avg_salary
+
+
+##############################################################################
+# Job title matching
+
+def normalize_title(title):
+    """Lowercase a job title, spell out shorthand and drop seniority words."""
+
+    words = re.findall(r'[a-z0-9]+', (title or '').lower())
+    words = [ABBREVIATIONS.get(word, word) for word in words if word not in IGNORED_WORDS]
+
+    return ' '.join(words)
+
+
+def trigrams(text):
+    """Return the set of three-character pieces of a title, padded at the word edges."""
+
+    padded = f'  {text} '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class TitleMatcher(object):
+    """Character trigram index over the salary job titles.
+
+    A title's score is the Dice coefficient of its trigrams with the query's,
+    averaged with the same score for just the last word, since that word names
+    the role ("Communications Engineer" is no "Communications Manager"). Only
+    titles sharing at least one trigram with the query are scored."""
+
+    def __init__(self, job_titles):
+        self.job_titles = tuple(job_titles)
+        self.grams = []
+        self.heads = []
+        index = defaultdict(list)
+
+        for number, job_title in enumerate(self.job_titles):
+            words = normalize_title(job_title)
+            grams = trigrams(words)
+            self.grams.append(len(grams))
+            self.heads.append(frozenset(trigrams(words.split(' ')[-1])))
+            for gram in grams:
+                index[gram].append(number)
+
+        self.index = {gram: tuple(numbers) for gram, numbers in index.items()}
+
+    def match(self, title, limit=5):
+        """Return up to limit (job_title, score) pairs, best match first."""
+
+        words = normalize_title(title)
+        if not words:
+            return []
+        grams = trigrams(words)
+        head = trigrams(words.split(' ')[-1])
+
+        # count the trigrams each title shares with the query
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.index.get(gram, ()))
+
+        scores = []
+        for number, count in shared.items():
+            title_score = 2.0 * count / (len(grams) + self.grams[number])
+            head_score = 2.0 * len(head & self.heads[number]) / (len(head) + len(self.heads[number]))
+            scores.append(((title_score + head_score) / 2, number))
+
+        return [(self.job_titles[number], round(score, 3))
+                for score, number in heapq.nlargest(limit, scores)]
+
+
+def suggest_salaries():
+    """Fill in a suggested national salary for every job that has none yet.
+
+    Returns how many jobs were updated."""
+
+    print("Suggesting salaries...")
+
+    jobs = db.session.query(Job.job_id, Job.title).filter(Job.avg_salary == None).all()
+
+    updates = []
+    for job_id, title in jobs:
+        suggestion = salary_service.suggest_salary(title)
+        if suggestion:
+            salary_title, avg_salary = suggestion
+            updates.append({'job_id': job_id,
+                            'salary_title': salary_title,
+                            'avg_salary': avg_salary,
+                            'avg_salary_amount': parse_salary(avg_salary),
+                            'salary_suggested': True})
+
+    db.session.bulk_update_mappings(Job, updates)
+    db.session.commit()
+
+    return len(updates)
+
+
+# one copy of the salary data shared by every request in this process
+salary_service = SalaryService()
+
+
+##############################################################################
+# Numeric salaries
+
+def parse_salary(text):
+    """Turn a salary string like "$86,563 " into 86563, or None if it holds no number."""
+
+    if not text:
+        return None
+
+    number = re.sub(r'[^0-9.]', '', text)
+    try:
+        return int(round(float(number)))
+    except ValueError:
+        return None
+
+
+def parse_percent(text):
+    """Turn a percent string like "-0.50%" into -0.5, or None if it holds no number."""
+
+    if not text:
+        return None
+
+    try:
+        return float(text.strip().rstrip('%'))
+    except ValueError:
+        return None
+
+
+def percentiles(column):
+    """Return 25th, 50th and 75th percentile aggregates of a column."""
+
+    return [func.percentile_cont(fraction).within_group(column).label(name)
+            for fraction, name in [(0.25, 'p25'), (0.5, 'median'), (0.75, 'p75')]]
+
+
+def salary_analytics(user_id):
+    """Summarize the salary table and compare a user's jobs against national salaries.
+
+    Each part is one aggregate query over the numeric salary columns:
+    percentiles per job title across metros, percentiles per metro across job
+    titles, and each of the user's jobs next to the national salary for its
+    job title."""
+
+    # national rows are a summary of the metros, so keep them out of the spread
+    metro_amount = case([(Salary.metro != NATIONAL, Salary.avg_salary_amount)])
+    national_amount = func.max(case([(Salary.metro == NATIONAL, Salary.avg_salary_amount)]))
+
+    titles = (db.session.query(Salary.job_title,
+                               func.count(metro_amount).label('metros'),
+                               func.min(metro_amount).label('min'),
+                               *percentiles(metro_amount),
+                               func.max(metro_amount).label('max'),
+                               national_amount.label('national'))
+                .group_by(Salary.job_title)
+                .order_by(Salary.job_title)
+                .all())
+
+    metros = (db.session.query(Salary.metro,
+                               func.count(Salary.avg_salary_amount).label('job_titles'),
+                               func.min(Salary.avg_salary_amount).label('min'),
+                               *percentiles(Salary.avg_salary_amount),
+                               func.max(Salary.avg_salary_amount).label('max'),
+                               func.avg(Salary.yoy_percent).label('avg_yoy_percent'))
+                .group_by(Salary.metro)
+                .order_by(Salary.metro)
+                .all())
+
+    # jobs without a chosen salary title are compared by their own title
+    jobs = (db.session.query(Job.job_id, Job.title, Job.avg_salary_amount,
+                             Salary.job_title.label('salary_title'),
+                             Salary.avg_salary_amount.label('national'))
+              .join(JobStatus, JobStatus.job_id == Job.job_id)
+              .outerjoin(Salary, and_(Salary.metro == NATIONAL,
+                                      Salary.job_title == func.coalesce(Job.salary_title, Job.title)))
+              .filter(JobStatus.user_id == user_id)
+              .order_by(Job.job_id)
+              .all())
+
+    results = {
+        'job_titles': [row._asdict() for row in titles],
+        'metros': [row._asdict() for row in metros],
+        'jobs': [],
+    }
+
+    for job in jobs:
+        job = job._asdict()
+        if job['avg_salary_amount'] is not None and job['national']:
+            job['difference'] = job['avg_salary_amount'] - job['national']
+            job['percent_of_national'] = round(100.0 * job['avg_salary_amount'] / job['national'], 1)
+        else:
+            job['difference'] = job['percent_of_national'] = None
+        results['jobs'].append(job)
+
+    return results
+
+
+if __name__ == "__main__":
+    from server import app
+    from model import connect_to_db
+    connect_to_db(app)
+
+    print(f"Suggested salaries for {suggest_salaries()} jobs.")
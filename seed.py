@@ -1,136 +1,198 @@
-"""Utility file to seed job hunt app database from created, sample, and Glassdoor data in /data folder"""
+"""Utility file to seed job hunt app database from created, sample, and Glassdoor data in /data folder
 
+Each data file is streamed in chunks and copied into a staging table with
+COPY. The codes, salaries and users are upserted on their natural keys, so
+seeding can be run again to refresh them. The other sample files carry no ids:
+a row's line number is its id, which is how the files refer to each other, so
+they are only loaded into empty tables."""
 
-from sqlalchemy import func
+
+import os
+import sys
+import time
+from io import StringIO
+from itertools import islice
 from model import (User, Company, Contact, ContactEvent, ContactCode, JobCode, ToDoCode,
                    Salary, Job, JobEvent, connect_to_db, db)
 from server import app
+from status import rebuild_job_statuses
+from upgrade import assign_company_owners, merge_duplicate_companies
+from salaries import parse_salary, parse_percent
+from versions import bump_reference_version
 
 
-# Load sample user data to users table
-def load_users():
-    """Load users from user-example into database."""
+# lines read from a data file for each COPY
+CHUNK_SIZE = 10000
 
-    print("Loading users...")
+# where the sample users, companies, contacts and jobs are read from, unless
+# another directory is given, like one written by data/faker.py
+DATA_DIR = "data"
 
-    # Delete all rows in table to make sure there are no duplicates
-    User.query.delete()
 
-    # Read user file and insert data
-    for row in open("data/user-example.txt"):
-        row = row.rstrip()
-        fname, lname, email, password = row.split("|")
+def copy_value(value):
+    """Format one value for COPY's text format."""
 
-        user = User(fname=fname,
-                    lname=lname,
-                    email=email,
-                    password=password)
+    if value is None:
+        return '\\N'
 
-        # Add to the session or it won't ever be stored
-        db.session.add(user)
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+                      .replace('\n', '\\n').replace('\r', '\\r'))
 
-    # Once we're done, we should commit our work
-    db.session.commit()
 
+def bulk_load(model, path, columns, parse_row, key=None, separator="|"):
+    """Stream a data file into model's table, upserting it on the key columns.
 
-# load sample contact data to contacts table
-def load_contacts():
-    """Load contacts from contact-example into database."""
+    parse_row is called with each line's number (counting from 1) and its
+    split fields, and returns the values for columns. Rows already in the
+    table are updated in place, keeping their primary key. Without a key the
+    table must be empty, since its ids come from the file's line numbers.
+    Each chunk is committed as it goes."""
 
-    print("Loading contacts...")
+    table = model.__table__.name
+    stage = f"stage_{table}"
+    column_list = ", ".join(columns)
 
-    # Delete all rows in table to make sure there are no duplicates
-    Contact.query.delete()
+    if key:
+        key_positions = [columns.index(column) for column in key]
+        primary_key = [column.name for column in model.__table__.primary_key.columns]
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns
+                            if column not in key and column not in primary_key)
+        on_conflict = (f"ON CONFLICT ({', '.join(key)}) "
+                       + (f"DO UPDATE SET {updates}" if updates else "DO NOTHING"))
+    else:
+        key_positions = None
+        on_conflict = ""
 
-    # Read user file and insert data
-    for row in open("data/contact-example.txt"):
-        row = row.rstrip()
-        fname, lname, company_id = row.split("|")
+    # use one connection throughout, since the staging table only exists there
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
 
-        contact = Contact(fname=fname,
-                          lname=lname,
-                          company_id=company_id)
+    if not key:
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+        if cursor.fetchone()[0]:
+            connection.close()
+            raise RuntimeError(f"{table} already has rows, and {path} can only be loaded into an empty table.")
 
-        # Add to the session or it won't ever be stored
-        db.session.add(contact)
+    cursor.execute(f"DROP TABLE IF EXISTS {stage}")
+    cursor.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DELETE ROWS AS "
+                   f"SELECT {column_list} FROM {table} WITH NO DATA")
+    connection.commit()
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+    start = time.perf_counter()
+    total = 0
 
+    with open(path) as data_file:
+        lines = enumerate(data_file, start=1)
+        while True:
+            chunk = list(islice(lines, CHUNK_SIZE))
+            if not chunk:
+                break
 
-# load sample company data to companies table
-def load_companies():
-    """Load companies from company-example into database."""
+            # a key repeated within a chunk keeps its last row, in file order
+            rows = {}
+            for number, row in chunk:
+                values = parse_row(number, row.rstrip("\r\n").split(separator))
+                rows[tuple(values[position] for position in key_positions) if key else number] = values
 
-    print("Loading companies...")
+            buffer = StringIO()
+            for values in rows.values():
+                buffer.write("\t".join(copy_value(value) for value in values))
+                buffer.write("\n")
+            buffer.seek(0)
 
-    # Delete all rows in table to make sure there are no duplicates
-    Company.query.delete()
+            # copy the chunk in, then move it into the real table in one statement
+            cursor.copy_expert(f"COPY {stage} ({column_list}) FROM STDIN", buffer)
+            cursor.execute(f"INSERT INTO {table} ({column_list}) "
+                           f"SELECT {column_list} FROM {stage} {on_conflict}")
+            connection.commit()
+            total += len(chunk)
 
-    # Read user file and insert data
-    for row in open("data/company-example.txt"):
-        row = row.rstrip()
-        name, street, city, state, zipcode, website = row.split("|")
+    cursor.execute(f"DROP TABLE {stage}")
+    connection.commit()
+    connection.close()
 
-        company = Company(name=name,
-                          street=street,
-                          city=city,
-                          state=state,
-                          zipcode=zipcode,
-                          website=website)
+    seconds = time.perf_counter() - start
+    print(f"  {total} rows in {seconds:.2f}s ({total / seconds:.0f} rows/s)")
 
-        # Add to the session or it won't ever be stored
-        db.session.add(company)
+    return total
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+
+# Load sample user data to users table
+def load_users(data_dir=DATA_DIR):
+    """Load users from user-example into database."""
+
+    print("Loading users...")
+
+    def parse(number, row):
+        fname, lname, email, password = row
+        return number, fname, lname, email, password
+
+    bulk_load(User, os.path.join(data_dir, "user-example.txt"),
+              ["user_id", "fname", "lname", "email", "password"], parse, key=["email"])
+
+
+# load sample contact data to contacts table
+def load_contacts(data_dir=DATA_DIR):
+    """Load contacts from contact-example into database."""
+
+    print("Loading contacts...")
+
+    def parse(number, row):
+        fname, lname, company_id = row
+        return number, fname, lname, company_id
+
+    bulk_load(Contact, os.path.join(data_dir, "contact-example.txt"),
+              ["contact_id", "fname", "lname", "company_id"], parse)
+
+
+# load sample company data to companies table
+def load_companies(data_dir=DATA_DIR):
+    """Load companies from company-example into database."""
+
+    print("Loading companies...")
+
+    def parse(number, row):
+        name, street, city, state, zipcode, website = row
+        return number, name, street, city, state, zipcode, website
+
+    bulk_load(Company, os.path.join(data_dir, "company-example.txt"),
+              ["company_id", "name", "street", "city", "state", "zipcode", "website"],
+              parse)
 
 
 # load contact codes (real data!)
 def load_contactcodes():
-    """Load contact codes from contact-codes.txt into database."""
+    """Load contact codes, and the todo each one starts, from contact-codes.txt into database."""
 
     print("Loading contact codes...")
 
-    # Delete all rows in table to make sure there are no duplicates
-    ContactCode.query.delete()
+    def parse(number, row):
+        contact_code, description, todo_code = row
+        return contact_code, description, todo_code
 
-    # Read user file and insert data
-    for row in open("data/contact-codes.txt"):
-        row = row.rstrip()
-        contact_code, description = row.split("|")
+    bulk_load(ContactCode, "data/contact-codes.txt",
+              ["contact_code", "description", "todo_code"], parse, key=["contact_code"])
 
-        contactcode = ContactCode(contact_code=contact_code,
-                                  description=description)
-
-        # Add to the session or it won't ever be stored
-        db.session.add(contactcode)
-
-    # Once we're done, we should commit our work
+    # running servers load the new codes on their next check
+    bump_reference_version('codes')
     db.session.commit()
 
 
 # load job codes (real data!)
 def load_jobcodes():
-    """Load job codes from job-codes.txt into database."""
+    """Load job codes, and the todo each one starts, from job-codes.txt into database."""
 
     print("Loading job codes...")
 
-    # Delete all rows in table to make sure there are no duplicates
-    JobCode.query.delete()
-
-    # Read user file and insert data
-    for row in open("data/job-codes.txt"):
-        row = row.rstrip()
-        job_code, description = row.split("|")
-
-        jobcode = JobCode(job_code=job_code,
-                          description=description)
+    def parse(number, row):
+        job_code, description, todo_code = row
+        return job_code, description, todo_code
 
-        # Add to the session or it won't ever be stored
-        db.session.add(jobcode)
+    bulk_load(JobCode, "data/job-codes.txt",
+              ["job_code", "description", "todo_code"], parse, key=["job_code"])
 
-    # Once we're done, we should commit our work
+    # running servers load the new codes on their next check
+    bump_reference_version('codes')
     db.session.commit()
 
 
@@ -140,22 +202,15 @@ def load_todocodes():
 
     print("Loading todo codes...")
 
-    # Delete all rows in table to make sure there are no duplicates
-    ToDoCode.query.delete()
+    def parse(number, row):
+        todo_code, description, sugg_due_date = row
+        return todo_code, description, sugg_due_date
 
-    # Read file and insert data
-    for row in open("data/todo-codes.txt"):
-        row = row.rstrip()
-        todo_code, description, sugg_due_date = row.split("|")
+    bulk_load(ToDoCode, "data/todo-codes.txt",
+              ["todo_code", "description", "sugg_due_date"], parse, key=["todo_code"])
 
-        todocode = ToDoCode(todo_code=todo_code,
-                            description=description,
-                            sugg_due_date=sugg_due_date)
-
-        # Add to the session or it won't ever be stored
-        db.session.add(todocode)
-
-    # Once we're done, we should commit our work
+    # running servers load the new codes on their next check
+    bump_reference_version('codes')
     db.session.commit()
 
 
@@ -165,114 +220,95 @@ def load_salaries():
 
     print("Loading salaries...")
 
-    # Delete all rows in table to make sure there are no dupes
-    Salary.query.delete()
-
-    # Read file and insert data
-    for row in open("data/salaries-data.tsv"):
-        row = row.rstrip()
-        metro, job_title, avg_salary, yoy_salary = row.split("\t")
-
-        salary = Salary(metro=metro,
-                        job_title=job_title,
-                        avg_salary=avg_salary,
-                        yoy_salary=yoy_salary)
+    # parse the salary strings into numbers once, here
+    def parse(number, row):
+        metro, job_title, avg_salary, yoy_salary = row
+        return (metro, job_title, avg_salary, yoy_salary,
+                parse_salary(avg_salary), parse_percent(yoy_salary))
 
-        # Add to the session
-        db.session.add(salary)
+    bulk_load(Salary, "data/salaries-data.tsv",
+              ["metro", "job_title", "avg_salary", "yoy_salary", "avg_salary_amount", "yoy_percent"],
+              parse, key=["metro", "job_title"], separator="\t")
 
-    # commit the session to database
+    # running servers load the new rows on their next check
+    bump_reference_version('salaries')
     db.session.commit()
 
 
 # load jobs
-def load_jobs():
+def load_jobs(data_dir=DATA_DIR):
     """Load fake sample job data from job-example.txt into database"""
 
     print("Loading jobs...")
 
-    # Delete all rows in table to make sure there are no dupes
-    Job.query.delete()
+    def parse(number, row):
+        title, link, company_id, active_status, notes = row
+        return number, title, link, company_id, active_status == "True", notes
 
-    # Read file and insert data
-    for row in open("data/job-example.txt"):
-        row = row.rstrip()
-        title, link, company_id, active_status, notes = row.split("|")
-
-        job = Job(title=title, link=link, company_id=company_id,
-                  active_status=bool(active_status), notes=notes)
-
-        # Add to the session
-        db.session.add(job)
-
-    # commit the session to database
-    db.session.commit()
+    bulk_load(Job, os.path.join(data_dir, "job-example.txt"),
+              ["job_id", "title", "link", "company_id", "active_status", "notes"],
+              parse)
 
 
 # load job events
-def load_jobevents():
+def load_jobevents(data_dir=DATA_DIR):
     """Load fake sample job event data from job-event-example.txt into database"""
 
     print("Loading job events...")
 
-    # Delete all rows in table to make sure there are no dupes
-    JobEvent.query.delete()
+    def parse(number, row):
+        job_id, user_id, job_code, date_created = row
+        return number, job_id, user_id, job_code, date_created
 
-    # Read file and insert data
-    for row in open("data/job-event-example.txt"):
-        row = row.rstrip()
-        job_id, user_id, job_code, date_created = row.split("|")
-
-        job_event = JobEvent(job_id=job_id,
-                             user_id=user_id,
-                             job_code=job_code,
-                             date_created=date_created)
-
-        # Add to the session
-        db.session.add(job_event)
-
-    # commit the session to database
-    db.session.commit()
+    bulk_load(JobEvent, os.path.join(data_dir, "job-event-example.txt"),
+              ["job_event_id", "job_id", "user_id", "job_code", "date_created"],
+              parse)
 
 
 # load contact events
-def load_contactevents():
+def load_contactevents(data_dir=DATA_DIR):
     """Load fake sample contact event data from contact-event-examples.txt into database"""
 
     print("Loading contact events...")
 
-    # Delete all rows in table to make sure there are no dupes
-    ContactEvent.query.delete()
+    def parse(number, row):
+        user_id, contact_id, contact_code, date_created = row
+        return number, user_id, contact_id, contact_code, date_created
 
-    # Read file and insert data
-    for row in open("data/contact-event-examples.txt"):
-        row = row.rstrip()
-        user_id, contact_id, contact_code, date_created = row.split("|")
+    bulk_load(ContactEvent, os.path.join(data_dir, "contact-event-examples.txt"),
+              ["contact_event_id", "user_id", "contact_id", "contact_code", "date_created"],
+              parse)
 
-        contact_event = ContactEvent(user_id=user_id,
-                                     contact_id=contact_id,
-                                     contact_code=contact_code,
-                                     date_created=date_created)
 
-        # Add to the session
-        db.session.add(contact_event)
+##############################################################################
+# Helper functions
+def sample_data_loaded():
+    """Return whether any table whose sample ids are line numbers already has rows."""
 
-    # commit the session to database
-    db.session.commit()
+    return any(db.session.query(model.query.exists()).scalar()
+               for model in (Company, Contact, ContactEvent, Job, JobEvent))
 
 
-##############################################################################
-# Helper functions
-def set_val_user_id():
-    """Set value for the next user_id after seeding database"""
+def set_sequences():
+    """Set the next id of every table's id sequence past the largest id loaded."""
+
+    print("Setting id sequences...")
+
+    for table in db.metadata.sorted_tables:
+        primary_key = list(table.primary_key.columns)
+        if len(primary_key) != 1:
+            continue
+        column = primary_key[0].name
+
+        sequence = db.session.execute("SELECT pg_get_serial_sequence(:table, :column)",
+                                      {'table': table.name, 'column': column}).scalar()
+        if not sequence:
+            continue
 
-    # Get the Max user_id in the database
-    result = db.session.query(func.max(User.user_id)).one()
-    max_id = int(result[0])
+        # the next id handed out will be max_id + 1
+        db.session.execute(f"SELECT setval(:sequence, COALESCE(MAX({column}), 0) + 1, false) "
+                           f"FROM {table.name}", {'sequence': sequence})
 
-    # Set the value for the next user_id to be max_id + 1
-    query = "SELECT setval('users_user_id_seq', :new_id)"
-    db.session.execute(query, {'new_id': max_id + 1})
     db.session.commit()
 
 
@@ -283,18 +319,29 @@ if __name__ == "__main__":
     db.create_all()
 
     # Import different types of data
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else DATA_DIR
 
     load_salaries()
+    # job and contact codes point at the todo codes
+    load_todocodes()
     load_contactcodes()
     load_jobcodes()
-    load_todocodes()
 
-    load_users()
-    load_companies()
-    load_contacts()
-    load_contactevents()
+    # the sample files refer to each other by line number, so they only go into an empty database
+    if sample_data_loaded():
+        print("Sample data is already loaded; only the codes and salaries were refreshed.")
+        sys.exit(0)
+
+    load_users(data_dir)
+    load_companies(data_dir)
+    load_contacts(data_dir)
+    load_contactevents(data_dir)
 
-    load_jobs()
-    load_jobevents()
+    load_jobs(data_dir)
+    load_jobevents(data_dir)
+    set_sequences()
 
-    set_val_user_id()
+    # the files share companies between users, and name some more than once
+    assign_company_owners()
+    merge_duplicate_companies()
+    rebuild_job_statuses()
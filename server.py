@@ -1,14 +1,31 @@
 """Job Hunt app server"""
 
 from jinja2 import StrictUndefined
-from flask import (Flask, render_template, redirect, request, flash, session, jsonify, url_for)
+from flask import (Flask, Response, render_template, redirect, request, flash, session, jsonify, url_for)
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy import desc
-from model import (User, Contact, ContactEvent, Company, Job, JobEvent, ToDo,
-                   ToDoCode, Salary, connect_to_db, db)
+from sqlalchemy import and_, desc
+from model import (User, Contact, ContactEvent, Company, Job, JobEvent, JobStatus, ToDo,
+                   connect_to_db, db)
+from cache import company_cache
+from fragments import FragmentCacheExtension
+from codes import LAST_ACTIVE_JOB_CODE, code_registry
+from importer import ImportFormatError, import_jobs, normalize_link, read_rows
+from pages import (PageError, archived_job_json, archived_jobs_page, contact_event_json,
+                   contact_events_page, contact_json, contacts_page, job_event_json, job_events_page,
+                   page_json, page_size)
+from status import MAX_TRANSITIONS, change_job_statuses, current_job_statuses, record_job_status
+from salaries import salary_service, parse_salary, salary_analytics
+from instrument import instrument_sql, sql_budget
+from metrics import instrument_metrics, registry, track_cache
+from profiler import instrument_profiler
+from memtrace import instrument_memory
+from versions import (bump_data_version, bump_reference_version, conditional_on_data_version,
+                      current_data_version)
+import api
 from datetime import datetime
 from datetime import timedelta
 import os
+import logging
 import google.oauth2.credentials
 import google_auth_oauthlib.flow
 from googleapiclient.discovery import build
@@ -21,6 +38,36 @@ app.secret_key = os.environ['FLASK_SECRET_KEY']
 # If an undefined variable is used, Jinja2 will raise an error
 app.jinja_env.undefined = StrictUndefined
 
+# {% cache %} blocks reuse their HTML until one of their keys changes
+app.jinja_env.add_extension(FragmentCacheExtension)
+fragment_cache = app.jinja_env.fragment_cache
+
+# the company dropdowns in base.html are only filled in when their fragment isn't cached
+app.jinja_env.globals.update(dropdown_companies=company_cache.get,
+                             user_data_version=current_data_version)
+
+# every template can look up code descriptions without a query
+@app.context_processor
+def inject_codes():
+    """Make the code tables available to templates as codes."""
+
+    return {'codes': code_registry.get_data()}
+
+
+# count each request's SQL and flag N+1 query patterns
+instrument_sql(app)
+
+# keep request, pool and cache metrics for the /metrics route
+instrument_metrics(app, db)
+track_cache('companies', company_cache)
+track_cache('fragments', fragment_cache)
+
+# sample stacks of requests sent with an X-Profile header, or of PROFILE_RATE of traffic
+instrument_profiler(app)
+
+# with MEMTRACE set, log each request's peak memory and where it was allocated
+instrument_memory(app)
+
 # This variable specifies the name of a file that contains the OAuth 2.0
 # information for this application, including its client_id and client_secret.
 CLIENT_SECRETS_FILE = 'client_secret.json'
@@ -123,6 +170,7 @@ def logout():
 # JOBS
 #################################################################################
 @app.route('/dashboard/jobs')
+@conditional_on_data_version
 def show_active_jobs():
     """Shows list jobs the user is interested in, applied to, or interviewing for."""
 
@@ -130,32 +178,13 @@ def show_active_jobs():
     if not session:
         return redirect('/')
     else:
-        # get user_id from session and pass in companies
+        # get user_id from session
         user_id = session['user_id']
-        user = User.query.filter(User.user_id == user_id).one()
-        companies = user.companies
-
-        # query for user job events, return list
-        user_job_events = JobEvent.query.options(db.joinedload('jobs')).filter(JobEvent.user_id == user_id).order_by(desc('date_created')).all()
-        job_event_ids = [event.job_event_id for event in user_job_events]
 
-        # make a set of all job_ids and remove any that are inactive
-        user_job_ids = set(job.job_id for job in user_job_events if job.jobs.active_status == True)
+        # latest event, active todo and company for each active job
+        all_active_status = current_job_statuses(user_id)
 
-        # grab only the most recent events and todos for each job_id
-        all_active_status = []
-        all_todos = []
-        for user_job_id in user_job_ids:
-            # get all events for one job id
-            events = [event for event in user_job_events if event.job_id == user_job_id]
-            # find that latest event and add to list
-            status = events[0]
-            all_active_status.append(status)
-            user_todo = ToDo.query.filter(ToDo.job_event_id == status.job_event_id, ToDo.active_status == True).first()
-            if user_todo:
-                all_todos.append(user_todo)
-
-        return render_template('jobs-active.html', all_active_status=all_active_status, all_todos=all_todos, companies=companies)
+        return render_template('jobs-active.html', all_active_status=all_active_status)
 
 
 @app.route('/dashboard/job-status', methods=['POST'])
@@ -171,41 +200,77 @@ def update_job_status():
         job_code = request.form['job_code']
         user_id = session['user_id']
 
-        last_job_event = JobEvent.query.filter(JobEvent.job_id == job_id).order_by(desc('date_created')).first()
-        last_todo = ToDo.query.filter(ToDo.job_event_id == last_job_event.job_event_id).first()
-        last_todo.active_status = False
-        db.session.commit()
+        # everything below is one transaction, committed once at the end
+
+        # close the todo of the job's last event, in one statement
+        last_job_event_id = (db.session.query(JobEvent.job_event_id)
+                               .filter(JobEvent.job_id == job_id)
+                               .order_by(desc('date_created'))
+                               .limit(1)
+                               .subquery())
+        ToDo.query.filter(ToDo.job_event_id.in_(last_job_event_id)).update(
+            {'active_status': False}, synchronize_session=False)
 
         # create job event
         today = datetime.now()
         job_event = JobEvent(user_id=user_id, job_id=job_id, job_code=job_code, date_created=today)
         db.session.add(job_event)
 
-        todo_for_event = {'1': '1', '2': '2', '3': '3', '4': '3', '5': '4', '6': '5', '7': '6', '8': '7'}
-        todo_code = todo_for_event[job_code]
-        find_code = ToDoCode.query.filter(ToDoCode.todo_code == todo_code).first()
-        num_days = find_code.sugg_due_date
-        due_date = today + timedelta(days=num_days)
-
-        # activate todo for event
-        new_todo = ToDo(job_event_id=job_event.job_event_id,
-                        todo_code=todo_code,
-                        date_created=today,
-                        date_due=due_date,
-                        active_status=True)
-        db.session.add(new_todo)
-
-        # find job in database and archive if necessary
-        job = Job.query.filter(Job.job_id == job_id).first()
-        if int(job_code) > 5:
-            job.active_status = False
-
+        # the todo this event starts, and when it's due, from the code tables
+        new_todo = None
+        todo = code_registry.todo_for_job(job_code)
+        if todo:
+            todo_code, num_days = todo
+
+            # activate todo for event; the flush fills in the event's id
+            new_todo = ToDo(job_events=job_event,
+                            todo_code=todo_code,
+                            date_created=today,
+                            date_due=today + timedelta(days=num_days),
+                            active_status=True)
+            db.session.add(new_todo)
+
+        # archive the job if necessary, without loading it
+        if int(job_code) > LAST_ACTIVE_JOB_CODE:
+            Job.query.filter(Job.job_id == job_id).update({'active_status': False},
+                                                          synchronize_session=False)
+
+        # move the job's current status to the new event
+        record_job_status(job_event, new_todo)
+        bump_data_version(user_id)
         db.session.commit()
 
         return redirect('/dashboard/jobs')
 
 
+@app.route('/dashboard/jobs/status', methods=['POST'])
+def update_job_statuses():
+    """Move many jobs to new statuses at once, from a JSON list of job_id and job_code pairs."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        user_id = session['user_id']
+
+        # {"transitions": [{"job_id": 1, "job_code": 3}, ...]}
+        body = request.get_json(silent=True)
+        transitions = body.get('transitions') if isinstance(body, dict) else None
+        if not isinstance(transitions, list):
+            return jsonify({'error': 'Send {"transitions": [{"job_id": ..., "job_code": ...}, ...]}.'}), 400
+        if len(transitions) > MAX_TRANSITIONS:
+            return jsonify({'error': f'Send at most {MAX_TRANSITIONS} transitions at a time.'}), 400
+
+        # every change is one transaction
+        summary = change_job_statuses(user_id, transitions)
+        bump_data_version(user_id)
+        db.session.commit()
+
+        return jsonify(summary)
+
+
 @app.route('/dashboard/jobs/archived')
+@conditional_on_data_version
 def show_archived_jobs():
     """ Shows a list of archived jobs the user is no longer tracking."""
 
@@ -215,33 +280,32 @@ def show_archived_jobs():
     else:
         # get user_id from session
         user_id = session['user_id']
-        user = User.query.filter(User.user_id == user_id).one()
-        companies = user.companies
 
-        # query for user job events, return list
-        user_job_events = JobEvent.query.options(db.joinedload('jobs')).filter(JobEvent.user_id == user_id).order_by(desc('date_created')).all()
+        # latest event and company for the newest archived jobs; the page fetches the rest
+        all_archived, next_cursor = archived_jobs_page(user_id)
 
-        # make a set of all job_ids and remove any that are inactive
-        user_job_ids = set(job.job_id for job in user_job_events
-                           if job.jobs.active_status == False)
+        return render_template('jobs-archive.html',
+                               all_archived=all_archived,
+                               next_cursor=next_cursor)
 
-        # grab only the most recent events for each job_id
-        all_archived = {}
-        for user_job_id in user_job_ids:
 
-            # get all events for one job id
-            events = [event for event in user_job_events
-                      if event.job_id == user_job_id]
+@app.route('/dashboard/jobs/archived/page')
+def show_archived_jobs_page():
+    """Return a page of archived jobs as JSON, after the cursor the previous page ended with."""
 
-            # find that latest event and add to list
-            status = events[0]
-            company = Company.query.filter(
-                Company.company_id == status.jobs.company_id).first()
-            all_archived[status] = company
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        user_id = session['user_id']
 
-        return render_template('jobs-archive.html',
-                               all_archived=all_archived,
-                               companies=companies)
+        try:
+            rows, next_cursor = archived_jobs_page(user_id, request.args.get('cursor'),
+                                                   page_size(request.args.get('limit')))
+        except PageError as error:
+            return jsonify({'error': str(error)}), 400
+
+        return jsonify(page_json(rows, next_cursor, archived_job_json))
 
 
 @app.route('/dashboard/jobs/<job_id>')
@@ -253,25 +317,21 @@ def show_a_job(job_id):
         return redirect('/')
     else:
         user_id = session['user_id']
-        user = User.query.filter(User.user_id == user_id).one()
-        companies = user.companies
 
         # get job from database and pre-load company data
         job = Job.query.filter(Job.job_id == job_id).options(db.joinedload('companies')).first()
 
-        # query for user job events, return list
-        # Look at created a db.relationship from users to jobs
-        job_status = JobEvent.query.options(db.joinedload('todos')).filter(JobEvent.user_id == user_id, JobEvent.job_id == job_id).order_by(desc('date_created')).order_by(desc('job_code')).all()
+        # the newest page of the user's events for the job, with their todos
+        job_status, next_cursor = job_events_page(user_id, job_id)
 
-        # query for associated tasks, return list
-        all_todos = []
-        for status in job_status:
-            todo = ToDo.query.filter(ToDo.job_event_id == status.job_event_id).options(db.joinedload('todo_codes')).first()
-            all_todos.append(todo)
+        # each event's task came with it, so no query per event
+        all_todos = [status.todos[0] for status in job_status if status.todos]
 
-        if not job.avg_salary:
-            metros = db.session.query(Salary.metro).group_by(Salary.metro).order_by(Salary.metro).all()
-            job_titles = db.session.query(Salary.job_title).group_by(Salary.job_title).order_by(Salary.job_title).all()
+        # the salary menus are cached by the version of the data they list
+        salaries = salary_service.get_data()
+        if not job.avg_salary or job.salary_suggested:
+            metros = salaries.metros
+            job_titles = salaries.job_titles
         else:
             metros = ""
             job_titles = ""
@@ -280,9 +340,29 @@ def show_a_job(job_id):
                                job=job,
                                metros=metros,
                                job_titles=job_titles,
+                               salary_version=salaries.version,
                                job_status=job_status,
                                all_todos=all_todos,
-                               companies=companies)
+                               next_cursor=next_cursor)
+
+
+@app.route('/dashboard/jobs/<job_id>/events')
+def show_job_events_page(job_id):
+    """Return a page of a job's events as JSON, after the cursor the previous page ended with."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        user_id = session['user_id']
+
+        try:
+            rows, next_cursor = job_events_page(user_id, job_id, request.args.get('cursor'),
+                                                page_size(request.args.get('limit')))
+        except PageError as error:
+            return jsonify({'error': str(error)}), 400
+
+        return jsonify(page_json(rows, next_cursor, job_event_json))
 
 
 @app.route('/dashboard/jobs/edit', methods=['POST'])
@@ -307,8 +387,12 @@ def edit_a_job():
         # get job from database, update, commit to db
         job = Job.query.filter(Job.job_id == job_id).first()
         job.link = link
-        job.avg_salary = avg_salary
+        if avg_salary != job.avg_salary:
+            job.avg_salary = avg_salary
+            job.avg_salary_amount = parse_salary(avg_salary)
+            job.salary_suggested = False
         job.notes = notes
+        bump_data_version(session['user_id'])
         db.session.commit()
 
         results = {
@@ -333,12 +417,16 @@ def get_salary():
         job_title = request.form['job_title']
         job_id = request.form['job_id']
 
-        salary = Salary.query.filter(
-            Salary.metro == metro,
-            Salary.job_title == job_title).one()
+        avg_salary = salary_service.get_salary(metro, job_title)
+        if avg_salary is None:
+            return 'No salary found for that job title and metro area.', 404
 
         job = Job.query.filter(Job.job_id == job_id).first()
-        job.avg_salary = salary.avg_salary
+        job.avg_salary = avg_salary
+        job.avg_salary_amount = parse_salary(avg_salary)
+        job.salary_title = job_title
+        job.salary_suggested = False
+        bump_data_version(session['user_id'])
 
         db.session.commit()
 
@@ -361,64 +449,146 @@ def process_job_form():
         job_status = request.form['job_status']
 
         # look for optional data and add if it exists
-        if request.form['job_link']:
-            job_link = request.form['job_link']
-            if not job_link:
-                job_link = None
-            elif job_link[:4] != 'http':
-                job_link = ''.join(['http://', job_link])
-        else:
-            job_link = ""
+        job_link = normalize_link(request.form['job_link'])
 
         if request.form['job_notes']:
             job_notes = request.form['job_notes']
         else:
             job_notes = ""
 
-        # look for company_id and find existing company
-        # or get new company_name and create company object, add, commit
+        # everything below is one transaction, committed once at the end
+
+        # use the chosen company, or find or create one by name
         if request.form['company_id']:
-            company_id = int(request.form['company_id'])
-            company = Company.query.filter(Company.company_id == company_id).first()
+            company_id = Company.owned_id(user_id, int(request.form['company_id']))
+            if company_id is None:
+                return 'No such company.', 404
         elif request.form['company_name']:
-            company_name = request.form['company_name']
-            company = Company(name=company_name)
-            db.session.add(company)
-            db.session.commit()
+            company_id = Company.get_or_create_id(user_id, request.form['company_name'])
 
-        # create a new job object, add, commit
-        job = Job(title=job_title, link=job_link, company_id=company.company_id,
+        # create a new job object and add it
+        job = Job(title=job_title, link=job_link, company_id=company_id,
                   active_status=True, notes=job_notes)
+
+        # suggest a national salary from the closest salary job title, which the
+        # user can still replace with one for their metro area
+        suggestion = salary_service.suggest_salary(job_title)
+        if suggestion:
+            job.salary_title, job.avg_salary = suggestion
+            job.avg_salary_amount = parse_salary(job.avg_salary)
+            job.salary_suggested = True
         db.session.add(job)
-        db.session.commit()
 
-        # create a job event to kick off job status, add, commit
+        # create a job event to kick off job status; the flush fills in the job's id
         today = datetime.now()
-        job_event = JobEvent(user_id=user_id, job_id=job.job_id,
+        job_event = JobEvent(user_id=user_id, jobs=job,
                              job_code=job_status, date_created=today)
         db.session.add(job_event)
-        db.session.commit()
 
-        todo_for_event = {'1': '1', '2': '2', '3': '3', '4': '3', '5': '4', '6': '5', '7': '6', '8': '7'}
-        todo_code = todo_for_event[job_status]
-        find_code = ToDoCode.query.filter(ToDoCode.todo_code == todo_code).first()
-        num_days = find_code.sugg_due_date
-        due_date = today + timedelta(days=num_days)
-
-        # activate todo for event
-        new_todo = ToDo(job_event_id=job_event.job_event_id,
-                        todo_code=todo_code,
-                        date_created=today,
-                        date_due=due_date,
-                        active_status=True)
-        db.session.add(new_todo)
+        # the todo this event starts, and when it's due, from the code tables
+        new_todo = None
+        todo = code_registry.todo_for_job(job_status)
+        if todo:
+            todo_code, num_days = todo
+
+            # activate todo for event
+            new_todo = ToDo(job_events=job_event,
+                            todo_code=todo_code,
+                            date_created=today,
+                            date_due=today + timedelta(days=num_days),
+                            active_status=True)
+            db.session.add(new_todo)
+
+        # start the job's current status at this event
+        record_job_status(job_event, new_todo)
+        bump_data_version(user_id)
         db.session.commit()
 
+        # the job may link the user to a new company
+        company_cache.invalidate(user_id)
+
         # return to active jobs and show confirmation
         flash('{} added to your jobs.'.format(job_title), 'success')
         return redirect('/dashboard/jobs')
 
 
+@app.route('/dashboard/jobs/import', methods=['POST'])
+@sql_budget(None, repeats=False)
+def import_job_file():
+    """Add jobs from an uploaded CSV or JSON file and report on every row."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        user_id = session['user_id']
+
+        # a file field from a form, or the file as the request body
+        upload = request.files.get('file')
+        if upload:
+            rows = read_rows(upload.stream, upload.filename, upload.mimetype)
+        else:
+            rows = read_rows(request.stream, content_type=request.mimetype)
+
+        # the whole file is one transaction, so a file that can't be read adds nothing
+        try:
+            report = import_jobs(user_id, rows)
+        except ImportFormatError as error:
+            db.session.rollback()
+            return jsonify({'error': str(error)}), 400
+        bump_data_version(user_id)
+        db.session.commit()
+
+        # the jobs may link the user to new companies
+        company_cache.invalidate(user_id)
+
+        return jsonify(report)
+
+
+@app.route('/dashboard/jobs/salary/titles')
+def match_salary_titles():
+    """Suggest the salary job titles closest to a free-text job title."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        title = request.args.get('title', '')
+        matches = salary_service.match_titles(title)
+
+        return jsonify([{'job_title': job_title, 'score': score} for job_title, score in matches])
+
+
+@app.route('/dashboard/jobs/salary/analytics')
+def show_salary_analytics():
+    """Salary spread per job title and metro, and how the user's jobs compare nationally."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        return jsonify(salary_analytics(session['user_id']))
+
+
+@app.route('/dashboard/jobs/salary/reload', methods=['POST'])
+def reload_salaries():
+    """Reload the in-memory salary data after the salaries table is re-seeded, in every worker."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        if not db.session.query(User.is_admin).filter(User.user_id == session['user_id']).scalar():
+            return jsonify({'error': 'Only an admin can reload salaries.'}), 403
+
+        # the other workers see the new version within salaries.CHECK_INTERVAL seconds
+        bump_reference_version('salaries')
+        db.session.commit()
+        data = salary_service.reload()
+
+        return jsonify({'salaries': len(data.salaries), 'version': data.version})
+
+
 # TO DO ITEMS & GOOGLE CALENDAR EVENTS
 #################################################################################
 @app.route('/dashboard/archive-task', methods=['POST'])
@@ -435,6 +605,7 @@ def archive_task():
         # find todo in database and change status
         todo = ToDo.query.filter(ToDo.todo_id == todo_id).first()
         todo.active_status = False
+        bump_data_version(session['user_id'])
         db.session.commit()
 
     return 'Task archived!'
@@ -454,7 +625,7 @@ def add_calendar_event():
         todo_id = request.form['todo_id']
         todo = ToDo.query.filter(ToDo.todo_id == todo_id).first()
 
-        todo_description = todo.todo_codes.description
+        todo_description = code_registry.get_data().todo_codes[todo.todo_code].description
         job_event = JobEvent.query.filter(JobEvent.job_event_id == todo.job_event_id).first()
         job_name = job_event.jobs.title
         todo_summary = '{}: {}'.format(job_name, todo_description)
@@ -528,7 +699,16 @@ def oauth2callback():
 
 # COMPANIES
 ################################################################################
+# the choices of the company form's state menu
+STATES = ["", "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DC", "DE", "FL", "GA",
+          "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD",
+          "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ",
+          "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC",
+          "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"]
+
+
 @app.route('/dashboard/companies')
+@conditional_on_data_version
 def show_all_companies():
     """Show all companies a user has interest in."""
 
@@ -538,13 +718,15 @@ def show_all_companies():
     else:
         # get user_id from session
         user_id = session['user_id']
-        user = User.query.filter(User.user_id == user_id).one()
-        user_companies = user.companies
 
-        companies = {}
-        for company in user_companies:
-            count = Job.query.filter(Job.company_id == company.company_id).count()
-            companies[company] = count
+        # count each company's jobs in the same query that finds the user's companies
+        companies = dict(db.session.query(Company, db.func.count(JobStatus.job_id))
+                           .outerjoin(Job, Job.company_id == Company.company_id)
+                           .outerjoin(JobStatus, and_(JobStatus.job_id == Job.job_id,
+                                                      JobStatus.user_id == user_id))
+                           .filter(Company.company_id.in_(User.company_ids(user_id)))
+                           .group_by(Company.company_id)
+                           .all())
 
         return render_template('companies.html', companies=companies)
 
@@ -559,28 +741,20 @@ def show_a_company(company_id):
     else:
         edit = request.args.get('edit')
 
-        # get user_id from session
-        user_id = session['user_id']
-        user = User.query.filter(User.user_id == user_id).one()
-        companies = user.companies
-
-        #get company info and pre-load jobs
-        company = Company.query.filter(Company.company_id == company_id).options(db.joinedload('jobs')).options(db.joinedload('contacts')).first()
+        # get company info and pre-load jobs and contacts, each in its own query,
+        # since joining both multiplies every job by every contact
+        company = Company.query.filter(Company.company_id == company_id, Company.owner_user_id == session['user_id']).options(db.selectinload('jobs')).options(db.selectinload('contacts')).first()
+        # another user's company, with their address and notes, is not shown
+        if company is None:
+            return 'No such company.', 404
         # get list of active jobs and of arcived jobs
         active_jobs = [job for job in company.jobs if job.active_status]
         archived_jobs = [job for job in company.jobs if not job.active_status]
 
-        states = ["", "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DC", "DE", "FL", "GA",
-                  "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD",
-                  "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ",
-                  "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC",
-                  "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"]
-
         return render_template('company-info.html',
                                company=company,
                                edit=edit,
-                               states=states,
-                               companies=companies,
+                               states=STATES,
                                active_jobs=active_jobs,
                                archived_jobs=archived_jobs)
 
@@ -593,9 +767,12 @@ def edit_a_company():
     if not session:
         return redirect('/')
     else:
-        # get company object to update
+        # get company object to update, which only its owner may
         company_id = request.form['company_id']
-        company = Company.query.filter(Company.company_id == company_id).first()
+        company = Company.query.filter(Company.company_id == company_id,
+                                       Company.owner_user_id == session['user_id']).first()
+        if company is None:
+            return 'No such company.', 404
 
         company.street = request.form['street']
         company.city = request.form['city']
@@ -611,6 +788,7 @@ def edit_a_company():
             website = ''.join(['http://', website])
         company.website = website
 
+        bump_data_version(session['user_id'])
         db.session.commit()
 
         # send results back to webpage
@@ -629,6 +807,7 @@ def edit_a_company():
 # CONTACTS
 #################################################################################
 @app.route('/dashboard/contacts')
+@conditional_on_data_version
 def show_all_contacts():
     """Show all contacts a user is connected to."""
 
@@ -638,29 +817,30 @@ def show_all_contacts():
     else:
         # get user
         user_id = session['user_id']
-        user = User.query.filter(User.user_id == user_id).one()
-        companies = user.companies
 
-        # get all user events with all contacts
-        contact_events = ContactEvent.query.filter(ContactEvent.user_id == user_id).order_by(desc('date_created')).all()
+        # the most recently contacted page of contacts, each with its latest event's task
+        contacts, next_cursor = contacts_page(user_id)
+
+        return render_template('contacts.html', contacts=contacts, next_cursor=next_cursor)
 
-        # make a set of all contact_ids
-        contact_ids = set(contact_event.contact_id for contact_event in contact_events)
 
-        # grab all contact objects by contact_id
-        contacts = []
-        all_todos = []
-        for contact_id in contact_ids:
-            contact = Contact.query.filter(Contact.contact_id == contact_id).options(db.joinedload('companies')).first()
-            contacts.append(contact)
-            # get all contact events for the contact
-            events = [event for event in contact_events if event.contact_id == contact.contact_id]
-            latest_event = events[0]
-            user_todo = ToDo.query.filter(ToDo.contact_event_id == latest_event.contact_event_id, ToDo.active_status ==True).first()
-            if user_todo:
-                all_todos.append(user_todo)
+@app.route('/dashboard/contacts/page')
+def show_contacts_page():
+    """Return a page of contacts as JSON, after the cursor the previous page ended with."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        user_id = session['user_id']
+
+        try:
+            rows, next_cursor = contacts_page(user_id, request.args.get('cursor'),
+                                              page_size(request.args.get('limit')))
+        except PageError as error:
+            return jsonify({'error': str(error)}), 400
 
-        return render_template('contacts.html', contacts=contacts, all_todos=all_todos, companies=companies)
+        return jsonify(page_json(rows, next_cursor, contact_json))
 
 
 @app.route('/dashboard/contacts/<contact_id>', methods=['GET'])
@@ -673,30 +853,44 @@ def show_a_contact(contact_id):
     else:
         # get user_id from session
         user_id = session['user_id']
-        user = User.query.filter(User.user_id == user_id).one()
-        companies = user.companies
+        companies = company_cache.get(user_id, current_data_version())
 
         # get edit status
         edit = request.args.get('edit')
 
-        # get contact (join companies) and all events
+        # get contact (join companies) and the newest page of its events
         contact = Contact.query.filter(Contact.contact_id == contact_id).options(db.joinedload('companies')).first()
-        contact_events = ContactEvent.query.filter(ContactEvent.contact_id == contact_id).order_by(desc('date_created')).all()
+        contact_events, next_cursor = contact_events_page(contact_id)
 
-        # query for associated tasks, return list
-        all_todos = []
-        for event in contact_events:
-            todo = ToDo.query.filter(ToDo.contact_event_id == event.contact_event_id).options(db.joinedload('todo_codes')).first()
-            all_todos.append(todo)
+        # each event's task came with it, so no query per event
+        all_todos = [event.todos[0] for event in contact_events if event.todos]
 
         return render_template('contact-info.html',
                                edit=edit,
                                contact=contact,
                                contact_events=contact_events,
                                all_todos=all_todos,
+                               next_cursor=next_cursor,
                                companies=companies)
 
 
+@app.route('/dashboard/contacts/<contact_id>/events')
+def show_contact_events_page(contact_id):
+    """Return a page of a contact's events as JSON, after the cursor the previous page ended with."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        try:
+            rows, next_cursor = contact_events_page(contact_id, request.args.get('cursor'),
+                                                    page_size(request.args.get('limit')))
+        except PageError as error:
+            return jsonify({'error': str(error)}), 400
+
+        return jsonify(page_json(rows, next_cursor, contact_event_json))
+
+
 @app.route('/dashboard/contacts/edit', methods=['POST'])
 def edit_a_contact():
     """Allows user to edit info about a contact"""
@@ -714,20 +908,21 @@ def edit_a_contact():
         phone = "".join((request.form['phone']).split('-'))
         contact.phone = phone
 
-        # look for company_id and find existing company OR
-        # get new company_name and create company object, add, commit
+        # use the chosen company, or find or create one by name
         if request.form['company_id']:
-            company_id = int(request.form['company_id'])
-            company = Company.query.filter(Company.company_id == company_id).first()
+            contact.company_id = Company.owned_id(session['user_id'], int(request.form['company_id']))
+            if contact.company_id is None:
+                return 'No such company.', 404
         elif request.form['company_name']:
-            company_name = request.form['company_name']
-            company = Company(name=company_name)
-            db.session.add(company)
-            db.session.commit()
+            contact.company_id = Company.get_or_create_id(session['user_id'], request.form['company_name'])
 
-        contact.company_id = company.company_id
+        # one commit for the contact and any new company
+        bump_data_version(session['user_id'])
         db.session.commit()
 
+        # the contact may have moved to a company new to the user
+        company_cache.invalidate(session['user_id'])
+
         # send results back to webpage
         results = {
             'email': contact.email,
@@ -767,47 +962,47 @@ def process_contact_form():
         else:
             notes = ""
 
-        # look for company_id and find existing company
-        # or get new company_name and create company object, add, commit
+        # everything below is one transaction, committed once at the end
+
+        # use the chosen company, or find or create one by name
         if request.form['company_id']:
-            company_id = int(request.form['company_id'])
-            company = Company.query.filter(Company.company_id == company_id).first()
+            company_id = Company.owned_id(user_id, int(request.form['company_id']))
+            if company_id is None:
+                return 'No such company.', 404
         elif request.form['company_name']:
-            company_name = request.form['company_name']
-            company = Company(name=company_name)
-            db.session.add(company)
-            db.session.commit()
+            company_id = Company.get_or_create_id(user_id, request.form['company_name'])
 
-        # create new contact and commit to db
+        # create new contact and add it
         new_contact = Contact(fname=fname, lname=lname, email=email, phone=phone,
-                              company_id=company.company_id, notes=notes)
+                              company_id=company_id, notes=notes)
         db.session.add(new_contact)
-        db.session.commit()
 
-        # create initial contact event
+        # create initial contact event; the flush fills in the contact's id
         contact_code = request.form['contact_event']
         today = datetime.now()
-        contact_event = ContactEvent(user_id=user_id, contact_id=new_contact.contact_id,
+        contact_event = ContactEvent(user_id=user_id, contacts=new_contact,
                                      contact_code=contact_code, date_created=today)
         db.session.add(contact_event)
-        db.session.commit()
 
-        todo_for_event = {'1': '8', '2': '8', '3': '9', '4': '8', '5': '9'}
-        todo_code = todo_for_event[contact_code]
-        find_code = ToDoCode.query.filter(ToDoCode.todo_code == todo_code).first()
-        num_days = find_code.sugg_due_date
-        due_date = today + timedelta(days=num_days)
-
-        # activate todo for event
-        new_todo = ToDo(contact_event_id=contact_event.contact_event_id,
-                        todo_code=todo_code,
-                        date_created=today,
-                        date_due=due_date,
-                        active_status=True)
-        db.session.add(new_todo)
+        # the todo this event starts, and when it's due, from the code tables
+        todo = code_registry.todo_for_contact(contact_code)
+        if todo:
+            todo_code, num_days = todo
+
+            # activate todo for event
+            db.session.add(ToDo(contact_events=contact_event,
+                                todo_code=todo_code,
+                                date_created=today,
+                                date_due=today + timedelta(days=num_days),
+                                active_status=True))
+        bump_data_version(user_id)
         db.session.commit()
 
-        flash('{} {} added to your contacts'.format(new_contact.fname, new_contact.lname), 'success')
+        # the contact may link the user to a new company
+        company_cache.invalidate(user_id)
+
+        # the committed contact would be reloaded to read its name, so use the form's
+        flash('{} {} added to your contacts'.format(fname, lname), 'success')
         return redirect('/dashboard/contacts')
 
 
@@ -831,21 +1026,19 @@ def update_contact_status():
                                      contact_code=contact_code,
                                      date_created=today)
         db.session.add(contact_event)
-        db.session.commit()
 
-        todo_for_event = {'1': '8', '2': '8', '3': '9', '4': '8', '5': '9'}
-        todo_code = todo_for_event[contact_code]
-        find_code = ToDoCode.query.filter(ToDoCode.todo_code == todo_code).first()
-        num_days = find_code.sugg_due_date
-        due_date = today + timedelta(days=num_days)
-
-        # activate todo for event
-        new_todo = ToDo(contact_event_id=contact_event.contact_event_id,
-                        todo_code=todo_code,
-                        date_created=today,
-                        date_due=due_date,
-                        active_status=True)
-        db.session.add(new_todo)
+        # the todo this event starts, and when it's due, from the code tables
+        todo = code_registry.todo_for_contact(contact_code)
+        if todo:
+            todo_code, num_days = todo
+
+            # activate todo for event, committed with it; the flush fills in the event's id
+            db.session.add(ToDo(contact_events=contact_event,
+                                todo_code=todo_code,
+                                date_created=today,
+                                date_due=today + timedelta(days=num_days),
+                                active_status=True))
+        bump_data_version(user_id)
         db.session.commit()
 
         return redirect('/dashboard/contacts')
@@ -854,6 +1047,7 @@ def update_contact_status():
 # USER PROFILE
 #################################################################################
 @app.route('/dashboard/profile', methods=['GET'])
+@conditional_on_data_version
 def show_user_profile():
     """Show user's profile and allow update to information."""
 
@@ -864,7 +1058,6 @@ def show_user_profile():
         # find user in db
         user_id = session['user_id']
         user = User.query.filter(User.user_id == user_id).one()
-        companies = user.companies
 
         # get user data to pass into charts
         user_job_events = JobEvent.query.options(db.joinedload('jobs')).filter(JobEvent.user_id == user_id).all()
@@ -882,7 +1075,7 @@ def show_user_profile():
             'offers': total_job_offer
         }
 
-        return render_template('profile-tasks.html', companies=companies,
+        return render_template('profile-tasks.html',
                                user=user, user_analytics=user_analytics)
 
 
@@ -903,6 +1096,7 @@ def edit_user_profile():
         user.lname = request.form['lname']
         user.email = request.form['email']
         user.phone = request.form['phone']
+        bump_data_version(user_id)
         db.session.commit()
 
         results = {
@@ -915,6 +1109,102 @@ def edit_user_profile():
     return jsonify(results)
 
 
+# JSON API
+#################################################################################
+# Read-only JSON for the dashboards. Each answers a repeat request with 304
+# until the user's data changes.
+
+@app.route('/api/jobs')
+@conditional_on_data_version
+def api_active_jobs():
+    """Return the user's active jobs as JSON."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        return jsonify(api.active_jobs(session['user_id']))
+
+
+@app.route('/api/jobs/archived')
+@conditional_on_data_version
+def api_archived_jobs():
+    """Return a page of the user's archived jobs as JSON, after the cursor the previous page ended with."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        try:
+            return jsonify(api.archived_jobs(session['user_id'], request.args.get('cursor'),
+                                             page_size(request.args.get('limit'))))
+        except PageError as error:
+            return jsonify({'error': str(error)}), 400
+
+
+@app.route('/api/companies')
+@conditional_on_data_version
+def api_companies():
+    """Return the user's companies as JSON."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        return jsonify(api.companies(session['user_id']))
+
+
+@app.route('/api/contacts')
+@conditional_on_data_version
+def api_contacts():
+    """Return a page of the user's contacts as JSON, after the cursor the previous page ended with."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        try:
+            return jsonify(api.contacts(session['user_id'], request.args.get('cursor'),
+                                        page_size(request.args.get('limit'))))
+        except PageError as error:
+            return jsonify({'error': str(error)}), 400
+
+
+@app.route('/api/todos')
+@conditional_on_data_version
+def api_todos():
+    """Return the user's active todos as JSON."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        return jsonify(api.todos(session['user_id']))
+
+
+# CACHE STATS
+#################################################################################
+@app.route('/dashboard/cache-stats')
+def show_cache_stats():
+    """Show hit and miss counters for the in-process caches."""
+
+    # redirect if user is not logged in
+    if not session:
+        return redirect('/')
+    else:
+        return jsonify({'companies': company_cache.stats(), 'fragments': fragment_cache.stats()})
+
+
+# METRICS
+#################################################################################
+@app.route('/metrics')
+def show_metrics():
+    """Request, database pool and cache metrics in the Prometheus text format."""
+
+    # no login, so Prometheus (or curl) can scrape it
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 #################################################################################
 def credentials_to_dict(credentials):
     return {'token': credentials.token,
@@ -925,6 +1215,28 @@ def credentials_to_dict(credentials):
             'scopes': credentials.scopes}
 
 
+def create_app(db_uri='postgresql:///jobs', pool=None):
+    """Connect the app to its database and load its reference data, ready to serve.
+
+    pool holds connection pool settings for connect_to_db(). The app is left
+    holding no connections, so worker processes forked from it (see wsgi.py)
+    each open their own."""
+
+    connect_to_db(app, db_uri, pool)
+
+    # log each request's SQL line to stdout, which flask.service keeps in flask.log
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    # read the reference data once, before serving requests, so forked workers share it
+    with app.app_context():
+        salary_service.load()
+        code_registry.get_data()
+        db.session.remove()
+        db.engine.dispose()
+
+    return app
+
+
 if __name__ == '__main__':
     # When running locally, disable OAuthlib's HTTPs verification.
     # ACTION ITEM for developers:
@@ -939,7 +1251,8 @@ if __name__ == '__main__':
     # make sure templates, etc. are not cached in debug mode
     app.jinja_env.auto_reload = app.debug
 
-    connect_to_db(app)
+    # a single process for development; production runs wsgi.py under gunicorn
+    create_app()
 
     # Use the DebugToolbar
     # DebugToolbarExtension(app)
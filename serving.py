@@ -0,0 +1,40 @@
+"""Gunicorn settings for serving wsgi.py in production.
+
+    gunicorn -c serving.py wsgi:app
+
+Workers are processes, so requests run in parallel on every core; each runs
+THREADS requests at once, so a slow Google Calendar call or query only holds
+up its own thread. The app is loaded once in the master and forked, so the
+reference data is read once and shared; create_app() closes its connections
+before the fork, and model.py refuses any connection a worker inherits."""
+
+import multiprocessing
+import os
+
+
+def env_int(name, default):
+    """An integer setting from the environment."""
+
+    return int(os.environ.get(name, default))
+
+
+# requests each worker process serves at once; wsgi.py sizes the connection pool to match.
+# memtrace.py measures a whole process's memory, so tracing needs one request at a time
+THREADS = 1 if os.environ.get('MEMTRACE') else env_int('THREADS', 4)
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# one process per core, and one more to fill the gaps while others wait on the database
+workers = env_int('WORKERS', multiprocessing.cpu_count() + 1)
+worker_class = 'gthread'
+threads = THREADS
+
+# a worker silent this long is killed and replaced
+timeout = env_int('WORKER_TIMEOUT', 60)
+graceful_timeout = 30
+keepalive = 5
+
+preload_app = True
+
+# requests go to stdout with the SQL log, which flask.service keeps in flask.log
+accesslog = '-'
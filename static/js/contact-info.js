@@ -1,24 +1,25 @@
 "use strict";
 
 // TASK ARCHIVE SCRIPT
-function strikeArchiveTask(results) {
+function strikeArchiveTask(form, results) {
     alert(results);
-    $('#submitTaskArchive').hide();
-    $('#archiveTask').css({'text-decoration': 'line-through'});
-    $('#archiveDueDate').css({'text-decoration': 'line-through'});
+    form.hide();
+    form.closest('tr').find('#archiveTask, #archiveDueDate').css({'text-decoration': 'line-through'});
 }
 
 function sendArchiveTask(e) {
     console.log(e);
     e.preventDefault();
 
+    // each row has its own form, including rows added by "Show more"
+    const form = $(this);
     const formInputs = {
-        'todo_id': $('#todo-id-field').val(),
+        'todo_id': form.find('input[name="todo_id"]').val(),
     };
 
     $.post('/dashboard/archive-task',
         formInputs,
-        strikeArchiveTask);
+        function (results) { strikeArchiveTask(form, results); });
 }  
 
 // EDIT CONTACT AJAX SCRIPT
@@ -66,3 +67,11 @@ function toggleEditFields(e) {
     $('#contactEvents').toggle();
     $('#toggleEditButton').toggle();
 }
+
+// SHOW MORE SCRIPT
+function contactEventRow(event) {
+    return $('<tr>').append(
+        textCell(monthDay(event.date_created)),
+        textCell(event.action),
+        todoCells(event.todo));
+}
@@ -1,10 +1,9 @@
 "use strict";
 
 // TASK ARCHIVE SCRIPT
-function strikeArchiveTask(results) {
-    $('#archiveTask').css({'text-decoration': 'line-through'});
-    $('#archiveDueDate').css({'text-decoration': 'line-through'});
-    $('#submitTaskArchive').hide();
+function strikeArchiveTask(form, results) {
+    form.closest('tr').find('#archiveTask, #archiveDueDate').css({'text-decoration': 'line-through'});
+    form.hide();
     alert(results);
   }
 
@@ -12,15 +11,27 @@ function strikeArchiveTask(results) {
     console.log(e);
     e.preventDefault();
 
+    // each row has its own form, including rows added by "Show more"
+    const form = $(this);
     const formInputs = {
-      'todo_id': $('#todo-id-field').val(),
+      'todo_id': form.find('input[name="todo_id"]').val(),
     };
 
     $.post('/dashboard/archive-task',
            formInputs,
-           strikeArchiveTask);
+           function (results) { strikeArchiveTask(form, results); });
 }  
 
+// SHOW MORE SCRIPT
+function contactRow(contact) {
+    return $('<tr>').append(
+        textCell(contact.fname, '/dashboard/contacts/' + contact.contact_id),
+        textCell(contact.lname, '/dashboard/contacts/' + contact.contact_id),
+        textCell(contact.company_name,
+                 contact.company_id ? '/dashboard/companies/' + contact.company_id : null),
+        todoCells(contact.todo));
+}
+
 // TABLE SORT
 /* 
    Willmaster Table Sort
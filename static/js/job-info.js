@@ -1,30 +1,32 @@
 "use strict";
 
 // TASK ARCHIVE SCRIPT
-function strikeArchiveTask(results) {
+function strikeArchiveTask(form, results) {
     alert(results);
-    $('#submitTaskArchive').hide();
-    $('#archiveTask').css({'text-decoration': 'line-through'});
-    $('#archiveDueDate').css({'text-decoration': 'line-through'});
+    form.hide();
+    form.closest('tr').find('#archiveTask, #archiveDueDate').css({'text-decoration': 'line-through'});
 }
 
 function sendArchiveTask(e) {
     console.log(e);
     e.preventDefault();
 
+    // each row has its own form, including rows added by "Show more"
+    const form = $(this);
     const formInputs = {
-        'todo_id': $('#todo-id-field').val(),
+        'todo_id': form.find('input[name="todo_id"]').val(),
     };
 
     $.post('/dashboard/archive-task',
         formInputs,
-        strikeArchiveTask);
+        function (results) { strikeArchiveTask(form, results); });
 }   
 
 // SALARY PICKER AJAX SCRIPT
 function showSalary(results) {
     $('#averageSalary').html(results);
     $('#averageSalaryEditField').html(results);
+    $('#salarySuggestion').hide();
     $('#metroDiv').hide();
     $('#jobTitleDiv').hide();
     $('#salaryButton').hide();
@@ -87,48 +89,10 @@ function toggleEditFields(e) {
     $('#toggleEditButton').toggle();
 }
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+// SHOW MORE SCRIPT
+function jobEventRow(event) {
+    return $('<tr>').append(
+        textCell(monthDay(event.date_created)),
+        textCell(event.status),
+        todoCells(event.todo));
+}
@@ -1,5 +1,15 @@
 "use strict";
 
+// SHOW MORE SCRIPT
+function archivedJobRow(job) {
+    return $('<tr>').append(
+        textCell(job.company_name, '/dashboard/companies/' + job.company_id),
+        textCell(job.title, '/dashboard/jobs/' + job.job_id),
+        textCell(job.status),
+        textCell(monthDay(job.date_created)),
+        textCell(job.notes));
+}
+
 // TABLE SORT SCRIPT
 /* 
    Willmaster Table Sort
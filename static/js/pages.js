@@ -0,0 +1,71 @@
+"use strict";
+
+// SHOW MORE SCRIPT
+// Long lists render their newest page; the "Show more" button fetches the
+// next page from the list's JSON endpoint, appends its rows and keeps the
+// cursor for the page after, hiding itself once there are no more pages.
+
+const MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'];
+
+// "2018-06-09T10:00:00" -> "Jun-9", as the templates show dates
+function monthDay(isoDate) {
+    if (!isoDate) {
+        return '';
+    }
+    return MONTHS[parseInt(isoDate.substr(5, 2), 10) - 1] + '-' + parseInt(isoDate.substr(8, 2), 10);
+}
+
+// a table cell holding text, or a link with text when href is given
+function textCell(text, href) {
+    const cell = $('<td>');
+    if (href) {
+        cell.append($('<a>').attr('href', href).text(text));
+    } else {
+        cell.text(text);
+    }
+    return cell;
+}
+
+// the form that archives a task, as the templates render it
+function archiveForm(todo) {
+    return $('<form>').addClass('form-inline pull-left')
+        .attr({'id': 'submitTaskArchive', 'action': '/dashboard/archive-task', 'method': 'POST'})
+        .append($('<button>').addClass('btn').attr({'id': 'archiveButton', 'type': 'submit'}).append(
+            $('<input>').attr({'id': 'todo-id-field', 'type': 'hidden', 'name': 'todo_id', 'value': todo.todo_id}),
+            $('<i>').addClass('fas fa-archive')));
+}
+
+// a task and due date cell pair, with the archive form while the task is
+// active and struck through once it is done
+function todoCells(todo) {
+    if (!todo) {
+        return [$('<td>'), $('<td>')];
+    }
+    if (!todo.active) {
+        return [$('<td>').addClass('archived-task').append($('<del>').text(todo.description)),
+                $('<td>').addClass('archived-task').append($('<del>').text(monthDay(todo.date_due)))];
+    }
+    return [$('<td>').addClass('active-task').append(
+                $('<span>').attr('id', 'archiveTask').text(todo.description)),
+            $('<td>').addClass('active-task').append(
+                $('<span>').attr('id', 'archiveDueDate').text(monthDay(todo.date_due)),
+                archiveForm(todo))];
+}
+
+function loadMoreRows(button, tbody, buildRow) {
+    button.prop('disabled', true);
+    $.get(button.data('url'),
+          {'cursor': button.data('cursor')},
+          function (results) {
+              for (const row of results.rows) {
+                  tbody.append(buildRow(row));
+              }
+              if (results.next_cursor) {
+                  button.data('cursor', results.next_cursor);
+                  button.prop('disabled', false);
+              } else {
+                  button.hide();
+              }
+          });
+}
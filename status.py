@@ -0,0 +1,204 @@
+"""Current status of a user's jobs, kept in the job_statuses projection.
+
+Every job a user tracks has one job_statuses row pointing at its latest job
+event and that event's todo. Handlers that add a job event call
+record_job_status() before they commit, so the row changes in the same
+transaction as the event. Run this file to rebuild the table from job_events."""
+
+from datetime import datetime, timedelta
+from sqlalchemy import and_, desc, func
+from sqlalchemy.dialects.postgresql import insert
+from codes import LAST_ACTIVE_JOB_CODE, code_registry
+from model import Company, Job, JobEvent, JobStatus, ToDo, connect_to_db, db, insert_columns, next_ids
+
+
+# most job status changes one request may make
+MAX_TRANSITIONS = 1000
+
+
+def job_statuses_query(user_id, active_status=True):
+    """The unordered query behind current_job_statuses(), for callers that page through it."""
+
+    return (db.session.query(JobEvent, ToDo, Company)
+              .select_from(JobStatus)
+              .join(JobEvent, JobEvent.job_event_id == JobStatus.job_event_id)
+              .join(Job, Job.job_id == JobStatus.job_id)
+              .join(Company, Company.company_id == Job.company_id)
+              .outerjoin(ToDo, and_(ToDo.todo_id == JobStatus.todo_id,
+                                    ToDo.active_status == True))
+              .filter(JobStatus.user_id == user_id, Job.active_status == active_status)
+              .options(db.contains_eager(JobEvent.jobs).contains_eager(Job.companies)))
+
+
+def current_job_statuses(user_id, active_status=True):
+    """Find the latest event of every active (or archived) job a user tracks.
+
+    Returns a list of (job_event, todo, company) rows, newest event first, where
+    todo is the active todo for that event or None. The event's job and
+    company are loaded in the same statement, and code descriptions come from
+    the code registry, so the whole dashboard costs one query that reads one
+    row per job."""
+
+    rows = (job_statuses_query(user_id, active_status)
+              .order_by(desc(JobStatus.last_activity), desc(JobStatus.job_event_id))
+              .all())
+
+    return rows
+
+
+def record_job_status(job_event, todo=None):
+    """Point a job's current status row at a new job event and its todo.
+
+    Runs in the caller's transaction, so call it before committing the event.
+    An event older than the one already recorded leaves the row alone."""
+
+    # make sure the event and todo have ids
+    db.session.flush()
+
+    values = {
+        'user_id': job_event.user_id,
+        'job_id': job_event.job_id,
+        'job_code': job_event.job_code,
+        'job_event_id': job_event.job_event_id,
+        'todo_id': todo.todo_id if todo else None,
+        'last_activity': job_event.date_created,
+    }
+
+    stmt = insert(JobStatus).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[JobStatus.user_id, JobStatus.job_id],
+        set_={column: stmt.excluded[column]
+              for column in ('job_code', 'job_event_id', 'todo_id', 'last_activity')},
+        where=JobStatus.last_activity <= stmt.excluded.last_activity)
+
+    db.session.execute(stmt)
+
+
+def change_job_statuses(user_id, transitions):
+    """Move many of a user's jobs to new job codes with a fixed number of statements.
+
+    transitions is a list of {'job_id': ..., 'job_code': ...} dicts. Each good
+    one closes the todo of the job's latest event, adds a new event with the
+    todo its code starts, archives the job if the search for it is over, and
+    moves its status row, as update_job_status does for one job. Runs in the
+    caller's transaction. Returns counts and the transitions that were skipped,
+    by their index in the list."""
+
+    codes = code_registry.get_data()
+    errors = []
+
+    # the last change asked for each job is the one that's made
+    changes = {}
+    for index, transition in enumerate(transitions):
+        try:
+            job_id = int(transition['job_id'])
+            job_code = int(transition['job_code'])
+        except (TypeError, KeyError, ValueError):
+            errors.append({'index': index, 'error': "job_id and job_code must be numbers."})
+            continue
+
+        if job_code not in codes.job_todos:
+            errors.append({'index': index, 'error': f"job_code {job_code} is not a job code."})
+            continue
+
+        if job_id in changes:
+            errors.append({'index': changes[job_id][0], 'error': "job_id is changed again later in the list."})
+        changes[job_id] = (index, job_code)
+
+    # every job's latest event, from its status row, which only the user's own jobs have
+    latest = dict(db.session.query(JobStatus.job_id, JobStatus.job_event_id)
+                    .filter(JobStatus.user_id == user_id, JobStatus.job_id.in_(changes))
+                    .all()) if changes else {}
+
+    for job_id in set(changes) - set(latest):
+        errors.append({'index': changes[job_id][0], 'error': "job_id is not one of your jobs."})
+
+    job_ids = sorted(latest)
+    archived = [job_id for job_id in job_ids if changes[job_id][1] > LAST_ACTIVE_JOB_CODE]
+
+    if job_ids:
+        # close the todos of the latest events, in one statement
+        ToDo.query.filter(ToDo.job_event_id.in_(latest.values())).update(
+            {'active_status': False}, synchronize_session=False)
+
+        today = datetime.now()
+        job_event_ids = next_ids('job_events', 'job_event_id', len(job_ids))
+        # a job code with no todo code starts no todo
+        todo_job_ids = [job_id for job_id in job_ids if codes.job_todos[changes[job_id][1]] is not None]
+        todo_ids = dict(zip(todo_job_ids, next_ids('todos', 'todo_id', len(todo_job_ids))))
+
+        event_rows, todo_rows, status_rows = [], [], []
+        for job_id, job_event_id in zip(job_ids, job_event_ids):
+            job_code = changes[job_id][1]
+            todo_code = codes.job_todos[job_code]
+            todo_id = todo_ids.get(job_id)
+
+            event_rows.append({'job_event_id': job_event_id, 'user_id': user_id, 'job_id': job_id,
+                               'job_code': job_code, 'date_created': today})
+            if todo_id is not None:
+                todo_rows.append({'todo_id': todo_id, 'job_event_id': job_event_id, 'todo_code': todo_code,
+                                  'date_created': today, 'active_status': True,
+                                  'date_due': today + timedelta(days=codes.todo_codes[todo_code].sugg_due_date)})
+            status_rows.append({'job_id': job_id, 'job_code': job_code, 'job_event_id': job_event_id,
+                                'todo_id': todo_id, 'last_activity': today})
+
+        insert_columns(JobEvent, event_rows)
+        if todo_rows:
+            insert_columns(ToDo, todo_rows)
+
+        if archived:
+            Job.query.filter(Job.job_id.in_(archived)).update({'active_status': False},
+                                                              synchronize_session=False)
+
+        # move every status row to its new event, in one statement
+        db.session.execute(
+            "UPDATE job_statuses SET job_code = changes.job_code, job_event_id = changes.job_event_id, "
+            "todo_id = changes.todo_id, last_activity = changes.last_activity "
+            "FROM unnest(CAST(:job_id AS integer[]), CAST(:job_code AS integer[]), "
+            "CAST(:job_event_id AS integer[]), CAST(:todo_id AS integer[]), "
+            "CAST(:last_activity AS timestamp[])) "
+            "AS changes(job_id, job_code, job_event_id, todo_id, last_activity) "
+            "WHERE job_statuses.user_id = :user_id AND job_statuses.job_id = changes.job_id",
+            dict({name: [row[name] for row in status_rows] for name in status_rows[0]},
+                 user_id=user_id))
+
+    return {'updated': len(job_ids),
+            'archived': len(archived),
+            'errors': sorted(errors, key=lambda error: error['index'])}
+
+
+def rebuild_job_statuses():
+    """Replay job_events to fill job_statuses from scratch."""
+
+    print("Rebuilding job statuses...")
+
+    # the oldest active todo of each event
+    todos = (db.session.query(ToDo.job_event_id, func.min(ToDo.todo_id).label('todo_id'))
+               .filter(ToDo.active_status == True, ToDo.job_event_id != None)
+               .group_by(ToDo.job_event_id)
+               .subquery())
+
+    # the latest event of each (user, job)
+    latest = (db.session.query(JobEvent.user_id, JobEvent.job_id, JobEvent.job_code,
+                               JobEvent.job_event_id, todos.c.todo_id, JobEvent.date_created)
+                .outerjoin(todos, todos.c.job_event_id == JobEvent.job_event_id)
+                .distinct(JobEvent.user_id, JobEvent.job_id)
+                .order_by(JobEvent.user_id, JobEvent.job_id,
+                          desc(JobEvent.date_created), desc(JobEvent.job_event_id)))
+
+    # swap the contents in one transaction so readers never see an empty table
+    JobStatus.query.delete()
+    db.session.execute(insert(JobStatus).from_select(
+        ['user_id', 'job_id', 'job_code', 'job_event_id', 'todo_id', 'last_activity'],
+        latest))
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    # In case the table hasn't been created, create it
+    db.create_all()
+
+    rebuild_job_statuses()
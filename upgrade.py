@@ -0,0 +1,309 @@
+"""Bring an existing job hunt app database up to date with model.py.
+
+Safe to run more than once: every step checks what is already there first."""
+
+import re
+from sqlalchemy import func, inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from model import (Company, Contact, ContactEvent, Job, JobEvent, JobStatus, Salary, company_key, connect_to_db,
+                   db, next_ids)
+from salaries import parse_percent, parse_salary
+from status import rebuild_job_statuses
+
+
+def create_tables():
+    """Create any tables added to model.py since the database was set up."""
+
+    print("Creating tables...")
+
+    db.create_all()
+
+
+def add_columns():
+    """Add columns declared in model.py that existing tables are missing.
+
+    New columns must be nullable or have a server default, since existing
+    rows have no value for them."""
+
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            print(f"Adding column {table.name}.{column.name}...")
+            ddl = str(CreateColumn(column).compile(dialect=db.engine.dialect))
+            db.session.execute(f'ALTER TABLE "{table.name}" ADD COLUMN {ddl}')
+
+    db.session.commit()
+
+
+# indexes model.py no longer declares, which would reject rows the later steps write
+RETIRED_INDEXES = [
+    # company names were unique across every user before companies had owners
+    'ix_companies_name_key',
+]
+
+
+def drop_retired_indexes():
+    """Drop the indexes in RETIRED_INDEXES that the database still has."""
+
+    # CONCURRENTLY can't run inside a transaction block
+    conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+    for name in RETIRED_INDEXES:
+        print(f"Dropping index {name} if it exists...")
+        conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+    conn.close()
+
+
+def fill_salary_amounts():
+    """Parse salary strings into the numeric salary columns where they are still empty."""
+
+    print("Filling numeric salaries...")
+
+    salaries = (db.session.query(Salary.salary_id, Salary.avg_salary, Salary.yoy_salary)
+                  .filter(Salary.avg_salary_amount == None)
+                  .all())
+    db.session.bulk_update_mappings(Salary, [
+        {'salary_id': salary_id,
+         'avg_salary_amount': parse_salary(avg_salary),
+         'yoy_percent': parse_percent(yoy_salary)}
+        for salary_id, avg_salary, yoy_salary in salaries])
+
+    jobs = (db.session.query(Job.job_id, Job.avg_salary)
+              .filter(Job.avg_salary != None, Job.avg_salary_amount == None)
+              .all())
+    db.session.bulk_update_mappings(Job, [
+        {'job_id': job_id, 'avg_salary_amount': parse_salary(avg_salary)}
+        for job_id, avg_salary in jobs])
+
+    db.session.commit()
+
+
+def load_todo_rules():
+    """Reload the code tables, filling in the todo each job and contact code starts.
+
+    The seed loaders bump the codes' reference version, so running servers
+    pick up the new rules without a restart."""
+
+    # seed imports the app, so like __main__ below, only import it when run
+    import seed
+
+    seed.load_todocodes()
+    seed.load_contactcodes()
+    seed.load_jobcodes()
+
+
+def assign_company_owners():
+    """Give every company without an owner to the user with the earliest job or contact event there.
+
+    Companies used to be shared by everyone who named them alike. Every other
+    user with jobs or contacts at such a company gets a copy of it, with its
+    name and address but not the owner's notes, and their jobs and contacts
+    move to the copy. Companies no one uses keep no owner. Ids come from the
+    companies sequence, so seed.py runs this after set_sequences()."""
+
+    print("Assigning company owners...")
+
+    links = (db.session.query(Job.company_id, JobEvent.user_id, func.min(JobEvent.date_created))
+               .join(JobEvent, JobEvent.job_id == Job.job_id)
+               .join(Company, Company.company_id == Job.company_id)
+               .filter(Company.owner_user_id == None)
+               .group_by(Job.company_id, JobEvent.user_id)
+             .union_all(
+             db.session.query(Contact.company_id, ContactEvent.user_id, func.min(ContactEvent.date_created))
+               .join(ContactEvent, ContactEvent.contact_id == Contact.contact_id)
+               .join(Company, Company.company_id == Contact.company_id)
+               .filter(Company.owner_user_id == None)
+               .group_by(Contact.company_id, ContactEvent.user_id)))
+
+    owners = {}    # company id -> owner
+    copies = {}    # (company id, user id) for the other users at it, in order
+    for company_id, user_id, date_created in sorted(links, key=lambda link: (link[0], link[2], link[1])):
+        if owners.setdefault(company_id, user_id) != user_id:
+            copies[company_id, user_id] = True
+    copies = list(copies)
+
+    if owners:
+        db.session.execute("UPDATE companies SET owner_user_id = owned.user_id "
+                           "FROM unnest(CAST(:company_id AS integer[]), CAST(:user_id AS integer[])) "
+                           "AS owned(company_id, user_id) WHERE companies.company_id = owned.company_id",
+                           {'company_id': list(owners), 'user_id': list(owners.values())})
+
+    if copies:
+        copied = ("unnest(CAST(:copy_id AS integer[]), CAST(:company_id AS integer[]), "
+                  "CAST(:user_id AS integer[])) AS copied(copy_id, company_id, user_id)")
+        params = {'copy_id': next_ids('companies', 'company_id', len(copies)),
+                  'company_id': [company_id for company_id, user_id in copies],
+                  'user_id': [user_id for company_id, user_id in copies]}
+
+        columns = ('name', 'name_key', 'street', 'city', 'state', 'zipcode', 'website')
+        db.session.execute(f"INSERT INTO companies (company_id, owner_user_id, {', '.join(columns)}) "
+                           f"SELECT copied.copy_id, copied.user_id, "
+                           + ", ".join(f"companies.{column}" for column in columns)
+                           + f" FROM {copied} JOIN companies ON companies.company_id = copied.company_id", params)
+
+        for table, events, id_column in (('jobs', 'job_events', 'job_id'),
+                                         ('contacts', 'contact_events', 'contact_id')):
+            db.session.execute(f"UPDATE {table} SET company_id = copied.copy_id FROM {copied}, {events} "
+                               f"WHERE {table}.company_id = copied.company_id "
+                               f"AND {events}.{id_column} = {table}.{id_column} "
+                               f"AND {events}.user_id = copied.user_id", params)
+
+        # pages cached against the shared companies are stale for their users
+        db.session.execute("UPDATE users SET data_version = data_version + 1 "
+                           "WHERE user_id = ANY(CAST(:user_id AS integer[]))",
+                           {'user_id': sorted(set(params['user_id']) | set(owners.values()))})
+
+    db.session.commit()
+
+    print(f"  {len(owners)} companies given owners, {len(copies)} copied for other users")
+
+
+def merge_duplicate_companies():
+    """Fold each user's companies whose names share a company_key() into the oldest of them.
+
+    The duplicates' jobs and contacts move to the company that's kept, which
+    takes any address, website or notes it's missing from them, oldest first;
+    then the duplicates are deleted and every company's name_key is filled in,
+    all in one transaction. Run it after assign_company_owners() and before
+    the unique index on owner and name_key is built. Every user's data version
+    goes up, so running servers drop the cached company dropdowns that still
+    list the deleted companies."""
+
+    print("Merging duplicate companies...")
+
+    kept = {}      # (owner, key) -> id of the owner's oldest company with it
+    merges = []    # (duplicate id, kept id)
+    rekeyed = []   # (kept id, key) where name_key is missing or out of date
+    for company_id, owner_user_id, name, name_key in (db.session.query(Company.company_id, Company.owner_user_id,
+                                                                        Company.name, Company.name_key)
+                                                        .order_by(Company.company_id)):
+        key = company_key(name)
+        kept_id = kept.setdefault((owner_user_id, key), company_id)
+        if kept_id != company_id:
+            merges.append((company_id, kept_id))
+        elif name_key != key:
+            rekeyed.append((company_id, key))
+
+    if merges:
+        merged = ("unnest(CAST(:duplicate_id AS integer[]), CAST(:kept_id AS integer[])) "
+                  "AS merged(duplicate_id, kept_id)")
+        params = {'duplicate_id': [duplicate_id for duplicate_id, kept_id in merges],
+                  'kept_id': [kept_id for duplicate_id, kept_id in merges]}
+
+        for table in ('jobs', 'contacts'):
+            db.session.execute(f"UPDATE {table} SET company_id = merged.kept_id FROM {merged} "
+                               f"WHERE {table}.company_id = merged.duplicate_id", params)
+
+        columns = ('street', 'city', 'state', 'zipcode', 'website', 'notes')
+        db.session.execute(
+            "UPDATE companies SET "
+            + ", ".join(f"{column} = COALESCE(companies.{column}, filled.{column})" for column in columns)
+            + " FROM (SELECT merged.kept_id, "
+            + ", ".join(f"(array_agg(duplicate.{column} ORDER BY duplicate.company_id) "
+                        f"FILTER (WHERE duplicate.{column} IS NOT NULL))[1] AS {column}"
+                        for column in columns)
+            + f" FROM {merged} JOIN companies AS duplicate ON duplicate.company_id = merged.duplicate_id"
+            " GROUP BY merged.kept_id) AS filled WHERE companies.company_id = filled.kept_id", params)
+
+        db.session.execute(f"DELETE FROM companies USING {merged} "
+                           "WHERE companies.company_id = merged.duplicate_id", params)
+
+        # pages cached against the old companies are stale for anyone
+        db.session.execute("UPDATE users SET data_version = data_version + 1")
+
+    if rekeyed:
+        params = {'company_id': [company_id for company_id, key in rekeyed],
+                  'name_key': [key for company_id, key in rekeyed]}
+        # clear the old keys first, since a company may be taking another's old key
+        db.session.execute("UPDATE companies SET name_key = NULL "
+                           "WHERE company_id = ANY(CAST(:company_id AS integer[])) AND name_key IS NOT NULL",
+                           params)
+        db.session.execute("UPDATE companies SET name_key = keyed.name_key "
+                           "FROM unnest(CAST(:company_id AS integer[]), CAST(:name_key AS text[])) "
+                           "AS keyed(company_id, name_key) WHERE companies.company_id = keyed.company_id",
+                           params)
+
+    db.session.commit()
+
+    print(f"  {len(merges)} duplicates merged, {len(rekeyed)} companies keyed")
+
+
+def fill_job_statuses():
+    """Fill job_statuses from job_events if it was just created, or is otherwise empty.
+
+    The job dashboards only read job_statuses, so without this every job an
+    existing database tracks would disappear from them."""
+
+    if JobStatus.query.first() is None:
+        rebuild_job_statuses()
+
+
+def create_indexes():
+    """Build the indexes declared in model.py that the database is missing.
+
+    Indexes are built with CREATE INDEX CONCURRENTLY so a live database keeps
+    taking writes while they build. A concurrent build that failed part way
+    leaves an invalid index behind, so those are dropped and built again, as
+    are indexes whose uniqueness no longer matches model.py."""
+
+    # CONCURRENTLY can't run inside a transaction block
+    conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+    invalid = set(name for name, in conn.execute(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid"))
+    inspector = inspect(conn)
+
+    for table in db.metadata.sorted_tables:
+        existing = {index['name']: bool(index['unique'])
+                    for index in inspector.get_indexes(table.name)}
+
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in invalid:
+                print(f"Dropping invalid index {index.name}...")
+                conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"')
+            elif index.name in existing and existing[index.name] != bool(index.unique):
+                print(f"Dropping index {index.name} to change its uniqueness...")
+                conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"')
+            elif index.name in existing:
+                continue
+
+            print(f"Creating index {index.name}...")
+            ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+            conn.execute(re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', ddl))
+
+        # refresh planner statistics so the new indexes get used right away
+        conn.execute(f'ANALYZE "{table.name}"')
+
+    conn.close()
+
+
+def upgrade():
+    """Run every upgrade step in order."""
+
+    create_tables()
+    add_columns()
+    drop_retired_indexes()
+    fill_salary_amounts()
+    load_todo_rules()
+    assign_company_owners()
+    merge_duplicate_companies()
+    fill_job_statuses()
+    create_indexes()
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    upgrade()
@@ -0,0 +1,119 @@
+"""Per-user data versions, for answering repeat GETs with 304 Not Modified.
+
+Every user has a data_version that goes up whenever anything they see
+changes. Write handlers call bump_data_version() before they commit, so the
+bump is part of the change. A GET wrapped in conditional_on_data_version() sends the
+version as its ETag; when a client sends it back in If-None-Match and nothing
+has changed, the answer is a bodiless 304 that costs one indexed query.
+
+ETags also carry a hash of the app's code and templates, so pages cached
+before a deploy aren't reused after it.
+
+Reference tables every process keeps in memory, like salaries, have a version
+of their own that goes up when they are reloaded, so other processes notice."""
+
+import hashlib
+import os
+from functools import wraps
+from flask import Response, g, make_response, request, session
+from sqlalchemy.dialects.postgresql import insert
+from model import ReferenceVersion, User, db
+
+
+# files in this directory are the app's own code
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def release_tag(app_dir=APP_DIR):
+    """A short hash of the app's Python files and templates."""
+
+    digest = hashlib.sha1()
+    for directory, extension in ((app_dir, '.py'), (os.path.join(app_dir, 'templates'), '.html')):
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(extension):
+                with open(os.path.join(directory, name), 'rb') as source:
+                    digest.update(source.read())
+
+    return digest.hexdigest()[:8]
+
+
+# read once per process; every worker of a deploy computes the same one
+RELEASE = release_tag()
+
+
+def data_version(user_id):
+    """A user's current data version, or None if there is no such user."""
+
+    return db.session.query(User.data_version).filter(User.user_id == user_id).scalar()
+
+
+def current_data_version():
+    """The logged in user's data version, read at most once per request."""
+
+    if 'data_version' not in g:
+        g.data_version = data_version(session['user_id'])
+
+    return g.data_version
+
+
+def bump_data_version(user_id):
+    """Mark a user's data as changed, in the caller's transaction."""
+
+    User.query.filter(User.user_id == user_id).update(
+        {User.data_version: User.data_version + 1}, synchronize_session=False)
+
+
+def reference_version(name):
+    """A reference table's current version, 0 if it has never been reloaded."""
+
+    return db.session.query(ReferenceVersion.version).filter(ReferenceVersion.name == name).scalar() or 0
+
+
+def bump_reference_version(name):
+    """Mark a reference table as reloaded, in the caller's transaction."""
+
+    statement = insert(ReferenceVersion).values(name=name, version=1)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[ReferenceVersion.name], set_={'version': ReferenceVersion.version + 1}))
+
+
+def data_etag(user_id, version):
+    """The ETag for a user's data at a version; the user is in it since URLs are shared."""
+
+    return f'{user_id}-{version}-{RELEASE}'
+
+
+def conditional_on_data_version(view):
+    """Answer a logged in user's GET with 304 if their data hasn't changed since If-None-Match.
+
+    The version is read before the view runs, so a 304 skips all of the
+    view's queries and rendering. Other responses carry the ETag and ask the
+    browser to check back before reusing them. A page rendered with flashed
+    messages gets no ETag, since the messages are only meant to show once."""
+
+    @wraps(view)
+    def conditional_view(*args, **kwargs):
+        user_id = session.get('user_id')
+        if user_id is None or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        version = g.data_version = data_version(user_id)
+        if version is None:
+            return view(*args, **kwargs)
+
+        etag = data_etag(user_id, version)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        # the body depends on who's logged in, so only the user's own browser may keep it
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+
+        return response
+
+    return conditional_view
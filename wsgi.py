@@ -0,0 +1,38 @@
+"""Production entry point: the app, connected and loaded, for gunicorn to serve.
+
+    gunicorn -c serving.py wsgi:app
+
+Everything is set from the environment (see serving.py for workers and
+threads). Each worker process has its own connection pool, sized to its
+threads: a request holds one connection from start to finish, so a worker
+never needs more than THREADS at once, plus a little overflow. Mind that
+WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) stays below Postgres'
+max_connections. Workers write their metrics to METRICS_DIR, so /metrics
+reports all of them."""
+
+import os
+from metrics import registry
+from serving import THREADS, env_int
+from server import create_app
+
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql:///jobs')
+
+POOL = {
+    'pool_size': env_int('DB_POOL_SIZE', THREADS),
+    'max_overflow': env_int('DB_MAX_OVERFLOW', 2),
+    # seconds a request waits for a connection before failing
+    'pool_timeout': env_int('DB_POOL_TIMEOUT', 10),
+    # reconnect before firewalls or Postgres drop idle connections
+    'pool_recycle': env_int('DB_POOL_RECYCLE', 1800),
+    # a connection lost while idle (a database restart, say) is replaced before a request gets it
+    'pool_pre_ping': True,
+    # milliseconds a statement may run before Postgres cancels it
+    'statement_timeout': env_int('DB_STATEMENT_TIMEOUT', 15000),
+}
+
+
+# shared before gunicorn forks, so every worker writes to it
+registry.share(os.environ.get('METRICS_DIR', 'metrics'))
+
+app = create_app(DATABASE_URL, POOL)